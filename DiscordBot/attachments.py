@@ -0,0 +1,131 @@
+import asyncio
+import base64
+import hashlib
+from collections import OrderedDict
+
+import aiohttp
+
+from metrics import metrics
+
+
+def image_attachments(attachments):
+    '''
+    Keep only the attachments Discord tagged as images.
+    '''
+    return [a for a in attachments if a.content_type and a.content_type.startswith('image')]
+
+
+class FetchedAttachment:
+    def __init__(self, id, url, content_type, data):
+        self.id = id
+        self.url = url
+        self.content_type = content_type
+        self.data = data
+
+    def data_url(self):
+        '''
+        Inline the bytes as a data: url, the form OpenAI accepts for image inputs.
+        '''
+        return f'data:{self.content_type};base64,{base64.b64encode(self.data).decode("ascii")}'
+
+    def key(self):
+        return hashlib.sha256(self.data).digest()
+
+
+class UnfetchedAttachment:
+    '''
+    An image that was too large or failed to download. It has no bytes, so the classifier is sent its URL.
+    '''
+
+    data = None
+
+    def __init__(self, id, url, content_type):
+        self.id = id
+        self.url = url
+        self.content_type = content_type
+
+    def data_url(self):
+        return self.url
+
+    def key(self):
+        return hashlib.sha256(self.url.encode('utf-8')).digest()
+
+
+class AttachmentFetcher:
+    '''
+    Downloads message attachments into memory with a shared aiohttp session.
+
+    All attachments of a message are fetched in parallel. Files larger than `max_bytes` are skipped, every
+    download is bounded by `timeout` seconds, and recently fetched attachments are kept in an LRU cache keyed
+    by attachment ID that holds at most `cache_bytes` bytes in total. Concurrent requests for the same
+    attachment share one download.
+    '''
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, timeout=10.0, cache_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.cache_bytes = cache_bytes
+        self.cache = OrderedDict()  # attachment id -> FetchedAttachment
+        self.cached_bytes = 0
+        self.pending = {}  # attachment id -> Future for downloads in progress
+        self.session = None
+
+    async def fetch_all(self, attachments, keep_unfetched=False):
+        '''
+        Fetch every image attachment in parallel. Images that were too large or failed to download are
+        dropped, or with `keep_unfetched` returned as UnfetchedAttachments.
+        '''
+        images = image_attachments(attachments)
+        fetched = await asyncio.gather(*(self.fetch(a) for a in images))
+        if keep_unfetched:
+            return [f or UnfetchedAttachment(a.id, a.url, a.content_type) for a, f in zip(images, fetched)]
+        return [a for a in fetched if a is not None]
+
+    async def fetch(self, attachment):
+        if attachment.id in self.cache:
+            self.cache.move_to_end(attachment.id)
+            return self.cache[attachment.id]
+        if attachment.size and attachment.size > self.max_bytes:
+            return None
+        if attachment.id in self.pending:
+            return await asyncio.shield(self.pending[attachment.id])
+
+        future = asyncio.ensure_future(self._download(attachment))
+        self.pending[attachment.id] = future
+        try:
+            fetched = await asyncio.shield(future)
+        finally:
+            self.pending.pop(attachment.id, None)
+        if fetched is not None:
+            self._remember(fetched)
+        return fetched
+
+    async def _download(self, attachment):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        try:
+            with metrics.timer('image_fetch'):
+                async with self.session.get(attachment.url) as response:
+                    response.raise_for_status()
+                    data = bytearray()
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        data += chunk
+                        if len(data) > self.max_bytes:
+                            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        metrics.inc('image_fetch_bytes', len(data))
+        return FetchedAttachment(attachment.id, attachment.url, attachment.content_type, bytes(data))
+
+    def _remember(self, fetched):
+        if len(fetched.data) > self.cache_bytes:
+            return
+        self.cache[fetched.id] = fetched
+        self.cached_bytes += len(fetched.data)
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted.data)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
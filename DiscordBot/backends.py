@@ -0,0 +1,402 @@
+'''
+Classification across several providers.
+
+A `ClassifierBackend` answers the two kinds of request ModBot makes: a yes/no `verdict` for one message and a
+free-text `complete` (the micro-batched JSON verdicts). `OpenAIBackend` wraps the existing Classifier (or a
+WorkerPool client), `VertexBackend` asks Gemini through the ModelRegistry and `PrefilterBackend` answers
+locally with the prefilter model.
+
+`ClassifierRouter` has the Classifier interface, so ModBot uses it like a single classifier. Each request goes
+to the backend that has been fastest recently. If that backend hasn't answered after its own recent p95
+latency, the request is hedged: the same request also goes to the next backend and the first answer wins.
+A backend that fails is skipped straight away. Each backend also has a circuit breaker that opens after a
+run of consecutive errors. Fallback backends such as the local model are never hedged to. They only answer
+when every other backend has failed or is open.
+'''
+import asyncio
+import base64
+import contextvars
+import json
+import re
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+from classifier import label_from_text
+from evaluation import percentile
+from metrics import metrics, log_event
+
+NUMBERED_ITEM = re.compile(r'\d+\. (".*")$')
+
+# The backend that answered the caller's last routed request; set in the caller's own context, so concurrent
+# requests don't see each other's
+answered_by = contextvars.ContextVar('answered_by', default=None)
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+class UnsupportedInput(Exception):
+    '''
+    The backend can't take this request at all, e.g. Vertex with an image we only have a URL for. The router
+    tries the next backend without counting it against the breaker.
+    '''
+
+
+def answered_by_fallback():
+    '''
+    Whether the last classifier request made from this task was answered by a fallback backend. Such answers
+    are stopgaps and shouldn't be cached like the primary model's.
+    '''
+    backend = answered_by.get()
+    return backend is not None and backend.fallback
+
+
+def completion(text):
+    '''
+    A minimal chat-completion-shaped response, so callers of `Classifier.create` work with any backend.
+    '''
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+
+def prompt_parts(messages):
+    '''
+    The content parts of OpenAI-style chat `messages`, in order.
+    '''
+    parts = []
+    for message in messages:
+        content = message['content']
+        parts.extend([{'type': 'text', 'text': content}] if isinstance(content, str) else content)
+    return parts
+
+
+class ClassifierBackend:
+    '''
+    One classification provider. `fallback` backends only answer when every other backend failed.
+    '''
+
+    name = 'backend'
+    model = ''
+    fallback = False
+
+    async def complete(self, messages, max_tokens=300):
+        raise NotImplementedError
+
+    async def verdict(self, messages, logprobs=True):
+        '''
+        (label, confidence) for a single message; confidence is None when the backend can't give one.
+        '''
+        return label_from_text(await self.complete(messages, max_tokens=5)), None
+
+    async def prewarm(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(ClassifierBackend):
+    name = 'openai'
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+        self.model = getattr(classifier, 'model', 'gpt-4o')
+
+    async def complete(self, messages, max_tokens=300):
+        response = await self.classifier.create(messages, max_tokens=max_tokens)
+        return response.choices[0].message.content.strip()
+
+    async def verdict(self, messages, logprobs=True):
+        return await self.classifier.stream_verdict(messages, logprobs=logprobs)
+
+    async def prewarm(self):
+        await self.classifier.prewarm()
+
+    async def close(self):
+        await self.classifier.close()
+
+
+class VertexBackend(ClassifierBackend):
+    '''
+    Gemini through the bot's ModelRegistry, with the same prompts translated into Vertex parts.
+    '''
+
+    name = 'vertex'
+
+    def __init__(self, models, model):
+        self.models = models
+        self.model = model
+
+    async def parts(self, messages):
+        sdk = await self.models.sdk()
+        parts = []
+        for part in prompt_parts(messages):
+            if part['type'] == 'text':
+                parts.append(part['text'])
+                continue
+            url = part['image_url']['url']
+            if not url.startswith('data:'):
+                raise UnsupportedInput(f"Only inline images can be sent to Vertex, got {url[:40]}")
+            header, data = url[5:].split(',', 1)
+            parts.append(sdk.Part.from_data(data=base64.b64decode(data), mime_type=header.split(';')[0]))
+        return parts
+
+    async def complete(self, messages, max_tokens=300):
+        sdk = await self.models.sdk()
+        # Blocked responses have no text, and the messages being judged are often the kind filters block
+        safety_settings = [sdk.SafetySetting(category=category, threshold=sdk.HarmBlockThreshold.BLOCK_NONE)
+                           for category in (sdk.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                                            sdk.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                                            sdk.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                                            sdk.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT)]
+        response = await self.models.generate(self.model, await self.parts(messages),
+                                              generation_config={'max_output_tokens': max_tokens, 'temperature': 0},
+                                              safety_settings=safety_settings)
+        return response.text.strip()
+
+    async def prewarm(self):
+        await self.models.prewarm([self.model])
+
+
+class PrefilterBackend(ClassifierBackend):
+    '''
+    The local prefilter model as a last resort. It only reads text: messages with images get 'uncertain', and
+    so does everything while the model is untrained. The escalation lexicon only says a message needs a closer
+    look, not that it is a violation.
+    '''
+
+    name = 'local'
+    model = 'prefilter'
+    fallback = True
+
+    def __init__(self, prefilter, threshold=0.5):
+        self.prefilter = prefilter
+        self.threshold = threshold
+
+    def label(self, text):
+        if self.prefilter.trained:
+            p = self.prefilter.score(text)
+            return ('yes' if p >= self.threshold else 'no'), p
+        return 'uncertain', None
+
+    async def complete(self, messages, max_tokens=300):
+        parts = prompt_parts(messages)
+        if any(part['type'] != 'text' for part in parts):
+            return 'uncertain'
+        lines = parts[-1]['text'].splitlines()
+        items = [NUMBERED_ITEM.match(line) for line in lines]
+        if lines and all(items):  # a micro-batch: answer with a JSON array of labels
+            return json.dumps([self.label(json.loads(item.group(1)))[0] for item in items])
+        return self.label(parts[-1]['text'])[0]
+
+    async def verdict(self, messages, logprobs=True):
+        parts = prompt_parts(messages)
+        if any(part['type'] != 'text' for part in parts):
+            return 'uncertain', None
+        return self.label(parts[-1]['text'])
+
+
+class CircuitBreaker:
+    '''
+    Opens after `failures` consecutive errors and stays open for `reset_after` seconds. After that it lets
+    one trial request through ("half-open"). The trial's outcome either closes the breaker or reopens it.
+    '''
+
+    def __init__(self, failures=5, reset_after=30.0, clock=time.monotonic):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.clock = clock
+        self.errors = 0
+        self.opened_at = None
+        self.trial = False  # a half-open trial request is in flight
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.clock() - self.opened_at >= self.reset_after else 'open'
+
+    def available(self):
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.trial)
+
+    def start(self):
+        if self.state == 'half-open':
+            self.trial = True
+
+    def success(self):
+        self.errors = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        '''
+        Count an error. Returns True if this opened the breaker.
+        '''
+        self.errors += 1
+        if self.trial or (self.opened_at is None and self.errors >= self.failures):
+            self.opened_at = self.clock()
+            self.trial = False
+            return True
+        return False
+
+    def cancelled(self):
+        self.trial = False  # the trial lost a hedge race; let the next request try instead
+
+
+class ClassifierRouter:
+    '''
+    Routes Classifier calls across `backends`; see the module docstring. Until a backend has `min_samples`
+    recent answers of a kind, requests of that kind are hedged after `hedge_delay` seconds. A `hedge_quantile`
+    of None turns hedging off. Every attempt is bounded by `timeout` seconds.
+    '''
+
+    def __init__(self, backends, hedge_quantile=95, hedge_delay=2.0, min_samples=20, history=200, timeout=30.0,
+                 breaker_failures=5, breaker_reset=30.0, clock=time.monotonic):
+        self.backends = list(backends)
+        self.hedge_quantile = hedge_quantile
+        self.hedge_delay = hedge_delay
+        self.min_samples = min_samples
+        self.timeout = timeout
+        self.breakers = {backend.name: CircuitBreaker(breaker_failures, breaker_reset, clock)
+                         for backend in self.backends}
+        self.latencies = defaultdict(lambda: deque(maxlen=history))  # (backend, kind) -> recent answer times
+        self.counts = defaultdict(int)  # (backend, outcome) -> attempts
+
+    @property
+    def model(self):
+        return '+'.join(f'{backend.name}/{backend.model}' for backend in self.backends)
+
+    def route(self, kind):
+        '''
+        Backends to try for a request of `kind`, in order: the available ones with recent answers, fastest median
+        first; then the available ones without any, in configured order; then the fallbacks.
+        '''
+        available = [backend for backend in self.backends if self.breakers[backend.name].available()]
+        measured = [backend for backend in available if not backend.fallback and self.latencies[backend.name, kind]]
+        measured.sort(key=lambda backend: percentile(list(self.latencies[backend.name, kind]), 50))
+        unmeasured = [backend for backend in available if not backend.fallback and backend not in measured]
+        return measured + unmeasured, [backend for backend in available if backend.fallback]
+
+    def hedge_after(self, backend, kind):
+        latencies = self.latencies[backend.name, kind]
+        if self.hedge_quantile is None:
+            return None  # failover only
+        if len(latencies) < self.min_samples:
+            return self.hedge_delay
+        return percentile(list(latencies), self.hedge_quantile)
+
+    async def attempt(self, backend, kind, call):
+        breaker = self.breakers[backend.name]
+        breaker.start()
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(call(backend), self.timeout)
+        except asyncio.CancelledError:
+            breaker.cancelled()
+            self.counts[backend.name, 'cancelled'] += 1
+            raise
+        except UnsupportedInput:
+            breaker.cancelled()
+            self.counts[backend.name, 'skipped'] += 1
+            metrics.inc('backend_requests', backend=backend.name, outcome='skipped')
+            raise
+        except Exception as e:
+            self.counts[backend.name, 'error'] += 1
+            metrics.inc('backend_requests', backend=backend.name, outcome='error')
+            if breaker.failure():
+                log_event('circuit_open', sample_rate=1.0, backend=backend.name, errors=breaker.errors,
+                          error=f'{type(e).__name__}: {e}')
+            raise
+        elapsed = time.perf_counter() - start
+        breaker.success()
+        self.latencies[backend.name, kind].append(elapsed)
+        self.counts[backend.name, 'ok'] += 1
+        metrics.inc('backend_requests', backend=backend.name, outcome='ok')
+        metrics.observe('backend_latency', elapsed, backend=backend.name, kind=kind)
+        return result
+
+    async def call(self, kind, call):
+        '''
+        Run `call(backend)` on the best backend, hedging and failing over as described above.
+        '''
+        answered_by.set(None)
+        primaries, fallbacks = self.route(kind)
+        if not primaries and not fallbacks:
+            raise BackendUnavailable("Every classifier backend's circuit breaker is open")
+        queue = iter(primaries)
+        pending = {}  # task -> backend
+        started = []
+        error = None
+
+        def launch():
+            backend = next(queue, None)
+            if backend is not None:
+                started.append(backend)
+                pending[asyncio.ensure_future(self.attempt(backend, kind, call))] = backend
+            return backend
+
+        try:
+            launch()
+            while pending:
+                # Hedge only off the backend started last, and only while there is another one to try
+                hedge = self.hedge_after(started[-1], kind) if len(started) < len(primaries) else None
+                done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    backend = launch()
+                    if backend is not None:
+                        self.counts[backend.name, 'hedge'] += 1
+                        metrics.inc('hedged_requests', backend=backend.name)
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        answered_by.set(backend)
+                        return task.result()
+                    error = task.exception()
+                if not pending and launch() is not None:
+                    metrics.inc('classifier_failovers')
+        finally:
+            for task in pending:
+                task.cancel()
+
+        for backend in fallbacks:
+            metrics.inc('classifier_failovers')
+            try:
+                result = await self.attempt(backend, kind, call)
+            except Exception as e:
+                error = e
+                continue
+            answered_by.set(backend)
+            return result
+        raise error
+
+    async def create(self, messages, max_tokens=300):
+        return completion(await self.complete(messages, max_tokens=max_tokens))
+
+    async def complete(self, messages, max_tokens=300):
+        return await self.call('complete', lambda backend: backend.complete(messages, max_tokens=max_tokens))
+
+    async def stream_verdict(self, messages, logprobs=True):
+        return await self.call('verdict', lambda backend: backend.verdict(messages, logprobs=logprobs))
+
+    async def prewarm(self):
+        await asyncio.gather(*(backend.prewarm() for backend in self.backends))
+
+    async def close(self):
+        await asyncio.gather(*(backend.close() for backend in self.backends))
+
+    def stats(self):
+        lines = []
+        for backend in self.backends:
+            line = (f"{backend.name} ({backend.model}): {self.breakers[backend.name].state}, "
+                    f"{self.counts[backend.name, 'ok']} answers, {self.counts[backend.name, 'error']} errors, "
+                    f"{self.counts[backend.name, 'hedge']} hedges")
+            for kind in ('verdict', 'complete'):
+                calls = list(self.latencies[backend.name, kind])
+                if calls:
+                    line += (f", {kind} p50 {percentile(calls, 50) * 1000:.0f} ms "
+                             f"p95 {percentile(calls, 95) * 1000:.0f} ms")
+            lines.append(line)
+        return "\n".join(lines)
@@ -0,0 +1,81 @@
+import asyncio
+
+
+class MicroBatcher:
+    '''
+    Collects items submitted within `window` seconds (up to `max_items`) and classifies them together.
+
+    `classify_batch(items)` must return one verdict per item, in order. If its response is malformed (it raises
+    ValueError, which includes JSONDecodeError) or has the wrong number of verdicts, each item of that batch is
+    retried on its own with `classify_one(item)`, so a bad batch response never loses a message. Any other
+    error, such as a failed request or a rate limit, is passed to every waiting caller instead: retrying each
+    item separately would only multiply the load on a backend that is already failing.
+    '''
+
+    def __init__(self, classify_batch, classify_one, window=0.05, max_items=8):
+        self.classify_batch = classify_batch
+        self.classify_one = classify_one
+        self.window = window
+        self.max_items = max_items
+        self.pending = []  # (item, future) waiting for the next flush
+        self.timer = None
+        self.batches = 0
+        self.batched_items = 0
+        self.fallbacks = 0
+
+    async def submit(self, item):
+        if self.max_items <= 1:
+            return await self.classify_one(item)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        items = [item for item, _ in batch]
+        verdicts = None
+        if len(items) > 1:
+            try:
+                verdicts = await self.classify_batch(items)
+            except ValueError:
+                verdicts = None
+            except Exception as e:
+                self.resolve(batch, [e] * len(items))
+                return
+            if verdicts is not None and len(verdicts) != len(items):
+                verdicts = None
+
+        if verdicts is None:
+            if len(items) > 1:
+                self.fallbacks += 1
+            verdicts = await asyncio.gather(*(self.classify_one(item) for item in items), return_exceptions=True)
+        else:
+            self.batches += 1
+            self.batched_items += len(items)
+        self.resolve(batch, verdicts)
+
+    def resolve(self, batch, verdicts):
+        for (_, future), verdict in zip(batch, verdicts):
+            if future.done():
+                continue
+            if isinstance(verdict, BaseException):
+                future.set_exception(verdict)
+            else:
+                future.set_result(verdict)
+
+    def stats(self):
+        average = self.batched_items / self.batches if self.batches else 0.0
+        return (f"Batching: {self.batches} batches, {average:.1f} messages per batch, "
+                f"{self.fallbacks} fell back to single calls")
@@ -0,0 +1,1059 @@
+'''
+Offline benchmarks for the moderation bot's hot paths.
+
+Run from this folder, e.g. `python bench.py storage --users 1000000`. Each subcommand prints its own numbers;
+none of them need Discord or API credentials.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+
+
+def report(name, count, elapsed):
+    print(f'{name:<32} {count:>10} ops  {elapsed:8.3f} s  {count / elapsed:12.0f} ops/s  '
+          f'{elapsed / count * 1e6:8.2f} us/op')
+
+
+def bench_storage(args):
+    from storage import OffenderStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = OffenderStore(os.path.join(tmp, 'bench.db'))
+
+        start = time.perf_counter()
+        batch = 100000
+        for offset in range(0, args.users, batch):
+            store.bulk_increment('violation', ((user_id, 1) for user_id in range(offset, min(offset + batch, args.users))))
+        report('bulk load', args.users, time.perf_counter() - start)
+
+        users = [random.randrange(args.users * 2) for _ in range(args.ops)]  # half of them are misses
+
+        start = time.perf_counter()
+        for user_id in users:
+            store.read('violation', user_id)
+        report('read', args.ops, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for user_id in users:
+            store.increment('violation', user_id, 1)
+        report('increment', args.ops, time.perf_counter() - start)
+
+        store.close()
+
+
+def bench_reports(args):
+    from report import Report, State
+    from review_queue import ReviewQueue
+    from storage import ReportStore
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = ReportStore(os.path.join(tmp, 'bench.db'))
+        start = time.perf_counter()
+        for i in range(args.reports):
+            pending = Report(None)
+            pending.state = State.AWAITING_REVIEW
+            pending.report_summary = ['Reported author:someone', f'Reported message:message {i}', 'Abuse type:Bullying']
+            pending.selected_abuse_type = 'Bullying'
+            pending.message_link = [1, 2, 1000 + i]
+            pending.poster_id = pending.reporter_id = i
+            store.save(pending.report_id, pending.to_dict())
+        report('save', args.reports, time.perf_counter() - start)
+        store.close()
+
+        # What ModBot.restore_reports does at startup, minus the offender lookups
+        start = time.perf_counter()
+        store = ReportStore(os.path.join(tmp, 'bench.db'))
+        queue = ReviewQueue()
+        for data in store.load_all():
+            restored = Report.from_dict(None, data)
+            queue.push(restored.report_id, abuse_type=restored.selected_abuse_type, enqueued_at=restored.created_at)
+        report('restore', args.reports, time.perf_counter() - start)
+        store.close()
+
+
+def bench_report_init(args):
+    from report import Report
+
+    start = time.perf_counter()
+    for _ in range(args.reports):
+        Report(None)
+    report('Report()', args.reports, time.perf_counter() - start)
+
+
+class SlowModel:
+    '''
+    Stand-in for a GenerativeModel whose synchronous generate_content takes `latency` seconds.
+    '''
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, parts, **kwargs):
+        time.sleep(self.latency)
+        return parts
+
+
+async def loop_lag(stop, interval=0.01):
+    '''
+    Sample how late a 10 ms timer fires while other work runs; this is what a DM handler would wait.
+    '''
+    import asyncio
+
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+    return lags
+
+
+def bench_generation(args):
+    import asyncio
+    from evaluation import percentile
+    from models import ModelRegistry
+
+    async def run(blocking):
+        registry = ModelRegistry(project=None, location=None, max_concurrency=args.concurrency,
+                                 max_workers=args.concurrency)
+        registry.models['stub'] = SlowModel(args.latency)
+        stop = asyncio.Event()
+        lag = asyncio.ensure_future(loop_lag(stop))
+        await asyncio.sleep(0.05)
+
+        start = time.perf_counter()
+        if blocking:
+            for _ in range(args.reports):
+                registry.models['stub'].generate_content([])  # what the old code did inside the coroutine
+                await asyncio.sleep(0)
+        else:
+            await asyncio.gather(*(registry.generate('stub', []) for _ in range(args.reports)))
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        lags = await lag
+        registry.close()
+        print(f'{"blocking" if blocking else "async":<10} {args.reports} generations in {elapsed:6.2f} s, '
+              f'loop lag p50 {percentile(lags, 50) * 1000:7.1f} ms, p99 {percentile(lags, 99) * 1000:7.1f} ms, '
+              f'max {max(lags) * 1000:7.1f} ms')
+
+    asyncio.run(run(blocking=True))
+    asyncio.run(run(blocking=False))
+
+
+def bench_batching(args):
+    import asyncio
+    from batcher import MicroBatcher
+
+    def tokens(text):
+        return len(text) // 4 + 1  # rough estimate, good enough to compare the two paths
+
+    async def run(batch_size):
+        usage = {'requests': 0, 'tokens': 0}
+
+        async def classify_one(text):
+            usage['requests'] += 1
+            usage['tokens'] += args.policy_tokens + args.instruction_tokens + tokens(text) + 1
+            await asyncio.sleep(args.latency)
+            return text, 'no'
+
+        async def classify_batch(texts):
+            usage['requests'] += 1
+            usage['tokens'] += args.policy_tokens + args.instruction_tokens + sum(tokens(t) + 3 for t in texts)
+            usage['tokens'] += 2 * len(texts)  # '"no",' per item in the JSON answer
+            await asyncio.sleep(args.latency + args.per_item_latency * len(texts))
+            return [(text, 'no') for text in texts]
+
+        batcher = MicroBatcher(classify_batch, classify_one, window=args.window, max_items=batch_size)
+        messages = [f'synthetic channel message number {i} with a few words' for i in range(args.messages)]
+        semaphore = asyncio.Semaphore(args.concurrency)  # the classifier client's request cap
+
+        async def submit(text):
+            await asyncio.sleep(random.uniform(0, args.burst))  # every message lands within one burst
+            if batch_size > 1:
+                return await batcher.submit(text)
+            async with semaphore:
+                return await classify_one(text)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(submit(text) for text in messages))
+        elapsed = time.perf_counter() - start
+        print(f'batch size {batch_size:>3}: {usage["requests"]:5} requests, '
+              f'{usage["tokens"] / args.messages:7.1f} tokens/message, {args.messages / elapsed:8.1f} messages/s')
+
+    asyncio.run(run(1))
+    asyncio.run(run(args.batch_size))
+
+
+async def mock_openai(port, first_token, per_token, answer_tokens):
+    '''
+    Local stand-in for the chat completions endpoint: the first token arrives after `first_token` seconds and
+    each further one `per_token` seconds later, streamed as SSE or returned whole. Returns the aiohttp runner.
+    '''
+    import asyncio
+    import json
+    from aiohttp import web
+
+    def logprobs(token):
+        alternatives = [{'token': 'Yes', 'logprob': -0.05, 'bytes': None}, {'token': 'No', 'logprob': -3.0, 'bytes': None}]
+        return {'content': [{'token': token, 'logprob': -0.05, 'bytes': None, 'top_logprobs': alternatives}]}
+
+    async def completions(request):
+        body = await request.json()
+        count = min(answer_tokens, body.get('max_tokens') or answer_tokens)
+        tokens = ['Yes', ','] + [' word'] * (count - 2)
+        base = {'id': 'mock', 'created': 0, 'model': body['model']}
+        if not body.get('stream'):
+            await asyncio.sleep(first_token + per_token * (count - 1))
+            return web.json_response({**base, 'object': 'chat.completion', 'choices': [
+                {'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': 'stop'}]})
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        try:
+            for i, token in enumerate(tokens):
+                await asyncio.sleep(first_token if i == 0 else per_token)
+                choice = {'index': 0, 'delta': {'content': token}, 'finish_reason': None}
+                if body.get('logprobs'):
+                    choice['logprobs'] = logprobs(token)
+                chunk = {**base, 'object': 'chat.completion.chunk', 'choices': [choice]}
+                await response.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await response.write(b'data: [DONE]\n\n')
+        except ConnectionResetError:
+            counts['closed_early'] += 1  # the client hung up once it had its verdict
+        return response
+
+    counts = {'closed_early': 0}
+    app = web.Application()
+    app['counts'] = counts
+    app.router.add_post('/v1/chat/completions', completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+def bench_streaming(args):
+    import asyncio
+    from classifier import Classifier, label_from_text
+    from evaluation import percentile
+
+    messages = [{'role': 'user', 'content': 'Is this a violation? Please answer with only a yes or no'}]
+
+    async def run():
+        runner = await mock_openai(args.port, args.first_token, args.per_token, args.answer_tokens)
+        classifier = Classifier(api_key='sk-bench', base_url=f'http://127.0.0.1:{args.port}/v1',
+                                max_concurrency=args.concurrency)
+
+        async def full():
+            response = await classifier.create(messages, max_tokens=300)
+            return label_from_text(response.choices[0].message.content), None
+
+        async def streamed():
+            return await classifier.stream_verdict(messages)
+
+        for name, call in (('full completion', full), ('streamed verdict', streamed)):
+            latencies = []
+
+            async def timed():
+                start = time.perf_counter()
+                verdict = await call()
+                latencies.append(time.perf_counter() - start)
+                return verdict
+
+            start = time.perf_counter()
+            verdicts = await asyncio.gather(*(timed() for _ in range(args.requests)))
+            elapsed = time.perf_counter() - start
+            print(f'{name:<18} {args.requests} requests in {elapsed:6.2f} s, '
+                  f'p50 {percentile(latencies, 50) * 1000:7.1f} ms, p95 {percentile(latencies, 95) * 1000:7.1f} ms, '
+                  f'verdict {verdicts[0]}')
+
+        await asyncio.sleep(0.1)
+        print(f'streams closed early: {runner.app["counts"]["closed_early"]}/{args.requests}')
+        await classifier.close()
+        await runner.cleanup()
+
+    asyncio.run(run())
+
+
+def raid_script(args):
+    '''
+    A synthetic raid: `raiders` accounts posting a handful of canned lines `raid_rate` times a second while
+    `users` regular members chat every 20 seconds or so, all in one channel.
+    '''
+    events = []
+    lines = ['get raided', 'this server is trash', 'LOL LOL LOL', 'join our server instead']
+    for raider in range(args.raiders):
+        t = random.uniform(0, 1)
+        while t < args.duration:
+            events.append({'t': t, 'author': f'raider{raider}', 'channel': 1, 'text': random.choice(lines)})
+            t += random.expovariate(args.raid_rate)
+    for user in range(args.users):
+        t = random.uniform(0, 20)
+        while t < args.duration:
+            events.append({'t': t, 'author': f'user{user}', 'channel': 1, 'text': f'message {t:.3f} from user {user}'})
+            t += random.expovariate(1 / 20)
+    return sorted(events, key=lambda event: event['t'])
+
+
+def bench_raid(args):
+    import heapq
+    import json
+    from collections import Counter
+    from ratelimit import RateLimiter
+
+    if args.script:
+        with open(args.script, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = raid_script(args)
+
+    now = [0.0]
+    limiter = RateLimiter(max_workers=args.workers, max_pending=args.queue_size, shed_policy=args.shed_policy,
+                          clock=lambda: now[0])
+    workers = [0.0] * args.workers  # when each simulated worker is next free
+    finishing = []  # finish times of admitted, unfinished messages
+    llm_calls = 0
+    posts_per_minute = Counter()
+    processed_users = total_users = 0
+
+    start = time.perf_counter()
+    for event in events:
+        now[0] = event['t']
+        while finishing and finishing[0] <= now[0]:
+            heapq.heappop(finishing)
+        limiter.pending = len(finishing)
+        decision = limiter.admit(event['author'], event['channel'], event['text'])
+        if decision == 'process':
+            begin = max(now[0], heapq.heappop(workers))
+            heapq.heappush(workers, begin + args.latency)
+            heapq.heappush(finishing, begin + args.latency)
+            llm_calls += 1
+            posts_per_minute[int(now[0] // 60)] += 2  # the forwarded message and the verdict
+        if event['author'].startswith('user'):
+            total_users += 1
+            processed_users += decision == 'process'
+    elapsed = time.perf_counter() - start
+
+    minutes = max(1.0, events[-1]['t'] / 60) if events else 1.0
+    print(f'{len(events)} messages over {minutes:.1f} min, admission took {elapsed / max(1, len(events)) * 1e6:.1f} us/message')
+    print(f'without limits: {len(events)} LLM calls, {2 * len(events)} mod-channel posts')
+    print(f'with limits:    {llm_calls} LLM calls, {sum(posts_per_minute.values())} mod-channel posts, '
+          f'busiest minute {max(posts_per_minute.values(), default=0)} posts')
+    print(f'regular members processed: {processed_users}/{total_users}')
+    print(limiter.stats())
+
+
+class FakeRateLimited(Exception):
+    status = 429
+
+    def __init__(self, retry_after):
+        super().__init__('429 Too Many Requests')
+        self.response = type('Response', (), {'headers': {'Retry-After': str(retry_after)}})()
+
+
+class FakeChannel:
+    '''
+    Stand-in for a Discord channel: each send takes `latency` seconds, and more than `limit` sends per `per`
+    seconds get a 429 with a Retry-After header, like Discord's per-channel message limit.
+    '''
+
+    def __init__(self, channel_id, latency=0.05, limit=5, per=5.0):
+        self.id = channel_id
+        self.latency = latency
+        self.limit = limit
+        self.per = per
+        self.sent = []
+        self.calls = 0
+        self.window = []
+
+    async def send(self, content):
+        import asyncio
+
+        self.calls += 1
+        now = time.perf_counter()
+        self.window = [t for t in self.window if now - t < self.per]
+        if len(self.window) >= self.limit:
+            raise FakeRateLimited(self.window[0] + self.per - now)
+        self.window.append(now)
+        await asyncio.sleep(self.latency)
+        assert len(content) <= 2000
+        self.sent.append(content)
+
+
+def bench_outbox(args):
+    import asyncio
+    from evaluation import percentile
+    from outbox import Outbox
+
+    def event_lines(i):
+        lines = [f'Forwarded message:\nraider: "flagged message number {i}"']
+        lines += [f'Forwarded image:\nraider: https://cdn.example/{i}/{n}.png' for n in range(args.images)]
+        return lines + [f"Evaluated: 'flagged message number {i}' as a violation (policy full@00000000)"]
+
+    async def run(coalesce):
+        channel = FakeChannel(1, latency=args.latency, limit=args.limit, per=args.per)
+        outbox = Outbox(flush_interval=args.flush_interval)
+        bucket = asyncio.Lock()
+        latencies = []
+
+        async def event(i):
+            await asyncio.sleep(i / args.rate)
+            start = time.perf_counter()
+            if coalesce:
+                await outbox.send(channel, *event_lines(i))
+            else:
+                for line in event_lines(i):  # one awaited send per line, as the bot used to do
+                    async with bucket:  # discord.py queues requests to one rate limit bucket
+                        await outbox._send(channel, line)
+            latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(event(i) for i in range(args.messages)))
+        print(f'{"coalesced" if coalesce else "one per line":<13} {channel.calls / args.messages:5.2f} API calls '
+              f'per flagged message ({outbox.rate_limited} were 429s), {len(channel.sent)} posts, '
+              f'latency p50 {percentile(latencies, 50):6.2f} s, p95 {percentile(latencies, 95):6.2f} s')
+
+    asyncio.run(run(False))
+    asyncio.run(run(True))
+
+
+def bench_routing(args):
+    from types import SimpleNamespace
+    from routing import ModChannelIndex
+
+    name = 'group-5-mod'
+    guilds = []
+    for guild_id in range(args.guilds):
+        guild = SimpleNamespace(id=guild_id, text_channels=[])
+        for n in range(args.channels):
+            # The mod channel sits at a random position, as it would in real servers
+            guild.text_channels.append(SimpleNamespace(id=guild_id * 10000 + n, name=f'channel-{n}', guild=guild))
+        guild.text_channels[random.randrange(args.channels)].name = name
+        guilds.append(guild)
+
+    start = time.perf_counter()
+    scanned = {}
+    for guild in guilds:  # what on_ready used to do
+        for channel in guild.text_channels:
+            if channel.name == name:
+                scanned[guild.id] = channel
+    report('full scan', args.guilds, time.perf_counter() - start)
+
+    index = ModChannelIndex(name)
+    start = time.perf_counter()
+    index.build(guilds)
+    report('index build', args.guilds, time.perf_counter() - start)
+    assert index == scanned
+
+    # Incremental updates: create, rename and delete one channel per guild
+    start = time.perf_counter()
+    for guild in guilds:
+        extra = SimpleNamespace(id=guild.id * 10000 + args.channels, name='new-channel', guild=guild)
+        guild.text_channels.append(extra)
+        index.channel_created(extra)
+        renamed = SimpleNamespace(id=extra.id, name='renamed', guild=guild)
+        index.channel_updated(extra, renamed)
+        guild.text_channels.remove(extra)
+        index.channel_deleted(renamed)
+    report('channel events', args.guilds * 3, time.perf_counter() - start)
+
+    reports = [SimpleNamespace(message_link=[random.randrange(args.guilds), 0, 0]) for _ in range(args.lookups)]
+    start = time.perf_counter()
+    routed = [index.for_report(r) for r in reports]
+    report('route report', args.lookups, time.perf_counter() - start)
+    assert all(channel.guild.id == r.message_link[0] for channel, r in zip(routed, reports))
+
+
+def bench_messages(args):
+    import asyncio
+    from types import SimpleNamespace
+    from message_cache import MessageCache
+
+    class Channel:
+        def __init__(self):
+            self.id = 1
+            self.fetches = 0
+
+        async def fetch_message(self, message_id):
+            self.fetches += 1
+            await asyncio.sleep(args.latency)
+            return SimpleNamespace(id=message_id, channel=self)
+
+    # Replies and reports pile onto a few popular posts: post i is looked up with weight 1 / (i + 1)
+    weights = [1 / (i + 1) for i in range(args.posts)]
+    lookups = random.choices(range(args.posts), weights, k=args.lookups)
+
+    async def run(cached):
+        channel = Channel()
+        cache = MessageCache(max_messages=args.cache_size)
+        if cached:
+            for post in random.sample(range(args.posts), int(args.posts * args.seen)):
+                cache.add(SimpleNamespace(id=post, channel=channel))  # posts the bot saw in on_message
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def lookup(post):
+            async with semaphore:
+                if cached:
+                    return await cache.fetch(channel, post)
+                return await channel.fetch_message(post)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(lookup(post) for post in lookups))
+        elapsed = time.perf_counter() - start
+        print(f'{"cached" if cached else "uncached":<9} {channel.fetches:6} fetch_message calls for {args.lookups} '
+              f'lookups in {elapsed:6.2f} s')
+        if cached:
+            print(cache.stats())
+
+    asyncio.run(run(False))
+    asyncio.run(run(True))
+
+
+def serve_mock_openai(port, first_token, per_token, answer_tokens):
+    import asyncio
+
+    async def serve():
+        await mock_openai(port, first_token, per_token, answer_tokens)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def fake_gateway_shard(index, args, pool_queues, ready, go, done):
+    '''
+    One bot process fed channel traffic from replay.py's fake guild instead of the Discord gateway, and
+    classifying through the worker pool's queues, or in-process when `pool_queues` is None.
+    '''
+    import asyncio
+    import contextlib
+    from types import SimpleNamespace
+    import replay
+    from classifier import Classifier
+    from evaluation import percentile
+    from workers import PoolClassifier
+
+    random.seed(index)
+    options = SimpleNamespace(messages=args.messages // args.processes, authors=50, rate=0, image_ratio=0.1,
+                              reply_ratio=0.05, violation_ratio=0.1, concurrency=args.concurrency, rate_limits=False,
+                              discord_latency=0.01, llm_latency=0, vertex_latency=0, cdn_latency=0.01, sigma=0.5,
+                              group=5)
+
+    async def run():
+        harness = replay.Harness(options)
+        bot = replay.make_bot(harness, options)
+        bot.batcher.max_items = 1  # the mock endpoint answers one message per request
+        if pool_queues is None:
+            bot.classifier = Classifier(api_key='sk-bench', base_url=f'http://127.0.0.1:{args.port}/v1',
+                                        max_concurrency=args.worker_concurrency)
+        else:
+            bot.classifier = PoolClassifier(*pool_queues, client=index)
+        stream = replay.channel_stream(harness, options)
+        ready.put(index)
+        await asyncio.get_running_loop().run_in_executor(None, go.wait)
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            latencies = await replay.replay(bot, stream)
+        done.put((len(latencies), time.perf_counter() - start, percentile(latencies, 50), percentile(latencies, 95)))
+        await bot.classifier.close()
+        bot.report_store.close()
+
+    asyncio.run(run())
+
+
+def bench_shards(args):
+    import multiprocessing
+    import socket
+    from workers import WorkerPool
+
+    context = multiprocessing.get_context('spawn')
+    os.chdir(tempfile.mkdtemp())  # the bots' SQLite files; children inherit the working directory
+    server = context.Process(target=serve_mock_openai, args=(args.port, args.first_token, 0.01, 5), daemon=True)
+    server.start()
+    while True:
+        with socket.socket() as probe:
+            if probe.connect_ex(('127.0.0.1', args.port)) == 0:
+                break
+        time.sleep(0.05)
+
+    print(f'{args.processes} bot processes, {args.messages} channel messages, '
+          f'{args.worker_concurrency} LLM requests in flight per classifier')
+    for workers in args.workers:
+        pool = None
+        if workers:
+            pool = WorkerPool(workers, clients=args.processes, api_key='sk-bench',
+                              base_url=f'http://127.0.0.1:{args.port}/v1', max_concurrency=args.worker_concurrency)
+            pool.start()
+        ready, go, done = context.Queue(), context.Event(), context.Queue()
+        shards = [context.Process(target=fake_gateway_shard,
+                                  args=(i, args, pool and (pool.jobs, pool.results[i]), ready, go, done))
+                  for i in range(args.processes)]
+        for shard in shards:
+            shard.start()
+        for _ in shards:
+            ready.get()
+        start = time.perf_counter()
+        go.set()
+        results = [done.get() for _ in shards]
+        elapsed = time.perf_counter() - start
+        for shard in shards:
+            shard.join()
+        if pool is not None:
+            pool.close()
+
+        total = sum(count for count, *_ in results)
+        name = f'{workers} worker processes' if workers else 'in-process classifier'
+        print(f'{name:<22} {total} messages in {elapsed:6.2f} s, {total / elapsed:7.1f} messages/s, '
+              f'p50 {max(r[2] for r in results) * 1000:7.1f} ms, p95 {max(r[3] for r in results) * 1000:7.1f} ms')
+    server.terminate()
+
+
+def synthetic_image(rng, width=640, height=480):
+    from PIL import Image, ImageDraw
+
+    image = Image.new('RGB', (width, height), tuple(int(c) for c in rng.integers(0, 256, 3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = x0 + rng.integers(40, width // 2), y0 + rng.integers(40, height // 2)
+        shape = draw.ellipse if rng.random() < 0.5 else draw.rectangle
+        shape([int(x0), int(y0), int(x1), int(y1)], fill=tuple(int(c) for c in rng.integers(0, 256, 3)))
+    return image
+
+
+def repost(image, rng):
+    '''
+    A crop of up to 5% per side, a rescale and a lossy recompression of `image`, as JPEG bytes.
+    '''
+    import io
+    width, height = image.size
+    box = [int(rng.uniform(0, 0.05) * width), int(rng.uniform(0, 0.05) * height),
+           width - int(rng.uniform(0, 0.05) * width), height - int(rng.uniform(0, 0.05) * height)]
+    scale = rng.uniform(0.5, 1.5)
+    image = image.crop(box).resize((int((box[2] - box[0]) * scale), int((box[3] - box[1]) * scale)))
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=int(rng.integers(30, 90)))
+    return out.getvalue()
+
+
+def bench_phash(args):
+    import io
+    import numpy as np
+    from evaluation import percentile
+    from phash import HashIndex, dhash
+
+    rng = np.random.default_rng(args.seed)
+    images = [synthetic_image(rng) for _ in range(args.images)]
+    originals = []
+    for image in images:
+        out = io.BytesIO()
+        image.save(out, 'PNG')
+        originals.append(out.getvalue())
+    reposts = [repost(image, rng) for image in images]
+    unseen = []
+    for _ in range(args.images):
+        out = io.BytesIO()
+        synthetic_image(rng).save(out, 'JPEG')
+        unseen.append(dhash(out.getvalue()))
+
+    start = time.perf_counter()
+    original_hashes = [dhash(data) for data in originals]
+    report('dhash (640x480 PNG)', len(originals), time.perf_counter() - start)
+    start = time.perf_counter()
+    repost_hashes = [dhash(data) for data in reposts]
+    report('dhash (JPEG repost)', len(reposts), time.perf_counter() - start)
+
+    distances = [(a ^ b).bit_count() for a, b in zip(original_hashes, repost_hashes)]
+    unrelated = [(original_hashes[i] ^ original_hashes[j]).bit_count()
+                 for i in range(len(images)) for j in range(i + 1, len(images))]
+    print(f'repost distance p50 {percentile(distances, 50):.0f}, p95 {percentile(distances, 95):.0f} bits; '
+          f'unrelated images p1 {percentile(unrelated, 1):.0f} bits')
+
+    stored = rng.integers(0, 2 ** 64 - 1, args.hashes - len(images), dtype=np.uint64, endpoint=True)
+    stored = np.concatenate([stored, np.array(original_hashes, dtype=np.uint64)])
+    start = time.perf_counter()
+    index = HashIndex(max_distance=args.max_distance)
+    index.extend(stored.tolist())
+    elapsed = time.perf_counter() - start
+    size = index.hashes.nbytes + sum(values.nbytes + order.nbytes for values, order in index.sorted)
+    print(f'index of {len(index)} hashes built in {elapsed:.2f} s, {size / 2 ** 20:.0f} MiB')
+
+    def linear(value):
+        found = np.bitwise_count(stored ^ np.uint64(value))
+        i = int(np.argmin(found))
+        return (int(found[i]), int(stored[i])) if found[i] <= args.max_distance else None
+
+    for name, lookup in (('linear scan', linear), ('multi-index', index.nearest)):
+        latencies = []
+        found = 0
+        for original, value in zip(original_hashes, repost_hashes):
+            start = time.perf_counter()
+            match = lookup(value)
+            latencies.append(time.perf_counter() - start)
+            found += match is not None and match[1] == original
+        false_matches = sum(lookup(value) is not None for value in unseen)
+        print(f'{name:<12} recall {found}/{len(reposts)} reposts, {false_matches}/{args.images} unseen images '
+              f'matched, p50 {percentile(latencies, 50) * 1000:.2f} ms, p99 {percentile(latencies, 99) * 1000:.2f} ms')
+
+
+PILE_ON_LINES = [
+    'you are such a worthless loser and everyone in this server knows it',
+    'nobody wants you here, go back to whatever trash server you came from',
+    'look at this ugly idiot trying to play ranked again',
+]
+
+
+def pile_on_variant(text, target):
+    '''
+    The kind of edits a pile-on makes to one insult: text speak, a dropped word, shouting, emphasis, a mention.
+    '''
+    words = text.split()
+    words = [{'you': 'u', 'are': 'r', 'your': 'ur'}.get(w, w) if random.random() < 0.5 else w for w in words]
+    if random.random() < 0.3:
+        del words[random.randrange(len(words))]
+    text = ' '.join(words)
+    if random.random() < 0.3:
+        text = text.upper()
+    text += random.choice(['', '!!!', ' lol', ' 😂', '...'])
+    return f'@{target} {text}' if random.random() < 0.5 else text
+
+
+def bench_minhash(args):
+    import asyncio
+    import contextlib
+    from types import SimpleNamespace
+    import replay
+    from minhash import MinHashIndex
+
+    words = [''.join(random.choices('abcdefghijklmnopqrstuvwxyz', k=random.randint(2, 8))) for _ in range(5000)]
+    texts = [' '.join(random.choices(words, k=random.randint(4, 15))) for _ in range(args.entries)]
+    index = MinHashIndex(max_entries=args.entries)
+    start = time.perf_counter()
+    signatures = [index.signature(text) for text in texts]
+    report('signature', len(texts), time.perf_counter() - start)
+    start = time.perf_counter()
+    for i, signature in enumerate(signatures):
+        index.add(signature, i)
+    report('add', len(texts), time.perf_counter() - start)
+    start = time.perf_counter()
+    found = sum(index.query(signature) == i for i, signature in enumerate(signatures))
+    report(f'query ({len(index)} entries)', len(texts), time.perf_counter() - start)
+    print(f'found {found}/{len(texts)} stored messages again')
+
+    # A pile-on: raiders post variants of a few insults in between ordinary chatter, all in one channel
+    options = SimpleNamespace(messages=args.chatter, authors=50, rate=0, image_ratio=0, reply_ratio=0,
+                              violation_ratio=0.1, concurrency=64, rate_limits=False, discord_latency=0.01,
+                              llm_latency=0.3, vertex_latency=0, cdn_latency=0, sigma=0.5, group=5)
+
+    async def run(collapse):
+        random.seed(args.seed)
+        harness = replay.Harness(options)
+        stream = replay.channel_stream(harness, options)
+        for i in range(args.raiders * args.posts):
+            author = harness.user(10000 + i % args.raiders)
+            content = pile_on_variant(random.choice(PILE_ON_LINES), 'user100')
+            stream.append((random.uniform(0, args.duration), harness.message(author, content, harness.channel)))
+        stream = [(random.uniform(0, args.duration), message) for _, message in stream]
+        stream.sort(key=lambda item: item[0])
+
+        bot = replay.make_bot(harness, options)
+        if not collapse:
+            bot.near_duplicates.threshold = 1.1  # nothing is ever similar enough
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            await replay.replay(bot, stream)
+            await asyncio.sleep(bot.duplicate_summary_delay + 0.5)  # let the last summaries go out
+        bot.report_store.close()
+        flagged = sum(1 for report in bot.reports.values() if report.classifier_verdict == 'yes')
+        print(f'{"with" if collapse else "without"} near-duplicate collapsing: {len(stream)} messages, '
+              f'{harness.calls["llm request"]} LLM requests, {bot.outbox.lines_sent} mod-channel lines in '
+              f'{harness.calls["discord send"]} posts, {flagged} authors flagged, '
+              f'{bot.near_duplicates.matches} near-duplicates')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        asyncio.run(run(False))
+        asyncio.run(run(True))
+
+
+def simulated_backend(name, median, sigma=0.3, spike_rate=0.0, spike_factor=20.0, error_rate=0.0, outage=None,
+                      fallback=False):
+    '''
+    A ClassifierBackend answering after a log-normal delay, with a `spike_rate` fraction of answers
+    `spike_factor` times slower, a `error_rate` fraction of errors and, within the `outage` (start, end) window
+    of loop time, nothing but errors.
+    '''
+    import asyncio
+    import math
+    from backends import ClassifierBackend
+
+    class SimulatedBackend(ClassifierBackend):
+        calls = 0
+
+        async def verdict(self, messages, logprobs=True):
+            self.calls += 1
+            now = asyncio.get_running_loop().time()
+            if outage and outage[0] <= now < outage[1] or random.random() < error_rate:
+                await asyncio.sleep(median / 5)
+                raise ConnectionError(f'{name} is unavailable')
+            delay = median * math.exp(random.gauss(0, sigma))
+            if random.random() < spike_rate:
+                delay *= spike_factor
+            await asyncio.sleep(delay)
+            return 'no', None
+
+    backend = SimulatedBackend()
+    backend.name = backend.model = name
+    backend.fallback = fallback
+    return backend
+
+
+def bench_backends(args):
+    import asyncio
+    from backends import ClassifierRouter
+    from evaluation import percentile
+
+    messages = [{'role': 'user', 'content': 'Is this a violation? Please answer with only a yes or no'}]
+    duration = args.requests / args.rate
+
+    async def run(name, hedge_quantile, single):
+        random.seed(args.seed)
+        start = asyncio.get_running_loop().time()
+        outage = (start + duration * 0.4, start + duration * 0.6)
+        backends = [simulated_backend('primary', args.median, spike_rate=args.spike_rate, error_rate=args.error_rate,
+                                      outage=outage),
+                    simulated_backend('secondary', args.median * 1.5, spike_rate=args.spike_rate / 2),
+                    simulated_backend('local', 0.001, fallback=True)]
+        router = ClassifierRouter(backends[:1] if single else backends, hedge_quantile=hedge_quantile,
+                                  hedge_delay=args.median * 4, timeout=args.timeout,
+                                  breaker_failures=5, breaker_reset=1.0)
+        latencies = []
+        errors = 0
+
+        async def request(delay):
+            nonlocal errors
+            await asyncio.sleep(delay)
+            begin = time.perf_counter()
+            try:
+                await router.stream_verdict(messages)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - begin)
+
+        arrivals, t = [], 0.0
+        for _ in range(args.requests):
+            arrivals.append(t)
+            t += random.expovariate(args.rate)
+        await asyncio.gather(*(request(t) for t in arrivals))
+        calls = ', '.join(f'{backend.name} {backend.calls}' for backend in backends if backend.calls)
+        print(f'{name:<28} p50 {percentile(latencies, 50) * 1000:6.0f} ms  p95 {percentile(latencies, 95) * 1000:6.0f} ms  '
+              f'p99 {percentile(latencies, 99) * 1000:6.0f} ms  max {max(latencies) * 1000:6.0f} ms  '
+              f'{errors:4} errors  calls: {calls}')
+
+    print(f'{args.requests} requests at {args.rate:.0f}/s; the primary errors throughout the middle fifth of the run')
+    asyncio.run(run('primary only', None, True))
+    asyncio.run(run('failover + breakers', None, False))
+    asyncio.run(run('failover + breakers + hedge', args.hedge_quantile, False))
+
+
+FIRST_MESSAGE = '''
+import time
+start = time.perf_counter()
+import asyncio, contextlib, os
+from types import SimpleNamespace
+import replay
+
+options = SimpleNamespace(concurrency=64, rate_limits=False, discord_latency=0, llm_latency=0, vertex_latency=0,
+                          cdn_latency=0, sigma=0.5, group=5)
+
+async def run():
+    harness = replay.Harness(options)
+    bot = replay.make_bot(harness, options)
+    message = harness.message(harness.user(100), 'you are a worthless idiot', harness.channel)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        await bot.on_message(message)
+        while not harness.calls['discord send']:
+            await asyncio.sleep(0.001)
+    bot.report_store.close()
+
+asyncio.run(run())
+print(time.perf_counter() - start)
+'''
+
+
+def import_times(statement):
+    '''
+    (depth, module, cumulative seconds) for every module `statement` imports, from `python -X importtime`.
+    '''
+    import subprocess
+    import sys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=here,
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((depth, name.strip(), int(cumulative) / 1e6))
+    return times
+
+
+def bench_startup(args):
+    import statistics
+    import subprocess
+    import sys
+
+    times = import_times('import bot')
+    print(f'import bot: {times[-1][2]:.3f} s')
+    for depth, name, cumulative in sorted((t for t in times if t[0] == 1), key=lambda t: -t[2])[:args.top]:
+        print(f'  {name:<30} {cumulative:8.3f} s')
+    for module in args.deferred:
+        print(f'deferred: import {module:<27} {import_times(f"import {module}")[-1][2]:8.3f} s')
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    elapsed = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PYTHONPATH=here)
+        for _ in range(args.runs):
+            result = subprocess.run([sys.executable, '-c', FIRST_MESSAGE], cwd=tmp, env=env,
+                                    capture_output=True, text=True, check=True)
+            elapsed.append(float(result.stdout.split()[-1]))
+    print(f'process start to first flagged message: median {statistics.median(elapsed):.3f} s, '
+          f'min {min(elapsed):.3f} s over {args.runs} runs')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    storage = commands.add_parser('storage', help='offender counter store reads and increments')
+    storage.add_argument('--users', type=int, default=1000000)
+    storage.add_argument('--ops', type=int, default=20000)
+    storage.set_defaults(run=bench_storage)
+
+    reports = commands.add_parser('reports', help='persisting open reports and restoring them at startup')
+    reports.add_argument('--reports', type=int, default=10000)
+    reports.set_defaults(run=bench_reports)
+
+    report_init = commands.add_parser('report-init', help='constructing a Report')
+    report_init.add_argument('--reports', type=int, default=100000)
+    report_init.set_defaults(run=bench_report_init)
+
+    generation = commands.add_parser('generation', help='event loop responsiveness during concurrent Gemini calls')
+    generation.add_argument('--reports', type=int, default=50)
+    generation.add_argument('--latency', type=float, default=0.2)
+    generation.add_argument('--concurrency', type=int, default=8)
+    generation.set_defaults(run=bench_generation)
+
+    batching = commands.add_parser('batching', help='tokens and throughput of micro-batched classification')
+    batching.add_argument('--messages', type=int, default=500)
+    batching.add_argument('--burst', type=float, default=2.0, help='seconds over which the messages arrive')
+    batching.add_argument('--batch-size', type=int, default=8)
+    batching.add_argument('--window', type=float, default=0.05)
+    batching.add_argument('--concurrency', type=int, default=8)
+    batching.add_argument('--latency', type=float, default=0.5)
+    batching.add_argument('--per-item-latency', type=float, default=0.02)
+    batching.add_argument('--policy-tokens', type=int, default=600)
+    batching.add_argument('--instruction-tokens', type=int, default=40)
+    batching.set_defaults(run=bench_batching)
+
+    streaming = commands.add_parser('streaming', help='full completions vs streamed first-word verdicts')
+    streaming.add_argument('--requests', type=int, default=100)
+    streaming.add_argument('--concurrency', type=int, default=8)
+    streaming.add_argument('--first-token', type=float, default=0.2, help='seconds to the first token')
+    streaming.add_argument('--per-token', type=float, default=0.01, help='seconds per further token')
+    streaming.add_argument('--answer-tokens', type=int, default=60, help='tokens the mock model wants to say')
+    streaming.add_argument('--port', type=int, default=8765)
+    streaming.set_defaults(run=bench_streaming)
+
+    raid = commands.add_parser('raid', help='API calls and mod-channel posts during a replayed raid')
+    raid.add_argument('--script', help='JSONL of {"t", "author", "channel", "text"} events to replay instead')
+    raid.add_argument('--raiders', type=int, default=50)
+    raid.add_argument('--raid-rate', type=float, default=2.0, help='messages per second per raider')
+    raid.add_argument('--users', type=int, default=20)
+    raid.add_argument('--duration', type=float, default=300.0)
+    raid.add_argument('--workers', type=int, default=8)
+    raid.add_argument('--queue-size', type=int, default=64)
+    raid.add_argument('--latency', type=float, default=0.8, help='seconds to forward and classify one message')
+    raid.add_argument('--shed-policy', default='cheap', choices=['cheap', 'sample', 'drop'])
+    raid.set_defaults(run=bench_raid)
+
+    outbox = commands.add_parser('outbox', help='mod-channel API calls and latency with and without coalescing')
+    outbox.add_argument('--messages', type=int, default=30)
+    outbox.add_argument('--rate', type=float, default=2.0, help='flagged messages per second')
+    outbox.add_argument('--images', type=int, default=1)
+    outbox.add_argument('--latency', type=float, default=0.05)
+    outbox.add_argument('--limit', type=int, default=5, help='sends allowed per window')
+    outbox.add_argument('--per', type=float, default=5.0, help='rate limit window in seconds')
+    outbox.add_argument('--flush-interval', type=float, default=0.1)
+    outbox.set_defaults(run=bench_outbox)
+
+    routing = commands.add_parser('routing', help='building and updating the guild to mod channel index')
+    routing.add_argument('--guilds', type=int, default=1000)
+    routing.add_argument('--channels', type=int, default=50, help='text channels per guild')
+    routing.add_argument('--lookups', type=int, default=100000)
+    routing.set_defaults(run=bench_routing)
+
+    messages = commands.add_parser('messages', help='fetch_message calls saved by the message cache')
+    messages.add_argument('--posts', type=int, default=5000)
+    messages.add_argument('--lookups', type=int, default=20000)
+    messages.add_argument('--seen', type=float, default=0.5, help='fraction of posts the bot saw arrive')
+    messages.add_argument('--cache-size', type=int, default=10000)
+    messages.add_argument('--concurrency', type=int, default=50)
+    messages.add_argument('--latency', type=float, default=0.05)
+    messages.set_defaults(run=bench_messages)
+
+    shards = commands.add_parser('shards', help='fake-gateway throughput against the number of classifier workers')
+    shards.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='worker pool sizes to try; 0 classifies inside each bot process')
+    shards.add_argument('--processes', type=int, default=2, help='bot processes')
+    shards.add_argument('--messages', type=int, default=2000)
+    shards.add_argument('--concurrency', type=int, default=64, help='channel messages processed at once per bot')
+    shards.add_argument('--worker-concurrency', type=int, default=8)
+    shards.add_argument('--first-token', type=float, default=0.2)
+    shards.add_argument('--port', type=int, default=8766)
+    shards.set_defaults(run=bench_shards)
+
+    phash = commands.add_parser('phash', help='known-image lookup latency and recall against stored hashes')
+    phash.add_argument('--hashes', type=int, default=1000000)
+    phash.add_argument('--images', type=int, default=200, help='synthetic images reposted with crops and JPEG')
+    phash.add_argument('--max-distance', type=int, default=10)
+    phash.add_argument('--seed', type=int, default=0)
+    phash.set_defaults(run=bench_phash)
+
+    minhash = commands.add_parser('minhash', help='near-duplicate index cost and LLM calls saved in a pile-on')
+    minhash.add_argument('--entries', type=int, default=10000)
+    minhash.add_argument('--chatter', type=int, default=500, help='ordinary channel messages')
+    minhash.add_argument('--raiders', type=int, default=100)
+    minhash.add_argument('--posts', type=int, default=5, help='insults per raider')
+    minhash.add_argument('--duration', type=float, default=30.0, help='seconds the stream is spread over')
+    minhash.add_argument('--seed', type=int, default=0)
+    minhash.set_defaults(run=bench_minhash)
+
+    startup = commands.add_parser('startup', help='import time and time from process start to the first handled message')
+    startup.add_argument('--top', type=int, default=10, help="bot's slowest direct imports to list")
+    startup.add_argument('--deferred', nargs='*', default=['openai', 'vertexai.generative_models'],
+                         help='modules the bot now imports on first use, to time on their own')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.set_defaults(run=bench_startup)
+
+    backends = commands.add_parser('backends', help='tail latency of hedged, failed-over classifier backends')
+    backends.add_argument('--requests', type=int, default=2000)
+    backends.add_argument('--rate', type=float, default=200.0, help='requests per second')
+    backends.add_argument('--median', type=float, default=0.05, help="primary backend's median seconds")
+    backends.add_argument('--spike-rate', type=float, default=0.05, help='fraction of answers 20x slower')
+    backends.add_argument('--error-rate', type=float, default=0.02)
+    backends.add_argument('--hedge-quantile', type=float, default=95)
+    backends.add_argument('--timeout', type=float, default=5.0)
+    backends.add_argument('--seed', type=int, default=0)
+    backends.set_defaults(run=bench_backends)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,184 @@
 import discord
-import numpy as np
-from discord.ext import commands
 import os
 import json
-import logging
 import re
-import requests
-from report import Report, State
-import pdb
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Image
-from vertexai import generative_models
-import io
+from report import Report, State, REVIEW_STATES, GEMINI_MODEL, read_violation_reports
+from classifier import Classifier, Verdict, label_from_text
+from evaluation import evaluate, percentile, render_confusion_matrix, format_runs
+from verdict_cache import VerdictCache
+from prompts import POLICIES, token_report, text_part, image_part
+from prefilter import Prefilter
+from attachments import AttachmentFetcher, image_attachments
+from review_queue import ReviewQueue, SharedReviewQueue
+from storage import OffenderStore, ReportStore, EvalRunStore, ImageHashStore
+from phash import HashIndex, dhash
+from minhash import MinHashIndex
+from models import ModelRegistry
+from batcher import MicroBatcher
+from ratelimit import RateLimiter
+from outbox import Outbox
+from routing import ModChannelIndex
+from message_cache import MessageCache
+from workers import WorkerPool
+from backends import ClassifierRouter, OpenAIBackend, VertexBackend, PrefilterBackend, answered_by_fallback
+from metrics import metrics, log_event, logger, setup_logging
 import csv
-import matplotlib.pyplot as plt
+import asyncio
+import time
+from collections import Counter
 
-# Set up logging to the console
-logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
 
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    tokens = json.load(f)
-    discord_token = tokens['discord']
+def load_tokens(token_path='tokens.json'):
+    # There should be a file called 'tokens.json' inside the same folder as this file
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        return json.load(f)
+
+
+def classifier_options(tokens):
+    '''
+    Keyword arguments for the OpenAI Classifier, whether it runs in the bot process or in a WorkerPool.
+    '''
+    return dict(
+        api_key=tokens.get('openai', os.environ.get('OPENAI_API_KEY', '')),
+        base_url=tokens.get('openai_base_url'),  # e.g. a local stub server for testing
+        model=tokens.get('classifier_model', 'gpt-4o'),
+        max_concurrency=tokens.get('classifier_concurrency', 8),
+        timeout=tokens.get('classifier_timeout', 30.0),
+    )
 
 
 class ModBot(discord.Client):
-    def __init__(self):
+    def __init__(self, tokens=None, classifier=None):
+        '''
+        `tokens` holds the API keys and optional settings, read from tokens.json when not given.
+        `classifier` replaces the bot's own Classifier, e.g. with a client of a WorkerPool shared by shards.
+        '''
+        tokens = self.tokens = load_tokens() if tokens is None else tokens
         intents = discord.Intents.default()
         intents.messages = True
         intents.guilds = True
         intents.message_content = True
-        super().__init__(intents=intents)
+        # Set by shards.py when this process runs only some of the bot's gateway shards
+        shard_options = {key: tokens[key] for key in ('shard_ids', 'shard_count') if key in tokens}
+        super().__init__(intents=intents, **shard_options)
         self.group_num = None
-        self.mod_channels = {}  # Map from guild to the mod channel id for that guild
-        self.reports = {}  # Map from user IDs to the state of their report
+        self.mod_channels = ModChannelIndex()  # Map from guild ID to the mod channel for that guild
+        self.policy = POLICIES[tokens.get('policy', 'full')]  # policy version sent with every classification
+        self.reports = {}  # Map from report IDs to the state of that report
+        self.active_reports = {}  # Map from user IDs to the report they are filling in over DM
+        self.flagged_reports = {}  # Map from user IDs to the open report the classifier raised against them
+        # With shared state, reports and the review queue live in the database that every shard process opens
+        self.shared_state = tokens.get('shared_state', False)
+        if self.shared_state:
+            self.review_queue = SharedReviewQueue(tokens.get('database_path', 'moderation.db'))
+        else:
+            self.review_queue = ReviewQueue()  # Reports awaiting moderator review, most urgent first
+        self.models = ModelRegistry(project=tokens.get('vertex_project', 'cs152team5'),
+                                    location=tokens.get('vertex_location', 'us-central1'),
+                                    max_concurrency=tokens.get('generation_concurrency', 8),
+                                    timeout=tokens.get('generation_timeout', 60.0))
+        self.report_store = ReportStore(tokens.get('database_path', 'moderation.db'))
+        # Per-user violation and adversarial-report counters, seeded once from the legacy JSON files
+        self.offender_store = OffenderStore(tokens.get('database_path', 'moderation.db'))
+        self.offender_store.import_json('adversarial', tokens.get('adversarial_data_path', 'adversarial_data.json'))
+        self.offender_store.import_json('violation', tokens.get('violation_data_path', 'violation_data.json'))
+        self.eval_runs = EvalRunStore(tokens.get('database_path', 'moderation.db'))
+        # Perceptual hashes of images moderators confirmed as violations; reposts of them skip the LLM
+        self.image_hashes = ImageHashStore(tokens.get('database_path', 'moderation.db'))
+        self.known_images = HashIndex(max_distance=tokens.get('image_match_distance', 10))
+        self.classifier_pool = None
+        if classifier is None and tokens.get('classifier_processes'):
+            # LLM requests are built, sent and parsed in worker processes instead of on this event loop
+            self.classifier_pool = WorkerPool(tokens['classifier_processes'], **classifier_options(tokens))
+            classifier = self.classifier_pool.client()
+        self.classifier = classifier or Classifier(**classifier_options(tokens))
+        # Stream single-message verdicts and stop at the first word; logprobs add a confidence score
+        self.streaming_verdicts = tokens.get('streaming_verdicts', True)
+        self.verdict_logprobs = tokens.get('verdict_logprobs', True)
+        self.verdict_cache = VerdictCache(
+            max_entries=tokens.get('verdict_cache_size', 10000),
+            ttl=tokens.get('verdict_cache_ttl', 24 * 60 * 60),
+            path=tokens.get('verdict_cache_path'),  # optional SQLite file so verdicts survive restarts
+            flush_interval=tokens.get('verdict_cache_flush_interval', 1.0),
+        )
+        # Text-only near-duplicates of a recent message reuse its verdict and share one mod-channel summary
+        self.near_duplicates = MinHashIndex(threshold=tokens.get('near_duplicate_threshold', 0.7),
+                                            window=tokens.get('near_duplicate_window', 300.0),
+                                            max_entries=tokens.get('near_duplicate_entries', 10000))
+        self.duplicate_summary_delay = tokens.get('duplicate_summary_delay', 10.0)
+        self.duplicate_groups = {}  # verdict future of the original -> near-duplicates awaiting their summary
+        self.message_cache = MessageCache(tokens.get('message_cache_size', 10000))  # (channel, message) -> message
+        self.attachments = AttachmentFetcher(
+            max_bytes=tokens.get('attachment_max_bytes', 8 * 1024 * 1024),
+            timeout=tokens.get('attachment_timeout', 10.0),
+            cache_bytes=tokens.get('attachment_cache_bytes', 64 * 1024 * 1024),
+        )
+        self.batcher = MicroBatcher(self.eval_text_batch, self.eval_text,
+                                    window=tokens.get('batch_window', 0.05),
+                                    max_items=tokens.get('batch_size', 8))
+        prefilter_path = tokens.get('prefilter_model', 'prefilter.npz')
+        prefilter_thresholds = dict(benign_threshold=tokens.get('prefilter_benign_threshold', 0.1),
+                                    violation_threshold=tokens.get('prefilter_violation_threshold'))
+        if os.path.isfile(prefilter_path):
+            self.prefilter = Prefilter.load(prefilter_path, **prefilter_thresholds)
+        else:
+            self.prefilter = Prefilter(**prefilter_thresholds)
+        # With more than one classifier backend, requests are routed to the fastest one, hedged to the next
+        # at its p95 latency, and failed over past errors and open circuit breakers
+        backends = {
+            'openai': lambda: OpenAIBackend(self.classifier),
+            'vertex': lambda: VertexBackend(self.models, tokens.get('vertex_classifier_model', GEMINI_MODEL)),
+            'local': lambda: PrefilterBackend(self.prefilter),
+        }
+        backend_names = tokens.get('classifier_backends', ['openai'])
+        if backend_names != ['openai']:
+            self.classifier = ClassifierRouter([backends[name]() for name in backend_names],
+                                               hedge_quantile=tokens.get('hedge_quantile', 95),
+                                               hedge_delay=tokens.get('hedge_delay', 2.0),
+                                               timeout=tokens.get('classifier_timeout', 30.0),
+                                               breaker_failures=tokens.get('breaker_failures', 5),
+                                               breaker_reset=tokens.get('breaker_reset', 30.0))
+        # Packs the lines of one event (and anything else sent to the same channel meanwhile) into one message
+        self.outbox = Outbox(flush_interval=tokens.get('outbox_flush_interval', 0.1))
+        # Bounds LLM calls and mod-channel posts per author and per channel; excess traffic is shed
+        self.rate_limiter = RateLimiter(
+            author_rate=tokens.get('author_rate', 0.2),
+            author_burst=tokens.get('author_burst', 5),
+            channel_rate=tokens.get('channel_rate', 5.0),
+            channel_burst=tokens.get('channel_burst', 30),
+            max_workers=tokens.get('channel_workers', 8),
+            max_pending=tokens.get('channel_queue_size', 64),
+            shed_policy=tokens.get('shed_policy', 'cheap'),
+            sample_rate=tokens.get('shed_sample_rate', 0.1),
+        )
+
+    async def close(self):
+        await self.classifier.close()
+        await asyncio.get_running_loop().run_in_executor(None, self.verdict_cache.close)
+        await self.attachments.close()
+        self.models.close()
+        if self.classifier_pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.classifier_pool.close)
+        await super().close()
+
+    async def setup_hook(self):
+        if self.classifier_pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.classifier_pool.start)
+        start = time.perf_counter()
+        self.restore_reports()
+        elapsed = time.perf_counter() - start
+        metrics.observe('restore_reports', elapsed)
+        log_event('reports_restored', sample_rate=1.0, reports=len(self.reports), seconds=round(elapsed, 3))
+        self.known_images.extend(self.image_hashes.load_all())
+
+        # Metrics can be scraped from a local port and/or dumped to a file, both in Prometheus text format
+        if self.tokens.get('metrics_port'):
+            self.metrics_server = await metrics.serve(self.tokens['metrics_port'])
+        if self.tokens.get('metrics_path'):
+            self.metrics_task = asyncio.create_task(
+                metrics.dump_periodically(self.tokens['metrics_path'], self.tokens.get('metrics_interval', 60.0)))
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -55,11 +193,43 @@ class ModBot(discord.Client):
         else:
             raise Exception("Group number not found in bot's name. Name format should be \"Group # Bot\".")
 
-        # Find the mod channel in each guild that this bot should report to
-        for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
+        # Find the mod channel in each guild that this bot should report to; guild and channel events keep
+        # the index current from here on
+        self.mod_channels.name = f'group-{self.group_num}-mod'
+        self.mod_channels.build(self.guilds)
+
+        # The Vertex SDK and the OpenAI client are imported lazily; load them in the background now that
+        # we're connected, so neither the login nor the first message waits for them
+        self.prewarm_task = asyncio.create_task(self.prewarm())
+
+    async def prewarm(self):
+        with metrics.timer('prewarm'):
+            await asyncio.gather(self.classifier.prewarm(), self.models.prewarm([GEMINI_MODEL]))
+
+    async def on_guild_join(self, guild):
+        self.mod_channels.add_guild(guild)
+
+    async def on_guild_remove(self, guild):
+        self.mod_channels.remove_guild(guild.id)
+
+    async def on_guild_channel_create(self, channel):
+        self.mod_channels.channel_created(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        self.mod_channels.channel_deleted(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        self.mod_channels.channel_updated(before, after)
+
+    async def on_raw_message_edit(self, payload):
+        self.message_cache.invalidate(payload.channel_id, payload.message_id)
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.invalidate(payload.channel_id, payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.message_cache.invalidate(payload.channel_id, message_id)
 
     async def on_message(self, message):
         '''
@@ -69,12 +239,14 @@ class ModBot(discord.Client):
         # Ignore messages from the bot 
         if message.author.id == self.user.id:
             return
+        self.message_cache.add(message)  # replies and reports often refer back to recent messages
 
         # Check if this message was sent in a server ("guild") or if it's a DM
-        if message.guild:
-            await self.handle_channel_message(message)
-        else:
-            await self.handle_dm(message)
+        with metrics.timer('event', kind='channel' if message.guild else 'dm'):
+            if message.guild:
+                await self.handle_channel_message(message)
+            else:
+                await self.handle_dm(message)
 
     async def handle_dm(self, message):
         # Handle a help message
@@ -89,121 +261,360 @@ class ModBot(discord.Client):
         responses = []
 
         # Only respond to messages if they're part of a reporting flow
-        if author_id not in self.reports and not message.content.startswith(Report.START_KEYWORD):
+        if author_id not in self.active_reports and not message.content.startswith(Report.START_KEYWORD):
             return
 
         # If we don't currently have an active report for this user, add one
-        if author_id not in self.reports:
-            self.reports[author_id] = Report(self)
+        if author_id not in self.active_reports:
+            report = Report(self)
+            self.reports[report.report_id] = report
+            self.active_reports[author_id] = report.report_id
+        report = self.reports[self.active_reports[author_id]]
 
         # Let the report class handle this message; forward all the messages it returns to us
-        responses = await self.reports[author_id].handle_message(message)
-        for r in responses:
-            await message.channel.send(r)
+        state = report.state
+        responses = await report.handle_message(message)
+        if report.report_id not in self.reports:
+            return  # cancelled by a later message while this one was waiting
+        await self.outbox.send(message.channel, *responses)
+        self.save_report(report)
+
+        # Once the reporter has finished the form, queue the report for moderators; the user may start another one.
+        # Only the message that finished it does this, not others handled while it was waiting.
+        if report.state == State.AWAITING_REVIEW and state != State.AWAITING_REVIEW:
+            self.active_reports.pop(author_id, None)
+            self.enqueue_for_review(report)
 
         # If the report is complete or cancelled, remove it from our map
-        if self.reports[author_id].report_complete():
-            # Forward the message to the mod channel
-            mod_channel = list(self.mod_channels.values())[
-                0]  # temp hack, need to change if we have multiple mod channels
-            await mod_channel.send(
-                f'Forwarded message:\n{message.author.name}: "{self.reports[author_id].report_summary}"')
-            self.reports.pop(author_id)
+        if report.report_complete():
+            self.active_reports.pop(author_id, None)
+            # Forward the message to the mod channel of the guild the reported message is in
+            mod_channel = self.mod_channels.for_report(report)
+            if mod_channel is not None:
+                await self.outbox.send(mod_channel,
+                                       f'Forwarded message:\n{message.author.name}: "{report.report_summary}"')
 
     async def handle_channel_message(self, message):
         # Only handle messages sent in the "group-#" channel
         if message.channel.name == f'group-{self.group_num}-mod':
             if message.content.startswith("eval "):
-                with open(message.content[5:], encoding='utf-8') as csvfile:
-                    confusion_matrix = await self.eval_dataset(message, csv.DictReader(csvfile), "Text", "oh_label")
+                dataset_path = message.content[5:]
+                # One checkpoint per policy version and classifier setup, so their runs never mix
+                checkpoint_path = f'{os.path.splitext(dataset_path)[0]}.{self.eval_key()}.eval.jsonl'
+                with open(dataset_path, encoding='utf-8', newline='') as csvfile:
+                    confusion_matrix = await self.eval_dataset(message, csv.DictReader(csvfile), "Text", "oh_label",
+                                                               checkpoint_path=checkpoint_path,
+                                                               dataset_path=dataset_path)
+                return
+
+            if message.content == "compare" or message.content.startswith("compare "):
+                runs = self.eval_runs.latest(dataset=message.content[8:].strip() or None)
+                if not runs:
+                    await message.channel.send("No stored evaluation runs yet.")
+                else:
+                    await message.channel.send(f"```\n{format_runs(runs)}\n```")
+                return
+
+            if message.content == "cache":
+                await message.channel.send(self.verdict_cache.stats() + "\n" + self.message_cache.stats() + "\n"
+                                           + self.batcher.stats() + "\n" + self.outbox.stats() + "\n"
+                                           + self.near_duplicates.stats() + "\n"
+                                           + f"Known violating images: {len(self.known_images)}")
+                return
 
             if message.content == Report.HELP_KEYWORD:
                 reply = "Use the `review` command to begin the moderation process.\n"
                 reply += "Use the `cancel` command to cancel the report process.\n"
+                reply += "Use the `cache` command to see cache, batching, outbox and known-image counts.\n"
+                reply += "Use the `compare [dataset]` command to compare recent evaluation runs side by side.\n"
+                reply += "Use the `stats` command to see latency percentiles and counters for the hot paths.\n"
+                reply += "Use the `limits` command to see how much channel traffic was rate limited.\n"
+                reply += "Use the `queue` command to see the review queue depth and wait times.\n"
+                reply += "Use the `models` command to see generative model load times and latency.\n"
+                reply += "Use the `backends` command to see classifier backend latency and circuit breaker states.\n"
+                reply += "Use the `prompts` command to see the token cost of each policy's prompt templates.\n"
                 await message.channel.send(reply)
                 return
 
-            responses = []
+            if message.content == "prompts":
+                await message.channel.send(f"Prompt prefix tokens per template:\n```\n{token_report()}\n```")
+                return
+
+            if message.content == "models":
+                await message.channel.send(self.models.stats())
+                return
 
-            # Only respond to messages if they're part of a reporting flow
-            if len(self.reports) == 0 and message.content.startswith(Report.REVIEW_KEYWORD):
-                await message.channel.send("No active moderation reports found!")
+            if message.content == "backends":
+                if isinstance(self.classifier, ClassifierRouter):
+                    await message.channel.send(self.classifier.stats())
+                else:
+                    await message.channel.send("Classifying with OpenAI only; set `classifier_backends` to add more")
                 return
 
-            author_id = next(iter(self.reports))  # get the author id of the first report
+            if message.content == "stats":
+                await self.outbox.send(message.channel, *metrics.summary().splitlines())  # may exceed one message
+                return
+
+            if message.content == "limits":
+                await message.channel.send(self.rate_limiter.stats())
+                return
+
+            if message.content == "queue":
+                await message.channel.send(self.review_queue.stats())
+                return
+
+            responses = []
+            moderator_id = message.author.id
+
+            # A moderator keeps working the report they claimed; `review` claims the most urgent unclaimed one
+            report_id = self.review_queue.claimed(moderator_id)
+            if report_id is None:
+                if not message.content.startswith(Report.REVIEW_KEYWORD):
+                    return
+                report_id = self.review_queue.claim(moderator_id)
+                if report_id is None:
+                    await message.channel.send("No active moderation reports found!")
+                    return
+                # Another shard may have filed or last changed this report
+                report = self.lookup_report(report_id, reload=True)
+            elif message.content == Report.CANCEL_KEYWORD:
+                report = self.lookup_report(report_id)
+                if report is not None and report.state == State.AWAITING_BAN_POSTER:
+                    # The offender's count was already recorded; reviewing it again would count it twice
+                    report.state = State.REPORT_COMPLETE
+                    self.save_report(report)
+                    self.review_queue.complete(moderator_id)
+                    await message.channel.send("Review cancelled. The violation was already recorded, so the "
+                                               "report has been closed.")
+                    return
+                if report is not None:
+                    report.cancel_generation()
+                    report.state = State.AWAITING_REVIEW
+                    self.save_report(report)
+                self.review_queue.release(moderator_id)
+                await message.channel.send("Review cancelled. The report is back in the queue.")
+                return
+            else:
+                report = self.lookup_report(report_id)
+            if report is None:
+                self.review_queue.complete(moderator_id)
+                await message.channel.send("That report has already been closed.")
+                return
 
             # Let the report class handle this message; forward all the messages it returns to us
-            responses = await self.reports[author_id].handle_review(message)
-            for r in responses:
-                await message.channel.send(r)
+            responses = await report.handle_review(message)
+            await self.outbox.send(message.channel, *responses)
+            self.save_report(report)
 
-            if self.reports[author_id].report_complete():
-                self.reports.pop(author_id)
+            if report.report_complete():
+                self.review_queue.complete(moderator_id)
             return
 
         if not message.channel.name == f'group-{self.group_num}':
             return
 
-        # Forward the message to the mod channel
-        mod_channel = self.mod_channels[message.guild.id]
-        await mod_channel.send(f'Forwarded message:\n{message.author.name}: "{message.content}"')
+        decision = self.rate_limiter.admit(message.author.id, message.channel.id, message.content)
+        metrics.inc('admissions', decision=decision)
+        if decision == 'process':
+            async with self.rate_limiter.processing():
+                await self.process_channel_message(message)
+        elif decision == 'cheap':
+            # Shed messages only get the local prefilter, but anything it flags still reaches review
+            verdict, _ = self.prefilter.decide(message.content)
+            if verdict == 'yes':
+                self.flag_message(message, Verdict(verdict, version=self.policy.version))
+
+    async def process_channel_message(self, message):
+        # Everything about this message goes to the mod channel as one post once the verdict is in
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            return  # this guild has no mod channel to report to
+
+        signature = None
+        if not message.attachments and not message.reference:
+            signature = self.near_duplicates.signature(message.content)
+        if signature is not None:
+            original = self.near_duplicates.query(signature)
+            if original is not None and await self.inherit_verdict(message, original, mod_channel):
+                return
+            verdict = asyncio.get_running_loop().create_future()
+            self.near_duplicates.add(signature, (message, verdict))
+
+        lines = [f'Forwarded message:\n{message.author.name}: "{message.content}"']
+        result = None
+        try:
+            result = await self.forward_and_classify(message, lines)
+        finally:
+            if signature is not None:
+                verdict.set_result(result)  # None if classification failed; near-duplicates then go it alone
+            await self.outbox.send(mod_channel, *lines)
+
+    async def inherit_verdict(self, message, original, mod_channel):
+        '''
+        Give a near-duplicate the verdict of the recent message it resembles, waiting for that verdict if it is
+        still being classified, and count it towards one summary post. Returns False if the original got no
+        verdict, in which case the message is classified on its own.
+        '''
+        original_message, pending = original
+        verdict = await asyncio.shield(pending)
+        if verdict is None:
+            return False
+        metrics.inc('near_duplicates', label=verdict.label)
+        if verdict.violation:
+            self.flag_message(message, verdict)
+        group = self.duplicate_groups.get(pending)
+        if group is None:
+            group = self.duplicate_groups[pending] = {'authors': Counter()}
+            group['task'] = asyncio.create_task(
+                self.summarize_duplicates(pending, original_message, verdict, mod_channel))
+        group['authors'][message.author.name] += 1
+        return True
+
+    async def summarize_duplicates(self, key, original, verdict, mod_channel):
+        '''
+        After `duplicate_summary_delay` seconds, post one line for every near-duplicate of `original` since.
+        '''
+        await asyncio.sleep(self.duplicate_summary_delay)
+        authors = self.duplicate_groups.pop(key)['authors']
+        names = ', '.join(name if n == 1 else f'{name} x{n}' for name, n in authors.most_common(10))
+        if len(authors) > 10:
+            names += f' and {len(authors) - 10} more'
+        await self.outbox.send(mod_channel,
+                               f'{sum(authors.values())} near-duplicates of {original.author.name}: '
+                               f'"{original.content}" from {names}',
+                               self.code_format((original.content, verdict)))
+
+    async def forward_and_classify(self, message, lines):
 
         # Handle image attachments in the original message
-        image_urls = [attachment.url for attachment in message.attachments if attachment.content_type.startswith('image')]
+        image_urls = [attachment.url for attachment in image_attachments(message.attachments)]
 
-        referenced_image_urls = None
         # # Handle image attachments in the referenced message (if any)
-        referenced_image_urls = None
+        referenced_attachments = []
         if message.reference:
-            referenced_message = await message.channel.fetch_message(message.reference.message_id)
-            referenced_image_urls = [attachment.url for attachment in referenced_message.attachments if
-                                     attachment.content_type.startswith('image')]
-            if referenced_image_urls:
-                for url in referenced_image_urls:
-                    await mod_channel.send(f'Forwarded referenced image:\n{referenced_message.author.name}: {url}')
+            referenced_message = await self.message_cache.fetch(message.channel, message.reference.message_id)
+            referenced_attachments = referenced_message.attachments
+            referenced_image_urls = [attachment.url for attachment in image_attachments(referenced_attachments)]
+            for url in referenced_image_urls:
+                lines.append(f'Forwarded referenced image:\n{referenced_message.author.name}: {url}')
 
         # Forward images from the original message to the mod channel
-        if image_urls:
-            for url in image_urls:
-                await mod_channel.send(f'Forwarded image:\n{message.author.name}: {url}')
-
-        scores = await self.eval_text(message.content, image_urls, referenced_image_urls)
-        if scores[1].startswith('yes'):
-            print("Found a violation msg")
-            author_id = message.author.id
-            if author_id not in self.reports:
-                print("creating report")
-                self.reports[author_id] = Report(self)
-                self.reports[author_id].report_message = message
-                self.reports[author_id].msg_poster = message.author
-                self.reports[author_id].state = State.AWAITING_REVIEW
-
-        await mod_channel.send(self.code_format(scores))
-
-    async def eval_dataset(self, message, dataset_parsed, text_key, label_key):
-        MAX_MESSAGES = 1000
-        count = 1
-
-        # Initialize the confusion matrix
-        confusion_matrix = np.zeros((2, 2), dtype=int)
-
-        for example in dataset_parsed:
-            if count > MAX_MESSAGES:
-                break
-            print('(example[text_key]', example[text_key])
-            _, score = await self.eval_text(example[text_key])
-            print('score', score)
-
-            predicted_label = 1 if score == 'yes' else 0
-            true_label = example[label_key]
-
-            print('true_label', true_label)
-            print('type true_label', type(true_label))
-
-            # Update the confusion matrix
-            confusion_matrix[int(true_label), int(predicted_label)] += 1
-            count += 1
-            print(count)
+        for url in image_urls:
+            lines.append(f'Forwarded image:\n{message.author.name}: {url}')
+
+        # Download both messages' images in parallel, straight into memory
+        # An image we couldn't download still goes to the LLM, by URL, rather than leaving a text-only message
+        # the prefilter might clear
+        images, referenced_images = await asyncio.gather(
+            self.attachments.fetch_all(message.attachments, keep_unfetched=True),
+            self.attachments.fetch_all(referenced_attachments, keep_unfetched=True))
+
+        scores = await self.classify(message.content, images, referenced_images)
+        metrics.inc('verdicts', label=scores[1].label)
+        if scores[1].violation:
+            self.flag_message(message, scores[1])
+
+        lines.append(self.code_format(scores))
+        return scores[1]
+
+    def flag_message(self, message, verdict):
+        '''
+        Open a review report for a message the classifier flagged, unless its author already has one.
+        '''
+        author_id = message.author.id
+        if author_id in self.flagged_reports:
+            # With shared state, another shard may have closed that report since
+            if not self.shared_state or self.report_store.load(self.flagged_reports[author_id]) is not None:
+                return
+        report = Report(self)
+        report.set_reported_message(message, message.author)
+        report.classifier_verdict = verdict.label
+        report.state = State.AWAITING_REVIEW
+        self.reports[report.report_id] = report
+        self.flagged_reports[author_id] = report.report_id
+        self.save_report(report)
+        self.enqueue_for_review(report)
+        log_event('flagged', sample_rate=1.0, report=report.report_id, author=author_id, message=message.id,
+                  label=verdict.label, confidence=verdict.confidence)
+
+    def enqueue_for_review(self, report):
+        self.review_queue.push(report.report_id,
+                               abuse_type=report.selected_abuse_type,
+                               flagged=report.classifier_verdict == 'yes',
+                               prior_violations=read_violation_reports(self.offender_store, report.poster_id),
+                               enqueued_at=report.created_at)
+
+    def lookup_report(self, report_id, reload=False):
+        '''
+        The open report with this ID, or None if it has been closed. With shared state another shard may have
+        filed, changed or closed it, so it is read back from the store when missing here or when `reload` is set.
+        '''
+        if self.shared_state and (reload or report_id not in self.reports):
+            data = self.report_store.load(report_id)
+            if data is None:
+                self.reports.pop(report_id, None)
+                return None
+            self.reports[report_id] = Report.from_dict(self, data)
+        return self.reports.get(report_id)
+
+    def save_report(self, report):
+        '''
+        Persist the report after a state transition, or forget it everywhere once it is complete.
+        '''
+        if not report.report_complete():
+            self.report_store.save(report.report_id, report.to_dict())
+            return
+        self.report_store.delete(report.report_id)
+        self.reports.pop(report.report_id, None)
+        self.review_queue.remove(report.report_id)
+        if self.flagged_reports.get(report.poster_id) == report.report_id:
+            self.flagged_reports.pop(report.poster_id)
+
+    def restore_reports(self):
+        '''
+        Reload the reports that were open when the bot last stopped. Discord objects are fetched lazily by
+        Report.resolve, so this only reads the local store.
+        '''
+        for data in self.report_store.load_all():
+            report = Report.from_dict(self, data)
+            self.reports[report.report_id] = report
+            if report.state in REVIEW_STATES:
+                # Unless another shard holds a claim on it, a half-reviewed report starts its review over
+                if self.review_queue.claimed_by(report.report_id) is None:
+                    report.state = State.AWAITING_REVIEW
+                    self.enqueue_for_review(report)
+                if report.classifier_verdict == 'yes':
+                    self.flagged_reports[report.poster_id] = report.report_id
+            elif report.reporter_id is not None:
+                self.active_reports[report.reporter_id] = report.report_id
+
+    def eval_key(self):
+        '''
+        Policy version plus the classifier model (every backend's, when routing), for naming evaluation files.
+        '''
+        return re.sub(r'[^\w.-]+', '_', f'{self.policy.version}.{self.classifier.model}')
+
+    async def eval_dataset(self, message, dataset_parsed, text_key, label_key, checkpoint_path=None,
+                           dataset_path='dataset'):
+        async def classify(text):
+            _, verdict = await self.classify(text)
+            return verdict.violation
+
+        async def post_progress(result):
+            await self.outbox.send(message.channel, f"Evaluating {dataset_path}: {result.rows} rows so far, "
+                                                    f"{result.throughput:.2f} rows/sec", result.scores())
+
+        tier_counts = dict(self.prefilter.counts)
+        result = await evaluate(classify, dataset_parsed, text_key, label_key,
+                                concurrency=self.tokens.get('eval_concurrency', 16),
+                                checkpoint_path=checkpoint_path, on_progress=post_progress,
+                                progress_interval=self.tokens.get('eval_progress_interval', 30.0))
+        confusion_matrix = result.confusion_matrix
+        (tn, fp), (fn, tp) = confusion_matrix.tolist()
+        self.eval_runs.save(dataset=dataset_path, policy=self.policy.version, model=self.classifier.model,
+                            finished_at=time.time(), tn=tn, fp=fp, fn=fn, tp=tp, errors=result.errors,
+                            elapsed=result.elapsed, p50=percentile(result.latencies, 50),
+                            p95=percentile(result.latencies, 95), resumed=result.resumed)
 
         # Calculate the total number of examples
         total = confusion_matrix.sum()
@@ -216,236 +627,161 @@ class ModBot(discord.Client):
             f"Actual Yes     {confusion_matrix[1, 0]:12} ({percentages[1, 0]:6.2f}%)    {confusion_matrix[1, 1]:12} ({percentages[1, 1]:6.2f}%)"
         )
 
-        # Print the formatted confusion matrix
-        print(formatted_matrix)
-
-        fig, ax = plt.subplots()
-        cax = ax.matshow(confusion_matrix, cmap='Blues')
-        plt.title('Confusion Matrix')
-        fig.colorbar(cax)
-        ax.set_xticklabels([''] + ['No', 'Yes'])
-        ax.set_yticklabels([''] + ['No', 'Yes'])
-        plt.xlabel('Predicted')
-        plt.ylabel('Actual')
-
-        for (i, j), val in np.ndenumerate(confusion_matrix):
-            plt.text(j, i, f'{val}\n({percentages[i, j]:.2f}%)', ha='center', va='center', color='red')
+        stats = (f"Policy: {self.policy.version}\n" + result.scores() + "\n" + result.stats() + "\n"
+                 + self.prefilter.stats(since=tier_counts))
+        logger.info("Evaluation finished\n%s\n%s", formatted_matrix, stats)
+        await self.outbox.send(message.channel, f"```\n{formatted_matrix}\n\n{stats}\n```")  # after any progress
 
-        # Save the confusion matrix as a JPG file
-        plt.savefig('confusion_matrix_full_policy_1000_oai.jpg', format='jpg')
-        plt.show()
+        # Drawing takes most of a second, so it happens in a worker thread while moderation carries on
+        plot_path = f'{os.path.splitext(dataset_path)[0]}.{self.eval_key()}.confusion.png'
+        await asyncio.get_running_loop().run_in_executor(
+            None, render_confusion_matrix, confusion_matrix, plot_path, f'Confusion Matrix ({self.policy.version})')
+        await message.channel.send(file=discord.File(plot_path))
 
         return percentages.tolist()
     
-    async def eval_text(self, message_content, image_urls=None, referenced_image_urls=None):
-
-        print('message_content', message_content)
-
-        from openai import OpenAI
-        client = OpenAI(
-            api_key='',
-        )
-
-        #no policy
-        policy_text = ''
-
-        # short policy
-        # policy_text = """
-        #         Cyberbullying Policy:
-
-        #         Cyberbullying is strictly prohibited on this platform. This includes content that targets an individual (including by name, handle, or image, regardless of whether or not that individual is directly tagged in the post itself) with one or more threatening or abusive messages, doxxes or exposes private information about an individual, and/or shares one or more nonconsensual images of an individual with malicious intent.
-        # """
-
-        # full policy
-        policy_text = """
-                Cyberbullying Policy:
-
-                Cyberbullying is strictly prohibited on this platform. This includes content that targets an individual (including by name, handle, or image, regardless of whether or not that individual is directly tagged in the post itself) with one or more threatening or abusive messages, doxxes or exposes private information about an individual, and/or shares one or more nonconsensual images of an individual with malicious intent.
-
-                We recognize that public figures (define) are in a unique position on our platform and that it is in the public interest to allow for some level of discourse and criticism on these figures. Therefore, we do permit some negative or critical comments about public figures. However, posts that constitute significant bullying (i.e., threatening to or following through with doxxing an individual or expressing a desire to harm an individual) are not permitted against public figures.
-
-                Threatening or abusive messages can include but are not limited to:
-                - Offensive name calling
-                - Spreading of false rumors
-                - Degrading statements about appearance
-                - Threats of physical harm
-                - Negative comments in reference to an individual’s sexual identity
-                - Incitements to harm oneself
-                - Encouragement of others to harass an individual
-
-                Exposing the private information of an individual can include but is not limited to:
-                - Threatening to or revealing an individual’s address, phone number, or email address
-
-                Sharing a nonconsensual image with malicious intent includes but is not limited to:
-                - Sharing sexually explicit/thematic images without consent (18+)
-                - Sharing images of an individual in a degrading/embarrassing context or situation
-                - Sharing any photo of an individual along with text meant to degrade, harass, or share private information about them
-                - Photoshopping or using deepfake/AI to create or facilitate any of the above scenarios
-
-                We recognize that context is necessary in certain scenarios to understand the intent and impact behind a given post. Our reporting system allows for victims of cyberbullying posts to identify themselves when reporting, and our moderators take this into account when making decisions.
-
-                Consider that there are other forms of violation and the above policy may not cover all types of abuses. 
-        """
-
-
-        print('referenced_image_urls', referenced_image_urls)
-        print('image_urls', image_urls)
-
-        if referenced_image_urls:
-            if image_urls:
-                response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                    "role": "user",
-                    "content": [
-                        {
-                        "type": "text",
-                        "text": policy_text,
-                        },
-                        {
-                        "type": "text",
-                        "text": "Let's say the first image is a instagram post and the second image is a response to the post, would you consider the response a violation of cyberbullying policy? Please start answer with only 'yes' or 'no' ",
-                        },
-                        {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": referenced_image_urls[0],
-                        },
-                        },
-                        {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_urls[0],
-                        },
-                        },
-                    ],
-                    }
-                ],
-                max_tokens=300,
-                )
-
-                print('response', response)
-                first_word = response.choices[0].message.content.strip().lower().split(' ')[0]
-                print('first_word', first_word)
-            else:
-                response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                    "role": "user",
-                    "content": [
-                        {
-                        "type": "text",
-                        "text": policy_text,
-                        },
-                        {
-                        "type": "text",
-                        "text": "Let's say the first image is a instagram post and the second text is a response to the post, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
-                        },
-                        {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": referenced_image_urls[0],
-                        },
-                        },
-                        {
-                        "type": "text",
-                        "text": message_content,
-                        },
-                    ],
-                    }
-                ],
-                max_tokens=300,
-                )
-                print('response', response)
-
-            first_word = response.choices[0].message.content.strip().lower().split(' ')[0]
-            print('first_word', first_word)
-        elif image_urls:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                    "role": "user",
-                    "content": [
-                        {
-                        "type": "text",
-                        "text": policy_text,
-                        },
-                        {
-                        "type": "text",
-                        "text": "Let's say the image is a instagram post, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
-                        },
-                        {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": image_urls[0],
-                        },
-                        },
-                    ],
-                    }
-                ],
-                max_tokens=300,
-                )
-            print('response.choices[0].message.content.strip()', response.choices[0].message.content.strip())
-            first_word = response.choices[0].message.content.strip().lower().split(' ')[0]
-            print('first_word', first_word)
-        else:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                    "role": "user",
-                    "content": [
-                        {
-                        "type": "text",
-                        "text": policy_text,
-                        },
-                        {
-                        "type": "text",
-                        "text": "Let's say the following is a comment on twitter, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
-                        },
-                        {
-                        "type": "text",
-                        "text": message_content,
-                        },
-                    ],
-                    }
-                ],
-                max_tokens=300,
-                )
-            print('response.choices[0].message.content.strip()', response.choices[0].message.content.strip())
-            first_word = response.choices[0].message.content.strip().lower().split(' ')[0]
-            print('first_word', first_word)
-
-        return message_content, first_word
-
-    async def save_image(self, image_url, image_path):
+    async def classify(self, message_content, images=None, referenced_images=None):
         '''
-        Download an image from a URL and save it locally.
+        Tiered classification: text-only messages the local prefilter is confident about never reach the LLM,
+        and the remaining text-only messages are micro-batched into shared requests.
         '''
-        response = requests.get(image_url)
-        image_data = response.content
+        with metrics.timer('classify', kind='image' if images or referenced_images else 'text'):
+            if not images and not referenced_images:
+                verdict = self.prefilter.classify(message_content)
+                if verdict is not None:
+                    return message_content, Verdict(verdict, version=self.policy.version)
+                return await self.batcher.submit(message_content)
+            # Reposts of images moderators already confirmed are flagged without asking the LLM
+            if images and await self.match_known_image(images) is not None:
+                return message_content, Verdict('yes', version=self.policy.version)
+            self.prefilter.counts['llm'] += 1
+            return await self.eval_text(message_content, images, referenced_images)
+
+    async def hash_images(self, images):
+        '''
+        Perceptual hashes of fetched images, computed off the event loop; images PIL cannot decode are skipped.
+        '''
+        loop = asyncio.get_running_loop()
+        hashes = []
+        for image in images:
+            if image.data is None:
+                continue  # not downloaded
+            try:
+                hashes.append(await loop.run_in_executor(None, dhash, image.data))
+            except (OSError, ValueError):  # PIL's UnidentifiedImageError is an OSError
+                continue
+        return hashes
+
+    async def match_known_image(self, images):
+        '''
+        (distance, hash) of the first image close to a known violating one, or None.
+        '''
+        with metrics.timer('known_image_lookup'):
+            for value in await self.hash_images(images):
+                match = self.known_images.nearest(value)
+                if match is not None:
+                    metrics.inc('known_image_matches')
+                    log_event('known_image', sample_rate=1.0, distance=match[0], hash=f'{match[1]:016x}')
+                    return match
+        return None
+
+    async def remember_violating_images(self, message, report_id):
+        '''
+        Add the images of a message a moderator confirmed as a violation to the known-image index.
+        '''
+        images = await self.attachments.fetch_all(message.attachments)
+        for value in await self.hash_images(images):
+            if self.known_images.add(value):
+                self.image_hashes.add(value, report_id, time.time())
 
-        # image_path = 'image.jpg'
-        with open(image_path, 'wb') as f:
-            f.write(image_data)
+    async def eval_text_batch(self, contents):
+        '''
+        Classify several text-only messages with one request that returns a verdict per message.
+        '''
+        keys = [self.verdict_cache.key(content, (), self.policy.version) for content in contents]
+        cached = [self.verdict_cache.get(key) for key in keys]
+        verdicts = [None if value is None else Verdict.from_cache(value, self.policy.version) for value in cached]
+        missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+
+        if missing:
+            numbered = "\n".join(f"{n + 1}. {json.dumps(contents[i])}" for n, i in enumerate(missing))
+            with metrics.timer('llm_request', mode='batch'):
+                response = await self.classifier.create(
+                    messages=self.policy.messages('batch', text_part(numbered)),
+                    max_tokens=8 * len(missing) + 16,
+                )
+            metrics.inc('batched_messages', len(missing))
+            cacheable = not answered_by_fallback()
+            content = response.choices[0].message.content
+            answers = json.loads(content[content.index('['):content.rindex(']') + 1])
+            if len(answers) != len(missing):
+                raise ValueError(f"Expected {len(missing)} verdicts, got {len(answers)}")
+            for i, answer in zip(missing, answers):
+                label = str(answer).strip().lower()
+                verdicts[i] = Verdict(label if label in ('yes', 'no') else 'uncertain', version=self.policy.version)
+                if cacheable and verdicts[i].label != 'uncertain':
+                    self.verdict_cache.put(keys[i], verdicts[i].to_cache())
+
+        return list(zip(contents, verdicts))
+
+    async def eval_text(self, message_content, images=None, referenced_images=None):
+        attachment_keys = [b'ref:' + image.key() for image in referenced_images or []]
+        attachment_keys += [b'img:' + image.key() for image in images or []]
+        cache_key = self.verdict_cache.key(message_content, attachment_keys, self.policy.version)
+        cached = self.verdict_cache.get(cache_key)
+        if cached is not None:
+            return message_content, Verdict.from_cache(cached, self.policy.version)
+
+        # The policy and instruction prefix is prebuilt per modality; only the message itself is appended
+        if referenced_images and images:
+            messages = self.policy.messages('image_pair', image_part(referenced_images[0].data_url()),
+                                            image_part(images[0].data_url()))
+        elif referenced_images:
+            messages = self.policy.messages('reply_to_image', image_part(referenced_images[0].data_url()),
+                                            text_part(message_content))
+        elif images:
+            messages = self.policy.messages('image', image_part(images[0].data_url()))
+        else:
+            messages = self.policy.messages('text', text_part(message_content))
 
-        return image_path
+        if self.streaming_verdicts:
+            with metrics.timer('llm_request', mode='stream'):
+                label, confidence = await self.classifier.stream_verdict(messages, logprobs=self.verdict_logprobs)
+            answer = label
+        else:
+            with metrics.timer('llm_request', mode='full'):
+                response = await self.classifier.create(messages=messages, max_tokens=300)
+            answer = response.choices[0].message.content.strip()
+            label, confidence = label_from_text(answer), None
+        fallback = answered_by_fallback()
+        log_event('classified', text=message_content[:200], images=len(images or []),
+                  referenced_images=len(referenced_images or []), answer=answer[:200], label=label,
+                  confidence=confidence, fallback=fallback)
+
+        verdict = Verdict(label, confidence, self.policy.version)
+        # A fallback's stopgap answer or an 'uncertain' would otherwise stick for the cache TTL
+        if not fallback and label != 'uncertain':
+            self.verdict_cache.put(cache_key, verdict.to_cache())
+        return message_content, verdict
 
     def code_format(self, text):
         '''
         Format the evaluated message and result.
         '''
-        msg, eval = text
-        eval_cleaned = eval.lower().replace(' ', '').strip()
-        print('eval_cleaned'+eval)
-        if 'yes' in eval_cleaned:
-            return f"Evaluated: '{msg}' as a violation"
-        return f"Evaluated: '{msg}' as not a violation"
+        msg, verdict = text
+        details = f"policy {verdict.version}"
+        if verdict.confidence is not None:
+            details += f", P(violation) {verdict.confidence:.2f}"
+        if verdict.violation:
+            return f"Evaluated: '{msg}' as a violation ({details})"
+        if verdict.label == 'uncertain':
+            return f"Evaluated: '{msg}' as uncertain ({details})"
+        return f"Evaluated: '{msg}' as not a violation ({details})"
 
 
 if __name__ == "__main__":
-    client = ModBot()
-    client.run(discord_token)
+    tokens = load_tokens()
+    setup_logging(path=tokens.get('log_path', 'discord.log'), level=tokens.get('log_level', 'INFO'),
+                  sample_rate=tokens.get('log_sample_rate', 0.01))
+    client = ModBot(tokens)
+    client.run(tokens['discord'])
@@ -0,0 +1,158 @@
+import asyncio
+import math
+import re
+import threading
+
+LABELS = ('yes', 'no')
+FIRST_WORD = re.compile(r"\W*(\w+)(\W?)")
+
+
+class Verdict:
+    '''
+    A classifier decision: `label` is 'yes', 'no' or 'uncertain', and `confidence`, when logprobs were
+    available, is the model's probability of 'yes' renormalized over the two answers.
+    '''
+
+    def __init__(self, label, confidence=None, version=''):
+        self.label = label
+        self.confidence = confidence
+        self.version = version
+
+    @property
+    def violation(self):
+        return self.label == 'yes'
+
+    def to_cache(self):
+        return [self.label, self.confidence]
+
+    @classmethod
+    def from_cache(cls, value, version=''):
+        if isinstance(value, str):
+            return cls(value, version=version)
+        return cls(value[0], value[1], version)
+
+    def __repr__(self):
+        return f"Verdict({self.label!r}, confidence={self.confidence!r}, version={self.version!r})"
+
+
+def label_from_text(text, final=True):
+    '''
+    The verdict label carried by the first word of `text`, or None if more text could still change it.
+    '''
+    match = FIRST_WORD.match(text.lower())
+    if match is None:
+        return 'uncertain' if final else None
+    word, boundary = match.groups()
+    if boundary or final or word == 'yes' or not any(label.startswith(word) for label in LABELS):
+        return word if word in LABELS else 'uncertain'
+    return None  # 'n' or 'no' may still grow into e.g. 'not'
+
+
+def yes_probability(top_logprobs):
+    '''
+    P(yes) / (P(yes) + P(no)) from the alternatives offered for the first token, or None if neither appears.
+    '''
+    mass = dict.fromkeys(LABELS, 0.0)
+    for candidate in top_logprobs or []:
+        word = candidate.token.strip().lower()
+        if word in mass:
+            mass[word] += math.exp(candidate.logprob)
+    total = sum(mass.values())
+    return mass['yes'] / total if total else None
+
+
+class Classifier:
+    '''
+    Long-lived async wrapper around the OpenAI chat completions API.
+
+    One instance is created by ModBot and shared by every message, so the HTTP
+    connection pool is reused instead of rebuilt per call. `max_concurrency`
+    caps the number of requests in flight and `timeout` bounds each request.
+    Pointing `base_url` at a local stub server makes it testable offline.
+    The openai package is only imported when the first request is made, or by `prewarm`.
+    '''
+
+    def __init__(self, api_key='', base_url=None, model="gpt-4o", max_concurrency=8, timeout=30.0):
+        self.model = model
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.options = dict(api_key=api_key, base_url=base_url, timeout=timeout)
+        self.lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    from openai import AsyncOpenAI
+
+                    self._client = AsyncOpenAI(**self.options)
+        return self._client
+
+    async def prewarm(self):
+        '''
+        Import openai and build the client in a worker thread, off the event loop.
+        '''
+        await asyncio.get_running_loop().run_in_executor(None, lambda: self.client)
+
+    async def create(self, messages, max_tokens=300, **kwargs):
+        '''
+        Send one chat completion request, waiting for a free concurrency slot first.
+        '''
+        async with self.semaphore:
+            return await asyncio.wait_for(
+                self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    **kwargs,
+                ),
+                timeout=self.timeout,
+            )
+
+    async def complete(self, messages, max_tokens=300, **kwargs):
+        '''
+        Like `create`, but return only the stripped text of the first choice.
+        '''
+        response = await self.create(messages, max_tokens=max_tokens, **kwargs)
+        return response.choices[0].message.content.strip()
+
+    async def stream_verdict(self, messages, max_tokens=5, logprobs=True, top_logprobs=5):
+        '''
+        Stream a yes/no answer and close the stream as soon as its first word settles, instead of paying for
+        the whole completion. Returns (label, confidence); confidence is None without `logprobs`.
+        '''
+        async with self.semaphore:
+            return await asyncio.wait_for(self._stream_verdict(messages, max_tokens, logprobs, top_logprobs),
+                                          timeout=self.timeout)
+
+    async def _stream_verdict(self, messages, max_tokens, logprobs, top_logprobs):
+        kwargs = {'logprobs': True, 'top_logprobs': top_logprobs} if logprobs else {}
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            **kwargs,
+        )
+        text = ''
+        label = confidence = None
+        try:
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if logprobs and confidence is None and choice.logprobs and choice.logprobs.content:
+                    confidence = yes_probability(choice.logprobs.content[0].top_logprobs)
+                text += choice.delta.content or ''
+                label = label_from_text(text, final=False)
+                if label is not None:
+                    break
+        finally:
+            await stream.close()
+        return label or label_from_text(text), confidence
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
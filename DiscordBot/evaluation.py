@@ -0,0 +1,224 @@
+import asyncio
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+
+def percentile(values, q):
+    '''
+    Return the q-th percentile of a list of numbers, or 0.0 if it is empty.
+    '''
+    if not values:
+        return 0.0
+    return float(np.percentile(values, q))
+
+
+def is_retryable(error):
+    '''
+    Rate-limit (429), server-side (5xx) and timeout errors are worth retrying; anything else is not.
+    '''
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        return type(error).__name__ in ('RateLimitError', 'APITimeoutError', 'APIConnectionError')
+    return status == 429 or status >= 500
+
+
+def retry_after(error):
+    '''
+    Seconds the server asked us to wait, if the error carries a Retry-After header.
+    '''
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class EvalResult:
+    def __init__(self):
+        self.confusion_matrix = np.zeros((2, 2), dtype=int)
+        self.latencies = []
+        self.errors = 0
+        self.resumed = 0
+        self.elapsed = 0.0
+
+    @property
+    def rows(self):
+        return int(self.confusion_matrix.sum())
+
+    @property
+    def throughput(self):
+        '''
+        Rows classified per second during this run (resumed rows are not counted).
+        '''
+        if self.elapsed <= 0:
+            return 0.0
+        return (self.rows - self.resumed) / self.elapsed
+
+    @property
+    def precision(self):
+        predicted_yes = self.confusion_matrix[:, 1].sum()
+        return self.confusion_matrix[1, 1] / predicted_yes if predicted_yes else 0.0
+
+    @property
+    def recall(self):
+        actual_yes = self.confusion_matrix[1].sum()
+        return self.confusion_matrix[1, 1] / actual_yes if actual_yes else 0.0
+
+    @property
+    def f1(self):
+        total = self.precision + self.recall
+        return 2 * self.precision * self.recall / total if total else 0.0
+
+    @property
+    def accuracy(self):
+        return (self.confusion_matrix[0, 0] + self.confusion_matrix[1, 1]) / self.rows if self.rows else 0.0
+
+    def scores(self):
+        (tn, fp), (fn, tp) = self.confusion_matrix
+        return (f"Precision {self.precision:.3f}, recall {self.recall:.3f}, F1 {self.f1:.3f}, "
+                f"accuracy {self.accuracy:.3f}\n"
+                f"Actual yes {fn + tp} (TP {tp}, FN {fn}), actual no {tn + fp} (TN {tn}, FP {fp})")
+
+    def stats(self):
+        return (
+            f"Rows: {self.rows} ({self.resumed} resumed from checkpoint, {self.errors} failed)\n"
+            f"Throughput: {self.throughput:.2f} rows/sec\n"
+            f"Latency: p50 {percentile(self.latencies, 50) * 1000:.0f} ms, "
+            f"p95 {percentile(self.latencies, 95) * 1000:.0f} ms"
+        )
+
+
+async def evaluate(classify, rows, text_key, label_key, concurrency=16, checkpoint_path=None, max_rows=None,
+                   retries=5, backoff=1.0, on_progress=None, progress_interval=30.0):
+    '''
+    Classify every row of `rows` (any iterable of dicts, e.g. a csv.DictReader) and build a confusion matrix.
+
+    `classify(text)` is awaited for each row and must return True for a predicted violation. Rows are pulled
+    lazily from the iterator by `concurrency` workers, so the whole dataset is never held in memory. Retryable
+    errors back off exponentially (honoring Retry-After) up to `retries` times before the row is counted as
+    failed. When `checkpoint_path` is given, each finished row is appended to it as a JSON line and rows already
+    present there are skipped, so an interrupted run resumes where it stopped.
+
+    The confusion matrix is updated as rows finish, so `result` is always current; if `on_progress` is given it
+    is awaited with the partial result every `progress_interval` seconds while the run is going.
+    '''
+    result = EvalResult()
+    done = set()
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # a partially written last line from a crash
+                done.add(entry['row'])
+                result.confusion_matrix[entry['label'], entry['predicted']] += 1
+        result.resumed = len(done)
+
+    checkpoint = open(checkpoint_path, 'a', encoding='utf-8') if checkpoint_path else None
+    examples = enumerate(rows)
+
+    async def classify_with_retry(text):
+        for attempt in range(retries + 1):
+            try:
+                return await classify(text)
+            except Exception as e:
+                if attempt == retries or not is_retryable(e):
+                    raise
+                delay = retry_after(e) or backoff * 2 ** attempt
+                await asyncio.sleep(delay * (1 + random.random() * 0.1))
+
+    async def worker():
+        for index, example in examples:
+            if max_rows is not None and index >= max_rows:
+                return
+            if index in done:
+                continue
+
+            start = time.perf_counter()
+            try:
+                predicted = int(bool(await classify_with_retry(example[text_key])))
+            except Exception:
+                result.errors += 1
+                continue
+            result.latencies.append(time.perf_counter() - start)
+
+            label = int(example[label_key])
+            result.confusion_matrix[label, predicted] += 1
+            if checkpoint:
+                checkpoint.write(json.dumps({'row': index, 'label': label, 'predicted': predicted}) + '\n')
+                checkpoint.flush()
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(progress_interval)
+            result.elapsed = time.perf_counter() - start
+            await on_progress(result)
+
+    start = time.perf_counter()
+    progress = asyncio.ensure_future(report_progress()) if on_progress else None
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        result.elapsed = time.perf_counter() - start
+        if progress:
+            progress.cancel()
+        if checkpoint:
+            checkpoint.close()
+
+    return result
+
+
+def render_confusion_matrix(confusion_matrix, path, title='Confusion Matrix'):
+    '''
+    Draw the confusion matrix to an image file. Uses matplotlib's object API with the Agg canvas, so it never
+    opens a window and is safe to call from a worker thread.
+    '''
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    percentages = confusion_matrix / max(1, confusion_matrix.sum()) * 100
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    cax = ax.matshow(confusion_matrix, cmap='Blues')
+    ax.set_title(title)
+    fig.colorbar(cax)
+    ax.set_xticks([0, 1], ['No', 'Yes'])
+    ax.set_yticks([0, 1], ['No', 'Yes'])
+    ax.set_xlabel('Predicted')
+    ax.set_ylabel('Actual')
+    for (i, j), val in np.ndenumerate(confusion_matrix):
+        ax.text(j, i, f'{val}\n({percentages[i, j]:.2f}%)', ha='center', va='center', color='red')
+    fig.savefig(path)
+    return path
+
+
+def format_runs(runs):
+    '''
+    Side-by-side table of stored runs (dicts from EvalRunStore.latest) for the `compare` command.
+    '''
+    lines = [f"{'run':>4} {'policy':<16} {'model':<10} {'rows':>6} {'prec':>6} {'recall':>6} {'F1':>6} "
+             f"{'acc':>6} {'rows/s':>7} {'p50 ms':>7}"]
+    for run in runs:
+        result = EvalResult()
+        result.confusion_matrix[:] = [[run['tn'], run['fp']], [run['fn'], run['tp']]]
+        classified = result.rows - (run['resumed'] or 0)
+        if classified <= 0:
+            # Everything came from the checkpoint: no speed was measured in this run
+            rate, p50 = f"{'resumed':>7}", f"{'-':>7}"
+        else:
+            rate = f"{classified / run['elapsed'] if run['elapsed'] else 0.0:>7.2f}"
+            p50 = f"{run['p50'] * 1000:>7.0f}"
+        lines.append(f"{run['run_id']:>4} {run['policy']:<16} {run['model']:<10} {result.rows:>6} "
+                     f"{result.precision:>6.3f} {result.recall:>6.3f} {result.f1:>6.3f} {result.accuracy:>6.3f} "
+                     f"{rate} {p50}")
+    return "\n".join(lines)
@@ -0,0 +1,70 @@
+import asyncio
+from collections import OrderedDict
+
+from metrics import metrics
+
+
+class MessageCache:
+    '''
+    Bounded LRU of Discord messages keyed by (channel ID, message ID).
+
+    ModBot adds every message it sees in `on_message` and drops entries when Discord reports an edit or a
+    delete, so a cached message is never stale. `fetch` answers from the cache when it can; otherwise it
+    calls `channel.fetch_message`, and concurrent lookups of the same message share that one request.
+    '''
+
+    def __init__(self, max_messages=10000):
+        self.max_messages = max_messages
+        self.messages = OrderedDict()
+        self.pending = {}  # key -> future of the fetch in flight
+        self.counts = {'hit': 0, 'miss': 0, 'coalesced': 0}
+
+    def add(self, message):
+        key = (message.channel.id, message.id)
+        self.messages[key] = message
+        self.messages.move_to_end(key)
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+    def invalidate(self, channel_id, message_id):
+        key = (channel_id, message_id)
+        self.messages.pop(key, None)
+        self.pending.pop(key, None)  # a fetch already in flight may return the old version; don't keep it
+
+    async def fetch(self, channel, message_id):
+        '''
+        Like `channel.fetch_message(message_id)`, including raising discord.NotFound, but cached and coalesced.
+        '''
+        key = (channel.id, message_id)
+        message = self.messages.get(key)
+        if message is not None:
+            self.messages.move_to_end(key)
+            self._count('hit')
+            return message
+        if key in self.pending:
+            self._count('coalesced')
+            return await asyncio.shield(self.pending[key])
+
+        self._count('miss')
+        future = asyncio.ensure_future(channel.fetch_message(message_id))
+        self.pending[key] = future
+        try:
+            message = await asyncio.shield(future)
+        finally:
+            current = self.pending.get(key)
+            if current is future:
+                del self.pending[key]
+        if current is future:
+            self.add(message)
+        return message
+
+    def _count(self, result):
+        self.counts[result] += 1
+        metrics.inc('message_lookups', result=result)
+
+    def stats(self):
+        lookups = sum(self.counts.values())
+        saved = self.counts['hit'] + self.counts['coalesced']
+        hit_rate = saved / lookups * 100 if lookups else 0.0
+        return (f"Message cache: {len(self.messages)}/{self.max_messages} messages, {self.counts['hit']} hits, "
+                f"{self.counts['coalesced']} coalesced, {self.counts['miss']} fetched ({hit_rate:.1f}% hit rate)")
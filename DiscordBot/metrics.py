@@ -0,0 +1,164 @@
+'''
+Counters, timers and sampled structured logs for the bot's hot paths.
+
+Everything records into the shared `metrics` registry. It can be scraped in Prometheus text format from
+`serve(port)`, written to a file every few seconds by `dump_periodically(path)`, or summarized with the
+`stats` mod-channel command. `log_event` replaces ad-hoc prints with one JSON line per event, of which only
+a sample is written.
+'''
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+from evaluation import percentile
+
+logger = logging.getLogger('modbot')
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in pairs) + '}'
+
+
+class Metrics:
+    '''
+    Counters and timers keyed by name and labels. Each timer keeps its total count and sum plus the last
+    `window` observations, from which the quantiles are computed.
+    '''
+
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, window=1000):
+        self.counters = defaultdict(float)
+        self.timings = defaultdict(lambda: deque(maxlen=window))
+        self.totals = defaultdict(lambda: [0, 0.0])  # key -> [count, sum of seconds]
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        self.counters[_key(name, labels)] += value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        self.timings[key].append(seconds)
+        total = self.totals[key]
+        total[0] += 1
+        total[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Time the enclosed block, including any awaits inside it. Exceptions are counted as `<name>_errors`.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            self.inc(name + '_errors', **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f'# TYPE modbot_{name}_total counter')
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(f'modbot_{name}_total{_format_labels(labels)} {value:g}')
+        for name in sorted({name for name, _ in self.totals}):
+            lines.append(f'# TYPE modbot_{name}_seconds summary')
+            for (timer, labels), (count, total) in sorted(self.totals.items()):
+                if timer != name:
+                    continue
+                recent = list(self.timings[(timer, labels)])
+                for q in self.QUANTILES:
+                    lines.append(f'modbot_{name}_seconds{_format_labels(labels, quantile=q)} '
+                                 f'{percentile(recent, q * 100):.6f}')
+                lines.append(f'modbot_{name}_seconds_count{_format_labels(labels)} {count}')
+                lines.append(f'modbot_{name}_seconds_sum{_format_labels(labels)} {total:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        One line per timer with its recent p50 and p99, then the counters; for the `stats` command.
+        '''
+        lines = [f"Up {time.time() - self.started:.0f} s"]
+        for (name, labels), recent in sorted(self.timings.items()):
+            recent = list(recent)
+            lines.append(f"{name}{_format_labels(labels)}: {self.totals[(name, labels)][0]} calls, "
+                         f"p50 {percentile(recent, 50) * 1000:.1f} ms, p99 {percentile(recent, 99) * 1000:.1f} ms")
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{_format_labels(labels)}: {value:g}")
+        return "\n".join(lines)
+
+    async def serve(self, port, host='127.0.0.1'):
+        '''
+        Answer every HTTP request on `host:port` with the Prometheus text export. Returns the asyncio server.
+        '''
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                body = self.prometheus().encode('utf-8')
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    async def dump_periodically(self, path, interval=60.0):
+        '''
+        Rewrite `path` with the Prometheus text export every `interval` seconds.
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+            os.replace(path + '.tmp', path)
+
+
+metrics = Metrics()
+
+LOG_SAMPLE_RATE = 1.0
+
+
+def setup_logging(path='discord.log', level='INFO', sample_rate=1.0):
+    '''
+    Append discord.py's and the bot's logs to a size-rotated file, keeping `sample_rate` of `log_event` lines.
+    '''
+    global LOG_SAMPLE_RATE
+    LOG_SAMPLE_RATE = sample_rate
+    handler = logging.handlers.RotatingFileHandler(filename=path, encoding='utf-8', maxBytes=10 * 1024 * 1024,
+                                                   backupCount=3)
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    for name in ('discord', 'modbot'):
+        logging.getLogger(name).setLevel(level)
+        logging.getLogger(name).addHandler(handler)
+
+
+def log_event(event, sample_rate=None, **fields):
+    '''
+    Write `event` and its fields as one JSON log line, keeping only a `sample_rate` fraction of them
+    (LOG_SAMPLE_RATE by default). Warnings and errors should go through `logger` directly instead.
+    '''
+    rate = LOG_SAMPLE_RATE if sample_rate is None else sample_rate
+    if not logger.isEnabledFor(logging.INFO) or (rate < 1 and random.random() >= rate):
+        return
+    logger.info(json.dumps({'event': event, **fields}, default=str))
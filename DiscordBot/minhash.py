@@ -0,0 +1,126 @@
+'''
+Near-duplicate detection for recent channel messages with MinHash and locality-sensitive hashing.
+
+A message becomes the set of character 3-grams of its normalized text. Its MinHash signature has `num_perm`
+values, and the fraction of values two signatures share estimates the Jaccard similarity of their 3-gram
+sets. The signature is cut into `bands` bands. Messages sharing any whole band land in the same bucket, so a
+query only compares against the few messages that collide with it rather than every message in the window.
+With 16 bands of 4 values, pairs at similarity 0.7 collide 99% of the time and pairs at 0.3 about 12%.
+'''
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from verdict_cache import normalize_text
+
+PUNCTUATION = re.compile(r'[^\w ]+')
+
+
+def shingles(text, size=3):
+    text = PUNCTUATION.sub('', normalize_text(text))
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHashIndex:
+    '''
+    Signatures of the messages seen in the last `window` seconds, at most `max_entries` of them, each with a
+    value (ModBot stores the message and its pending verdict). `query` returns the value of the most similar
+    message whose estimated similarity is at least `threshold`. Messages with fewer than `min_shingles`
+    3-grams are too short to compare and get no signature.
+    '''
+
+    def __init__(self, num_perm=64, bands=16, threshold=0.7, window=300.0, max_entries=10000, min_shingles=8,
+                 clock=time.monotonic, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"{num_perm} permutations do not split into {bands} bands")
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: (a * x + b) mod 2 ** 64, top 32 bits, with a odd; no division needed
+        self.a = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.threshold = threshold
+        self.window = window
+        self.max_entries = max_entries
+        self.min_shingles = min_shingles
+        self.clock = clock
+        self.entries = OrderedDict()  # entry id -> (added at, signature, value), oldest first
+        # Per band: hash of the band -> entry id, or a list of entry ids oldest first once several share it
+        self.buckets = [{} for _ in range(bands)]
+        self.next_id = 0
+        self.queries = 0
+        self.matches = 0
+
+    def signature(self, text):
+        grams = shingles(text)
+        if len(grams) < self.min_shingles:
+            return None
+        x = np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+        return ((np.outer(x, self.a) + self.b) >> np.uint64(32)).min(axis=0).astype(np.uint32)
+
+    def _bands(self, signature):
+        # A hash collision between different bands only adds a candidate, which the similarity check rejects
+        return [hash(signature[i * self.rows:(i + 1) * self.rows].tobytes()) for i in range(self.bands)]
+
+    def _expire(self, now):
+        while self.entries:
+            entry_id, (added_at, signature, _) = next(iter(self.entries.items()))
+            if now - added_at <= self.window and len(self.entries) <= self.max_entries:
+                return
+            del self.entries[entry_id]
+            # Ids enter every bucket in time order, so the oldest entry is always at the front of its buckets
+            for buckets, key in zip(self.buckets, self._bands(signature)):
+                bucket = buckets[key]
+                if type(bucket) is int or len(bucket) == 1:
+                    del buckets[key]
+                else:
+                    bucket.pop(0)
+
+    def add(self, signature, value):
+        now = self.clock()
+        entry_id = self.next_id
+        self.next_id += 1
+        self.entries[entry_id] = (now, signature, value)
+        for buckets, key in zip(self.buckets, self._bands(signature)):
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = entry_id  # most buckets only ever hold one message
+            elif type(bucket) is int:
+                buckets[key] = [bucket, entry_id]
+            else:
+                bucket.append(entry_id)
+        self._expire(now)
+
+    def query(self, signature):
+        '''
+        The value of the most similar recent message, or None if none reaches `threshold`.
+        '''
+        self._expire(self.clock())
+        self.queries += 1
+        candidates = set()
+        for buckets, key in zip(self.buckets, self._bands(signature)):
+            bucket = buckets.get(key)
+            if type(bucket) is int:
+                candidates.add(bucket)
+            elif bucket is not None:
+                candidates.update(bucket)
+        best, best_similarity = None, self.threshold
+        for entry_id in candidates:
+            _, other, value = self.entries[entry_id]
+            similarity = np.count_nonzero(other == signature) / len(signature)
+            if similarity >= best_similarity:
+                best, best_similarity = value, similarity
+        if best is not None:
+            self.matches += 1
+        return best
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        rate = self.matches / self.queries * 100 if self.queries else 0.0
+        return (f"Near-duplicates: {len(self)}/{self.max_entries} recent messages, {self.matches} of "
+                f"{self.queries} messages matched an earlier one ({rate:.1f}%)")
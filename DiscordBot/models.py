@@ -0,0 +1,105 @@
+import asyncio
+import importlib
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from evaluation import percentile
+from metrics import metrics
+
+
+class ModelRegistry:
+    '''
+    Generative models shared by every Report.
+
+    The Vertex SDK is initialized once and each model is constructed once, lazily, on first use (or ahead of
+    time with `prewarm`). Generation never runs on the event loop: it uses the SDK's native async call when
+    there is one and a bounded thread pool otherwise, with at most `max_concurrency` calls in flight per model
+    and each call bounded by `timeout` seconds. Initialization time and per-call latency are recorded for
+    `stats`.
+    '''
+
+    def __init__(self, project, location, max_concurrency=8, timeout=60.0, max_workers=16, history=1000):
+        self.project = project
+        self.location = location
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generate')
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(self.max_concurrency))
+        self.lock = threading.Lock()
+        self.initialized = False
+        self.models = {}
+        self.init_times = {}  # name -> seconds spent initializing ('vertexai' for the SDK itself)
+        self.latencies = defaultdict(lambda: deque(maxlen=history))
+
+    def get(self, name):
+        model = self.models.get(name)
+        if model is not None:
+            return model
+        with self.lock:
+            if name not in self.models:
+                import vertexai
+                from vertexai.generative_models import GenerativeModel
+
+                if not self.initialized:
+                    start = time.perf_counter()
+                    vertexai.init(project=self.project, location=self.location)
+                    self.init_times['vertexai'] = time.perf_counter() - start
+                    self.initialized = True
+                start = time.perf_counter()
+                self.models[name] = GenerativeModel(model_name=name)
+                self.init_times[name] = time.perf_counter() - start
+        return self.models[name]
+
+    async def prewarm(self, names):
+        '''
+        Initialize the given models in a worker thread so the first report does not pay for it.
+        '''
+        for name in names:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.get, name)
+
+    async def sdk(self):
+        '''
+        The vertexai.generative_models module (Part, Image, SafetySetting, ...). Importing it takes seconds, so
+        the first call imports it in a worker thread rather than on the event loop.
+        '''
+        module = sys.modules.get('vertexai.generative_models')
+        if module is None:
+            module = await asyncio.get_running_loop().run_in_executor(
+                self.executor, importlib.import_module, 'vertexai.generative_models')
+        return module
+
+    async def generate(self, name, parts, **kwargs):
+        '''
+        Generate content with model `name`. Raises asyncio.TimeoutError if the call takes longer than `timeout`.
+        '''
+        loop = asyncio.get_running_loop()
+        model = self.models.get(name) or await loop.run_in_executor(self.executor, self.get, name)
+        async with self.semaphores[name]:
+            start = time.perf_counter()
+            try:
+                if hasattr(model, 'generate_content_async'):
+                    call = model.generate_content_async(parts, **kwargs)
+                else:
+                    call = loop.run_in_executor(self.executor, partial(model.generate_content, parts, **kwargs))
+                return await asyncio.wait_for(call, self.timeout)
+            finally:
+                self.latencies[name].append(time.perf_counter() - start)
+                metrics.observe('generation', self.latencies[name][-1], model=name)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        lines = []
+        for name, seconds in self.init_times.items():
+            line = f"{name}: initialized in {seconds * 1000:.0f} ms"
+            if self.latencies[name]:
+                calls = list(self.latencies[name])
+                line += (f", {len(calls)} recent calls, p50 {percentile(calls, 50) * 1000:.0f} ms, "
+                         f"p95 {percentile(calls, 95) * 1000:.0f} ms")
+            lines.append(line)
+        return "\n".join(lines) or "No models loaded yet"
@@ -0,0 +1,130 @@
+import asyncio
+
+from metrics import metrics
+
+MAX_MESSAGE_LENGTH = 2000  # Discord's limit for one message's content
+
+
+def pack(lines, limit=MAX_MESSAGE_LENGTH):
+    '''
+    Join lines with newlines into as few messages of at most `limit` characters as possible, splitting only
+    between lines unless a single line is too long on its own.
+    '''
+    messages = []
+    current = ''
+    for line in lines:
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ''
+            messages.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = ''
+        current = f'{current}\n{line}' if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+def retry_after(error):
+    '''
+    Seconds Discord asked us to wait if `error` is a 429, otherwise None.
+    '''
+    if getattr(error, 'status', None) != 429 and not hasattr(error, 'retry_after'):
+        return None
+    if getattr(error, 'retry_after', None) is not None:
+        return float(error.retry_after)
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    return float(headers.get('Retry-After', 1.0))
+
+
+class Outbox:
+    '''
+    Outgoing message pipeline shared by the whole bot.
+
+    Lines sent to the same channel within `flush_interval` seconds are packed into as few messages as the
+    2000 character limit allows, so one event costs one API call instead of one per line. Each channel has
+    at most one send in flight, which keeps lines in order and lets whatever piles up behind a slow or
+    rate-limited send go out as one message. A 429 response is retried after the delay Discord asked for,
+    up to `retries` times.
+    '''
+
+    def __init__(self, flush_interval=0.1, retries=5):
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.pending = {}  # channel id -> (channel, [(lines, future)])
+        self.timers = {}
+        self.draining = set()  # channel ids with a send loop running
+        self.api_calls = 0
+        self.lines_sent = 0
+        self.rate_limited = 0
+
+    async def send(self, channel, *lines):
+        '''
+        Queue `lines` for `channel` and wait until they have been delivered.
+        '''
+        lines = [str(line) for line in lines if line]
+        if not lines:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(channel.id, (channel, []))[1].append((lines, future))
+        if channel.id not in self.timers:
+            self.timers[channel.id] = asyncio.get_running_loop().call_later(self.flush_interval, self.flush,
+                                                                             channel.id)
+        await future
+
+    def flush(self, channel_id):
+        timer = self.timers.pop(channel_id, None)
+        if timer is not None:
+            timer.cancel()
+        if channel_id in self.pending and channel_id not in self.draining:
+            self.draining.add(channel_id)
+            asyncio.ensure_future(self._drain(channel_id))
+
+    async def _drain(self, channel_id):
+        '''
+        Send everything queued for one channel; lines queued while a send is in flight (or waiting out a 429)
+        go out together in the next one.
+        '''
+        try:
+            while channel_id in self.pending:
+                timer = self.timers.pop(channel_id, None)
+                if timer is not None:
+                    timer.cancel()
+                channel, batch = self.pending.pop(channel_id)
+                lines = [line for event_lines, _ in batch for line in event_lines]
+                try:
+                    for message in pack(lines):
+                        await self._send(channel, message)
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.lines_sent += len(lines)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+        finally:
+            self.draining.discard(channel_id)
+
+    async def _send(self, channel, content):
+        for attempt in range(self.retries + 1):
+            self.api_calls += 1
+            try:
+                with metrics.timer('discord_send'):
+                    return await channel.send(content)
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is None or attempt == self.retries:
+                    raise
+                self.rate_limited += 1
+                metrics.inc('discord_rate_limited')
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        per_call = self.lines_sent / self.api_calls if self.api_calls else 0.0
+        return (f"Outbox: {self.lines_sent} lines in {self.api_calls} API calls ({per_call:.1f} lines per call), "
+                f"{self.rate_limited} rate limited retries")
@@ -0,0 +1,116 @@
+'''
+Perceptual hashes of images moderators confirmed as violations, so reposts are caught without an LLM call.
+
+`dhash` reduces an image to 64 bits that survive recompression, rescaling and small crops. `HashIndex` finds
+the stored hash nearest to a query within `max_distance` differing bits using multi-index hashing: split into
+`chunks` 16-bit chunks, two hashes within distance r agree to within r // chunks bits on at least one chunk, so
+only the stored hashes whose chunk falls in those few buckets are compared. Each chunk keeps a sorted copy
+of its values, which keeps a million hashes in about 32 MB and makes a lookup a handful of binary searches.
+'''
+import io
+from itertools import combinations
+
+import numpy as np
+from PIL import Image
+
+
+def dhash(data):
+    '''
+    64-bit difference hash of encoded image bytes: shrink to a 9 x 8 grayscale image and keep one bit per pair
+    of horizontally adjacent pixels, set when brightness increases left to right.
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (32, 32))  # JPEGs decode straight to a small grayscale image
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+
+
+def flip_masks(bits, radius):
+    '''
+    Every `bits`-wide mask with at most `radius` bits set.
+    '''
+    masks = [0]
+    for r in range(1, radius + 1):
+        masks += [sum(1 << i for i in positions) for positions in combinations(range(bits), r)]
+    return np.array(masks, dtype=np.uint64)
+
+
+class HashIndex:
+    '''
+    Nearest-neighbour lookup of 64-bit hashes by Hamming distance; see the module docstring.
+    '''
+
+    def __init__(self, max_distance=10, chunks=4, merge_every=10000):
+        self.max_distance = max_distance
+        self.chunks = chunks
+        self.bits = 64 // chunks
+        self.dtype = np.uint16 if self.bits <= 16 else np.uint32
+        self.masks = flip_masks(self.bits, max_distance // chunks).astype(self.dtype)
+        self.merge_every = merge_every
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self.sorted = []  # per chunk: (chunk values in ascending order, positions in `hashes`)
+        self.pending = []  # hashes added since the last merge, scanned linearly
+        self._build()
+
+    def __len__(self):
+        return len(self.hashes) + len(self.pending)
+
+    def _chunk(self, hashes, i):
+        return ((hashes >> np.uint64(i * self.bits)) & np.uint64((1 << self.bits) - 1)).astype(self.dtype)
+
+    def _build(self):
+        self.sorted = []
+        for i in range(self.chunks):
+            values = self._chunk(self.hashes, i)
+            order = np.argsort(values, kind='stable').astype(np.uint32)
+            self.sorted.append((values[order], order))
+
+    def extend(self, hashes):
+        '''
+        Add many hashes at once (e.g. everything stored, at startup) and rebuild the chunk tables.
+        '''
+        self.hashes = np.concatenate([self.hashes, np.array(list(hashes) + self.pending, dtype=np.uint64)])
+        self.pending = []
+        self._build()
+
+    def add(self, value):
+        '''
+        Add one hash unless an identical one is already stored. Returns whether it was added.
+        '''
+        match = self.nearest(value, max_distance=0)
+        if match is not None:
+            return False
+        self.pending.append(value)
+        if len(self.pending) >= self.merge_every:
+            self.extend([])
+        return True
+
+    def nearest(self, value, max_distance=None):
+        '''
+        (distance, hash) of the stored hash closest to `value` if it is within `max_distance` bits, else None.
+        '''
+        max_distance = self.max_distance if max_distance is None else max_distance
+        best = None
+        for stored in self.pending:
+            distance = (stored ^ value).bit_count()
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, stored)
+
+        if len(self.hashes):
+            query = np.uint64(value)
+            candidates = []
+            for i, (values, order) in enumerate(self.sorted):
+                keys = self._chunk(query, i) ^ self.masks
+                lo = np.searchsorted(values, keys, 'left')
+                hi = np.searchsorted(values, keys, 'right')
+                lengths = hi - lo
+                # Every position in each [lo, hi) range at once, rather than one slice per bucket
+                starts = np.repeat(lo - np.cumsum(lengths) + lengths, lengths)
+                candidates.append(order[starts + np.arange(len(starts))])
+            found = self.hashes[np.concatenate(candidates)]
+            if len(found):
+                distances = np.bitwise_count(found ^ query)
+                i = int(np.argmin(distances))
+                if distances[i] <= max_distance and (best is None or distances[i] < best[0]):
+                    best = (int(distances[i]), int(found[i]))
+        return best
@@ -0,0 +1,145 @@
+'''
+Cheap local classification tier that runs before the LLM.
+
+A regex lexicon catches messages that must always escalate, a few rules clear content with nothing to judge
+(emoji-only, "lol"), and a logistic regression over hashed word and character n-grams scores the rest.
+Messages the model is confident about are decided locally; everything else escalates to `eval_text`.
+
+Train a model from a labelled CSV with:
+
+    python prefilter.py train dataset.csv Text oh_label prefilter.npz
+'''
+import re
+import sys
+import zlib
+
+import numpy as np
+
+from verdict_cache import normalize_text
+
+
+# Anything matching this always goes to the LLM, whatever the model says
+ESCALATE_PATTERN = re.compile(
+    r"\b(kill|die|hurt|hate|ugly|fat|stupid|idiot|loser|slut|whore|retard\w*|dox\w*|address|phone|nudes?|"
+    r"kys|stfu|worthless|disgusting|freak|bitch\w*|fag\w*|shoot|stab|rape\w*)\b",
+    re.IGNORECASE,
+)
+
+# Short messages that are benign on their own
+BENIGN_WORDS = {
+    'lol', 'lmao', 'haha', 'hahaha', 'ok', 'okay', 'k', 'yes', 'no', 'yeah', 'yep', 'nope', 'thanks', 'thx', 'ty',
+    'hi', 'hey', 'hello', 'bye', 'gg', 'nice', 'cool', 'same', 'wow', 'omg', 'np', 'sure', 'true', 'agreed',
+}
+
+# Words in any script; text is NFKC-normalized first, so fullwidth and other compatibility forms fold to ASCII
+WORD_PATTERN = re.compile(r"[\w']+")
+
+
+def features(text, dimensions):
+    '''
+    Hash word unigrams/bigrams and character 3-grams of `text` into indices of a `dimensions`-wide vector.
+    '''
+    words = WORD_PATTERN.findall(normalize_text(text))
+    grams = ['w:' + w for w in words]
+    grams += ['b:' + a + ' ' + b for a, b in zip(words, words[1:])]
+    padded = f' {" ".join(words)} '
+    grams += ['c:' + padded[i:i + 3] for i in range(len(padded) - 2)]
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) % dimensions for g in grams), dtype=np.int64,
+                       count=len(grams))
+
+
+class Prefilter:
+    def __init__(self, weights=None, bias=0.0, dimensions=2 ** 18, benign_threshold=0.1, violation_threshold=None):
+        '''
+        `benign_threshold` and `violation_threshold` are probabilities; a message scoring below the first is
+        cleared locally and one scoring above the second is flagged locally. Pass None to disable either.
+        '''
+        self.weights = weights if weights is not None else np.zeros(dimensions, dtype=np.float32)
+        self.bias = bias
+        self.dimensions = len(self.weights)
+        self.trained = weights is not None
+        self.benign_threshold = benign_threshold
+        self.violation_threshold = violation_threshold
+        self.counts = {'rules': 0, 'model': 0, 'llm': 0}
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        data = np.load(path)
+        return cls(weights=data['weights'], bias=float(data['bias']), **kwargs)
+
+    def save(self, path):
+        np.savez_compressed(path, weights=self.weights, bias=self.bias)
+
+    def score(self, text):
+        '''
+        Probability that `text` is a violation according to the linear model.
+        '''
+        index = features(text, self.dimensions)
+        return float(1 / (1 + np.exp(-(self.weights[index].sum() + self.bias))))
+
+    def decide(self, text):
+        '''
+        Return ('yes' or 'no', tier) if the message can be decided locally, or (None, 'llm') if it should escalate.
+        '''
+        text = normalize_text(text)
+        if not ESCALATE_PATTERN.search(text):
+            words = WORD_PATTERN.findall(text)
+            # Only text with no words at all (emoji, punctuation) is cleared without reading it
+            if not words or (len(words) <= 3 and all(w in BENIGN_WORDS for w in words)):
+                return 'no', 'rules'
+
+            if self.trained:
+                p = self.score(text)
+                if self.benign_threshold is not None and p < self.benign_threshold:
+                    return 'no', 'model'
+                if self.violation_threshold is not None and p > self.violation_threshold:
+                    return 'yes', 'model'
+
+        return None, 'llm'
+
+    def classify(self, text):
+        '''
+        Return 'yes' or 'no' if the message can be decided locally, or None if it should escalate to the LLM.
+        '''
+        verdict, tier = self.decide(text)
+        self.counts[tier] += 1
+        return verdict
+
+    def fit(self, texts, labels, epochs=5, learning_rate=0.1, l2=1e-6):
+        '''
+        Train the weights with plain SGD on the logistic loss.
+        '''
+        examples = [(features(text, self.dimensions), float(label)) for text, label in zip(texts, labels)]
+        rng = np.random.default_rng(0)
+        for _ in range(epochs):
+            for i in rng.permutation(len(examples)):
+                index, label = examples[i]
+                p = 1 / (1 + np.exp(-(self.weights[index].sum() + self.bias)))
+                gradient = p - label
+                np.subtract.at(self.weights, index, learning_rate * (gradient + l2 * self.weights[index]))
+                self.bias -= learning_rate * gradient
+        self.trained = True
+
+    def stats(self, since=None):
+        '''
+        Describe what fraction of messages each tier decided, optionally relative to an earlier `counts` copy.
+        '''
+        counts = {tier: n - (since or {}).get(tier, 0) for tier, n in self.counts.items()}
+        total = sum(counts.values())
+        if not total:
+            return "Tiers: no messages classified"
+        return "Tiers: " + ", ".join(f"{tier} {n} ({n / total * 100:.1f}%)" for tier, n in counts.items())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 6 or sys.argv[1] != 'train':
+        sys.exit(__doc__)
+    import csv
+
+    _, _, dataset_path, text_key, label_key, output_path = sys.argv
+    with open(dataset_path, encoding='utf-8', newline='') as f:
+        rows = list(csv.DictReader(f))
+    prefilter = Prefilter()
+    prefilter.fit([row[text_key] for row in rows], [int(row[label_key]) for row in rows])
+    prefilter.save(output_path)
+    print(f'Trained on {len(rows)} rows, saved to {output_path}')
@@ -0,0 +1,85 @@
+'''
+Named policy versions and the classification prompt templates built from them.
+
+Each policy lives in `policies/<name>.txt` and is loaded once. For every policy, the static part of each
+request (the policy text followed by the modality's instruction) is built ahead of time and always sent first,
+so consecutive requests share a byte-identical prefix that provider-side prompt caching can reuse. Only the
+message text and images are appended per call.
+'''
+import hashlib
+import os
+
+POLICY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'policies')
+
+# Instruction sent after the policy for each input modality
+INSTRUCTIONS = {
+    'text': "Let's say the following is a comment on twitter, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
+    'image': "Let's say the image is a instagram post, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
+    'reply_to_image': "Let's say the first image is a instagram post and the second text is a response to the post, would you consider the response a violation of cyberbullying policy? Please answer with only a 'yes' or 'no'",
+    'image_pair': "Let's say the first image is a instagram post and the second image is a response to the post, would you consider the response a violation of cyberbullying policy? Please start answer with only 'yes' or 'no' ",
+    'batch': "Let's say the following numbered items are comments on twitter, would you consider each one a violation of cyberbullying policy? Please answer with only a JSON array containing one string, 'yes' or 'no', per item, in the same order",
+}
+
+
+def text_part(text):
+    return {"type": "text", "text": text}
+
+
+def image_part(url):
+    return {"type": "image_url", "image_url": {"url": url}}
+
+
+def count_tokens(text):
+    '''
+    Token count with tiktoken when it is installed, otherwise the usual ~4 characters per token estimate.
+    '''
+    try:
+        import tiktoken
+    except ImportError:
+        return (len(text) + 3) // 4
+    return len(tiktoken.get_encoding('o200k_base').encode(text))
+
+
+class Policy:
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.version = f"{name}@{hashlib.sha256(text.encode('utf-8')).hexdigest()[:8]}"
+        self.templates = {
+            modality: [text_part(part) for part in (text, instruction) if part]
+            for modality, instruction in INSTRUCTIONS.items()
+        }
+
+    def messages(self, modality, *parts):
+        '''
+        Chat messages for one request: the precomputed static prefix followed by the per-message `parts`.
+        '''
+        return [{"role": "user", "content": self.templates[modality] + list(parts)}]
+
+    def token_counts(self):
+        '''
+        Tokens in the static prefix of each modality's template, i.e. the fixed cost of every request.
+        '''
+        return {modality: sum(count_tokens(part["text"]) for part in template)
+                for modality, template in self.templates.items()}
+
+
+def load_policies(directory=POLICY_DIR):
+    policies = {}
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if extension == '.txt':
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                policies[name] = Policy(name, f.read().strip())
+    return policies
+
+
+POLICIES = load_policies()
+
+
+def token_report():
+    lines = [f"{'policy':<8}" + "".join(f"{modality:>16}" for modality in INSTRUCTIONS)]
+    for name, policy in POLICIES.items():
+        counts = policy.token_counts()
+        lines.append(f"{name:<8}" + "".join(f"{counts[modality]:>16}" for modality in INSTRUCTIONS))
+    return "\n".join(lines)
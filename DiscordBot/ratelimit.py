@@ -0,0 +1,130 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from verdict_cache import normalize_text
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now, cost=1):
+        self.refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class RateLimiter:
+    '''
+    Admission control in front of auto-classification.
+
+    Every message spends one token from its author's bucket (`author_rate` per second, bursts of `author_burst`)
+    and one from its channel's bucket. At most `max_workers` admitted messages are processed at once and at most
+    `max_pending` may be admitted but unfinished; past that the work queue counts as full.
+
+    A message over either limit, or arriving while the queue is full, is shed instead of processed. A repeat
+    of something the same author recently said is coalesced into the earlier copy; anything else is handled
+    by `shed_policy`: 'cheap' sends it to the local prefilter only, 'sample' still processes one in
+    `1 / sample_rate` of them, and 'drop' ignores it.
+
+    `admit` returns 'process', 'cheap' or 'drop', and every outcome is counted for `stats`.
+    '''
+
+    DECISIONS = ('processed', 'cheap', 'sampled', 'coalesced', 'dropped')
+
+    def __init__(self, author_rate=0.2, author_burst=5, channel_rate=5.0, channel_burst=30, max_workers=8,
+                 max_pending=64, shed_policy='cheap', sample_rate=0.1, repeat_window=60.0, max_keys=10000,
+                 clock=time.monotonic):
+        if shed_policy not in ('cheap', 'sample', 'drop'):
+            raise ValueError(f"Unknown shed policy {shed_policy!r}")
+        self.author_rate = author_rate
+        self.author_burst = author_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_pending = max_pending
+        self.shed_policy = shed_policy
+        self.sample_rate = sample_rate
+        self.repeat_window = repeat_window
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()  # ('author' | 'channel', id) -> TokenBucket, least recently used first
+        self.recent = OrderedDict()  # (author_id, normalized text) -> last seen
+        self.workers = asyncio.Semaphore(max_workers)
+        self.pending = 0
+        self.counts = dict.fromkeys(self.DECISIONS, 0)
+        self.queue_full = 0
+
+    def _bucket(self, kind, key, rate, burst, now):
+        bucket = self.buckets.get((kind, key))
+        if bucket is None:
+            bucket = self.buckets[(kind, key)] = TokenBucket(rate, burst, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        self.buckets.move_to_end((kind, key))
+        return bucket
+
+    def _is_repeat(self, author_id, text, now):
+        key = (author_id, normalize_text(text))
+        last_seen = self.recent.pop(key, None)
+        self.recent[key] = now
+        while len(self.recent) > self.max_keys:
+            self.recent.popitem(last=False)
+        return last_seen is not None and now - last_seen <= self.repeat_window
+
+    def admit(self, author_id, channel_id, text):
+        now = self.clock()
+        repeat = self._is_repeat(author_id, text, now)
+        # Authors already over their own limit do not also use up the channel's allowance
+        author_ok = self._bucket('author', author_id, self.author_rate, self.author_burst, now).take(now)
+        channel_ok = author_ok and self._bucket('channel', channel_id, self.channel_rate, self.channel_burst,
+                                                now).take(now)
+        full = self.pending >= self.max_pending
+        if full:
+            self.queue_full += 1
+
+        if author_ok and channel_ok and not full:
+            self.counts['processed'] += 1
+            return 'process'
+        if repeat:
+            self.counts['coalesced'] += 1
+            return 'drop'
+        if self.shed_policy == 'cheap':
+            self.counts['cheap'] += 1
+            return 'cheap'
+        if self.shed_policy == 'sample' and not full and random.random() < self.sample_rate:
+            self.counts['sampled'] += 1
+            return 'process'
+        self.counts['dropped'] += 1
+        return 'drop'
+
+    @asynccontextmanager
+    async def processing(self):
+        '''
+        Hold one of the `max_workers` slots while an admitted message is processed.
+        '''
+        self.pending += 1
+        try:
+            async with self.workers:
+                yield
+        finally:
+            self.pending -= 1
+
+    def stats(self):
+        total = sum(self.counts.values())
+        shed = total - self.counts['processed'] - self.counts['sampled']
+        lines = [f"Rate limiting: {total} messages, {shed} shed ({shed / total * 100 if total else 0.0:.1f}%), "
+                 f"{self.pending} in progress, queue full {self.queue_full} times"]
+        lines.append(", ".join(f"{decision} {n}" for decision, n in self.counts.items()))
+        return "\n".join(lines)
@@ -0,0 +1,421 @@
+'''
+Offline replay harness for ModBot.
+
+Feeds synthetic or recorded message streams through `ModBot.on_message` using stub Discord guilds, channels
+and users, and stub classifier, attachment and Gemini backends whose latencies are log-normal around a
+configurable median. For each scenario it prints throughput, per-message latency percentiles, API call
+counts and peak Python memory, so regressions in the hot paths show up without Discord or API keys:
+
+    python replay.py                                  # every scenario with the default sizes
+    python replay.py channel --messages 2000 --llm-latency 0.3
+    python replay.py recorded stream.jsonl
+
+A recorded stream is JSONL with one message per line: {"t": seconds, "author": id, "content": text} plus
+optional "dm": true, "images": count and "reply_to": the line number (from 0) of an earlier channel message.
+
+Everything runs in a temporary directory, so the bot's SQLite files never touch the working copy.
+'''
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+GUILD_ID = 1000
+CHANNEL_ID = 2000
+MOD_CHANNEL_ID = 2001
+BOT_ID = 1
+VIOLATION_WORDS = ('trash', 'idiot', 'loser', 'ugly', 'worthless')
+WORDS = ('the', 'game', 'last', 'night', 'was', 'really', 'fun', 'anyone', 'up', 'for', 'another', 'round',
+         'i', 'think', 'we', 'should', 'try', 'that', 'new', 'map', 'later', 'today', 'lol', 'nice')
+
+
+class Latency:
+    '''
+    Log-normal delay with the given median (seconds) and shape `sigma`.
+    '''
+
+    def __init__(self, median, sigma=0.5):
+        self.median = median
+        self.sigma = sigma
+
+    async def wait(self):
+        if self.median > 0:
+            await asyncio.sleep(self.median * math.exp(random.gauss(0, self.sigma)))
+
+
+class Harness:
+    '''
+    The fake world a replay runs in: one guild with a public and a mod channel, users created on demand,
+    stub backends, and a counter of every API call the bot makes.
+    '''
+
+    def __init__(self, args):
+        self.calls = Counter()
+        self.discord_latency = Latency(args.discord_latency, args.sigma)
+        self.llm_latency = Latency(args.llm_latency, args.sigma)
+        self.vertex_latency = Latency(args.vertex_latency, args.sigma)
+        self.cdn_latency = Latency(args.cdn_latency, args.sigma)
+        self.guild = StubGuild(GUILD_ID, 'Replay Guild')
+        self.channel = StubChannel(self, CHANNEL_ID, f'group-{args.group}', self.guild)
+        self.mod_channel = StubChannel(self, MOD_CHANNEL_ID, f'group-{args.group}-mod', self.guild)
+        self.users = {}
+        self.next_message_id = 10 ** 6
+
+    def user(self, user_id):
+        if user_id not in self.users:
+            self.users[user_id] = StubUser(self, user_id, f'user{user_id}')
+        return self.users[user_id]
+
+    def message(self, author, content, channel, attachments=(), reference=None):
+        self.next_message_id += 1
+        message = StubMessage(self.next_message_id, author, content, channel, attachments, reference)
+        channel.messages[message.id] = message
+        return message
+
+    def image(self):
+        self.next_message_id += 1
+        return StubAttachment(self.next_message_id, f'https://cdn.example/{self.next_message_id}.png')
+
+    def link(self, message):
+        return f'https://discord.com/channels/{GUILD_ID}/{message.channel.id}/{message.id}'
+
+
+class StubGuild:
+    def __init__(self, guild_id, name):
+        self.id = guild_id
+        self.name = name
+        self.channels = {}
+
+    @property
+    def text_channels(self):
+        return list(self.channels.values())
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+
+class StubChannel:
+    def __init__(self, harness, channel_id, name, guild=None):
+        self.harness = harness
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.messages = {}
+        if guild is not None:
+            guild.channels[channel_id] = self
+
+    async def send(self, content=None, **kwargs):
+        self.harness.calls['discord send'] += 1
+        await self.harness.discord_latency.wait()
+
+    async def fetch_message(self, message_id):
+        self.harness.calls['discord fetch'] += 1
+        await self.harness.discord_latency.wait()
+        return self.messages[message_id]
+
+
+class StubUser:
+    def __init__(self, harness, user_id, name):
+        self.harness = harness
+        self.id = user_id
+        self.name = name
+        self.dm_channel = StubChannel(harness, user_id, f'dm-{name}')
+
+    async def send(self, content=None, **kwargs):
+        self.harness.calls['discord dm'] += 1
+        await self.harness.discord_latency.wait()
+
+
+class StubAttachment:
+    def __init__(self, attachment_id, url, content_type='image/png', size=50 * 1024):
+        self.id = attachment_id
+        self.url = url
+        self.filename = url.rsplit('/', 1)[-1]
+        self.content_type = content_type
+        self.size = size
+
+
+class StubMessage:
+    def __init__(self, message_id, author, content, channel, attachments=(), reference=None):
+        self.id = message_id
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.attachments = list(attachments)
+        self.reference = SimpleNamespace(message_id=reference.id) if reference is not None else None
+        self.jump_url = f'https://discord.com/channels/{GUILD_ID}/{channel.id}/{message_id}'
+
+
+class StubClassifier:
+    '''
+    Answers like the OpenAI classifier would: 'yes' when the text contains an insult, 'no' otherwise.
+    '''
+
+    def __init__(self, harness):
+        self.harness = harness
+
+    @staticmethod
+    def label(text):
+        return 'yes' if any(word in text.lower() for word in VIOLATION_WORDS) else 'no'
+
+    async def create(self, messages, max_tokens=300, **kwargs):
+        self.harness.calls['llm request'] += 1
+        await self.harness.llm_latency.wait()
+        text = messages[0]['content'][-1].get('text', '')
+        if "numbered items" in messages[0]['content'][-2].get('text', ''):
+            content = json.dumps([self.label(line) for line in text.splitlines()])
+        else:
+            content = f'{self.label(text).capitalize()}, because of the wording used.'
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    async def stream_verdict(self, messages, **kwargs):
+        self.harness.calls['llm request'] += 1
+        await self.harness.llm_latency.wait()
+        label = self.label(messages[0]['content'][-1].get('text', ''))
+        return label, 0.9 if label == 'yes' else 0.1
+
+    async def close(self):
+        pass
+
+
+class StubModel:
+    def __init__(self, harness):
+        self.harness = harness
+
+    async def generate_content_async(self, parts, **kwargs):
+        self.harness.calls['vertex request'] += 1
+        await self.harness.vertex_latency.wait()
+        return SimpleNamespace(text='Here are some resources that may help.')
+
+
+def make_bot(harness, args):
+    from attachments import AttachmentFetcher, FetchedAttachment
+    from bot import ModBot
+    from report import GEMINI_MODEL
+
+    class StubFetcher(AttachmentFetcher):
+        async def _download(self, attachment):
+            harness.calls['cdn download'] += 1
+            await harness.cdn_latency.wait()
+            return FetchedAttachment(attachment.id, attachment.url, attachment.content_type, bytes(attachment.size))
+
+    class ReplayBot(ModBot):
+        @property
+        def user(self):
+            return SimpleNamespace(id=BOT_ID, name=f'Group {args.group} Bot')
+
+        def get_guild(self, guild_id):
+            return harness.guild if guild_id == GUILD_ID else None
+
+        def get_channel(self, channel_id):
+            return harness.guild.get_channel(channel_id)
+
+        def get_user(self, user_id):
+            return harness.user(user_id)
+
+        async def fetch_channel(self, channel_id):
+            return harness.guild.get_channel(channel_id)
+
+        async def fetch_user(self, user_id):
+            return harness.user(user_id)
+
+    tokens = {'discord': 'replay', 'openai': 'sk-replay', 'database_path': 'replay.db'}
+    if not args.rate_limits:
+        tokens.update(author_rate=1e6, author_burst=1e6, channel_rate=1e6, channel_burst=1e6,
+                      channel_workers=args.concurrency, channel_queue_size=10 ** 6)
+    bot = ReplayBot(tokens)
+    bot.group_num = str(args.group)
+    bot.mod_channels[GUILD_ID] = harness.mod_channel
+    bot.classifier = StubClassifier(harness)
+    bot.attachments = StubFetcher()
+    bot.models.models[GEMINI_MODEL] = StubModel(harness)
+    return bot
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))] if values else 0.0
+
+
+async def deliver(bot, message, latencies):
+    start = time.perf_counter()
+    await bot.on_message(message)
+    latencies.append(time.perf_counter() - start)
+
+
+def channel_stream(harness, args):
+    '''
+    Channel chatter: `messages` posts from `authors` members, some with an image and some replying to an
+    earlier image post, a fraction of them insulting.
+    '''
+    stream = []
+    image_posts = []
+    t = 0.0
+    for i in range(args.messages):
+        words = random.choices(WORDS, k=random.randint(3, 12))
+        if random.random() < args.violation_ratio:
+            words.insert(random.randrange(len(words)), random.choice(VIOLATION_WORDS))
+        attachments = [harness.image()] if random.random() < args.image_ratio else []
+        reference = random.choice(image_posts) if image_posts and random.random() < args.reply_ratio else None
+        author = harness.user(100 + random.randrange(args.authors))
+        message = harness.message(author, ' '.join(words) + f' #{i}', harness.channel, attachments, reference)
+        if attachments:
+            image_posts.append(message)
+        stream.append((t, message))
+        t += random.expovariate(args.rate) if args.rate else 0.0
+    return stream
+
+
+async def replay(bot, stream):
+    '''
+    Deliver each (t, message) at its offset from now; messages from one author are delivered in order.
+    '''
+    latencies = []
+    previous = {}  # author id -> task of that author's previous message
+    tasks = []
+
+    async def send(t, message, before):
+        await asyncio.sleep(t)
+        if before is not None:
+            await before
+        await deliver(bot, message, latencies)
+
+    for t, message in stream:
+        task = asyncio.ensure_future(send(t, message, previous.get(message.author.id)))
+        previous[message.author.id] = task
+        tasks.append(task)
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def report_flow(harness, reporter, target):
+    '''
+    The DM messages of one complete bullying report, up to the point it is queued for review.
+    '''
+    dm = reporter.dm_channel
+    steps = ['report', harness.link(target), '1', '1', '3', 'next', '1', 'Y']
+    return [harness.message(reporter, step, dm) for step in steps]
+
+
+async def run_dms(bot, harness, args):
+    targets = [harness.message(harness.user(100 + i), f'you are such a loser #{i}', harness.channel)
+               for i in range(args.reporters)]
+    latencies = []
+
+    async def reporter_flow(i):
+        await asyncio.sleep(random.uniform(0, args.spread))
+        for message in report_flow(harness, harness.user(5000 + i), targets[i]):
+            await deliver(bot, message, latencies)
+
+    await asyncio.gather(*(reporter_flow(i) for i in range(args.reporters)))
+    return latencies
+
+
+async def run_reviews(bot, harness, args):
+    await run_dms(bot, harness, args)  # fill the queue first; only the reviews are measured
+    latencies = []
+
+    async def moderator(i):
+        moderator = harness.user(9000 + i)
+        while len(bot.review_queue):
+            for step in ('review', '3', '2'):
+                await deliver(bot, harness.message(moderator, step, harness.mod_channel), latencies)
+
+    await asyncio.gather(*(moderator(i) for i in range(args.moderators)))
+    return latencies
+
+
+def recorded_stream(harness, path):
+    stream = []
+    posted = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            author = harness.user(event['author'])
+            channel = author.dm_channel if event.get('dm') else harness.channel
+            attachments = [harness.image() for _ in range(event.get('images', 0))]
+            reference = posted[event['reply_to']] if event.get('reply_to') is not None else None
+            message = harness.message(author, event['content'], channel, attachments, reference)
+            posted.append(message)
+            stream.append((event.get('t', 0.0), message))
+    return stream
+
+
+SCENARIOS = {
+    'channel': lambda bot, harness, args: replay(bot, channel_stream(harness, args)),
+    'dm': run_dms,
+    'review': run_reviews,
+    'recorded': lambda bot, harness, args: replay(bot, recorded_stream(harness, args.record)),
+}
+
+
+async def run_scenario(name, args):
+    harness = Harness(args)
+    bot = make_bot(harness, args)
+    await bot.models.sdk()  # loaded in the background after connecting in production (ModBot.prewarm)
+    tracemalloc.start()
+    start = time.perf_counter()
+    latencies = await SCENARIOS[name](bot, harness, args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    bot.report_store.close()
+
+    print(f'{name}: {len(latencies)} messages in {elapsed:.2f} s, {len(latencies) / elapsed:.1f} messages/s')
+    print(f'  latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms, '
+          f'p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies, default=0) * 1000:.1f} ms')
+    print('  API calls: ' + ', '.join(f'{call} {n}' for call, n in sorted(harness.calls.items())))
+    print(f'  peak memory {peak / 2 ** 20:.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', nargs='?', choices=['all'] + list(SCENARIOS), default='all')
+    parser.add_argument('record', nargs='?', help='JSONL stream for the recorded scenario')
+    parser.add_argument('--messages', type=int, default=1000, help='channel messages')
+    parser.add_argument('--authors', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=200.0, help='channel messages per second, 0 for all at once')
+    parser.add_argument('--image-ratio', type=float, default=0.1)
+    parser.add_argument('--reply-ratio', type=float, default=0.05)
+    parser.add_argument('--violation-ratio', type=float, default=0.1)
+    parser.add_argument('--reporters', type=int, default=100, help='concurrent DM reports')
+    parser.add_argument('--moderators', type=int, default=5)
+    parser.add_argument('--spread', type=float, default=1.0, help='seconds over which reporters start')
+    parser.add_argument('--concurrency', type=int, default=64, help='channel messages processed at once')
+    parser.add_argument('--rate-limits', action='store_true', help="keep the bot's default rate limits")
+    parser.add_argument('--discord-latency', type=float, default=0.05, help='median seconds per Discord call')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='median seconds per classifier call')
+    parser.add_argument('--vertex-latency', type=float, default=1.0, help='median seconds per Gemini call')
+    parser.add_argument('--cdn-latency', type=float, default=0.1, help='median seconds per attachment download')
+    parser.add_argument('--sigma', type=float, default=0.5, help='spread of every latency distribution')
+    parser.add_argument('--group', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.scenario == 'recorded' and not args.record:
+        parser.error('the recorded scenario needs a JSONL stream')
+
+    if args.record:
+        args.record = os.path.abspath(args.record)
+    scenarios = [name for name in SCENARIOS if name != 'recorded'] if args.scenario == 'all' else [args.scenario]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        for name in scenarios:
+            random.seed(args.seed)
+            asyncio.run(run_scenario(name, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,36 @@
 from enum import Enum, auto
+import asyncio
+import time
+import uuid
 import discord
 import re
 
-import json
+from attachments import image_attachments
+from prompts import POLICIES
+from metrics import metrics
 
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Image
-from vertexai import generative_models
-import requests
 
+GEMINI_MODEL = "gemini-1.0-pro-vision-001"
 
-def update_adversarial_reports(username, count):
-    username = str(username)
-    with open('adversarial_data.json', 'r+') as file:
-        data = json.load(file)
-        if username in data:
-            data[username]['count'] += count
-        else:
-            data[username] = {'count': count}
-        file.seek(0)
-        json.dump(data, file, indent=4)
 
+def update_adversarial_reports(offender_store, username, count):
+    with metrics.timer('offender_store', op='increment'):
+        return offender_store.increment('adversarial', username, count)
 
-def update_violation_reports(username, count):
-    username = str(username)
-    with open('violation_data.json', 'r+') as file:
-        data = json.load(file)
-        if username in data:
-            data[username]['count'] += count
-        else:
-            data[username] = {'count': count}
-        file.seek(0)
-        json.dump(data, file, indent=4)
 
+def update_violation_reports(offender_store, username, count):
+    with metrics.timer('offender_store', op='increment'):
+        return offender_store.increment('violation', username, count)
 
-def read_adversarial_reports(username):
-    username = str(username)
-    with open('adversarial_data.json', 'r') as file:
-        data = json.load(file)
-        if str(username) in data:
-            return int(data[username]['count'])
-        else:
-            return 0
 
+def read_adversarial_reports(offender_store, username):
+    with metrics.timer('offender_store', op='read'):
+        return offender_store.read('adversarial', username)
 
-def read_violation_reports(username):
-    username = str(username)
-    with open('violation_data.json', 'r') as file:
-        data = json.load(file)
-        if username in data:
-            return int(data[username]['count'])
-        else:
-            return 0
 
+def read_violation_reports(offender_store, username):
+    with metrics.timer('offender_store', op='read'):
+        return offender_store.read('violation', username)
 
 
 class State(Enum):
@@ -74,67 +52,182 @@ class State(Enum):
     REPORT_COMPLETE = auto() # start: block simulated
 
 
+# States a report passes through while a moderator works on it
+REVIEW_STATES = {
+    State.AWAITING_REVIEW,
+    State.VIOLATION_TYPE,
+    State.AWAITING_BAN_POSTER,
+    State.AWAITING_BAN_REPORTER,
+    State.AWAITING_ADVERSARIAL_DECISION,
+    State.AWAITING_OTHER_VIOLATION_TYPE,
+}
+
+
 class Report:
     START_KEYWORD = "report"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
     REVIEW_KEYWORD = "review"
 
-    def __init__(self, client):
+    # Lookup tables shared by every report. bullying_type and victim are replaced on the instance by the
+    # number the reporter picked, which shadows the class-level table from then on.
+    abuse_type = {
+        '1': "Bullying",
+        '2' : "Spam",
+        '3': "Offensive Content",
+        '4': "Immenent Danger"
+    }  # abuse type dictionary, used for report summary
+
+    bullying_type = {
+        '1': "Threatening/abusive message(s)",
+        '2': "Doxxing/exposing private information",
+        '3': "Sharing nonconsensual image(s)"
+    }  # bullying type dictionary, used for report summary
+
+    blocking_type = {
+        '1': "Block just this account",
+        '2': "Block this and any future accounts they create using the same email/phone number",
+        '3': "Do not block"
+    }  # blocking type dictionary, used for report summary
+
+    victim = {
+        '1': "User",
+        '2': "Someone the user knows",
+        '3': "Other"
+    }  # who the victim is dictionary, used for report summary
+
+    policy_text = POLICIES['short'].text
+
+    def __init__(self, client, report_id=None):
+        self.report_id = report_id or uuid.uuid4().hex
+        self.created_at = time.time()
         self.state = State.REPORT_START
         self.client = client
         self.report_message = None  # message contents of the report
-        self.bullying_type = None # 1: threatening/abusive messages, 2: doxxing, 3: nonconsensual images
-        self.victim = None # 1: me, 2: someone I know, 3: other
         self.msg_poster = None  # The author who posted the reported message
         self.msg_reporter = None  # the author who opened the report
+        self.selected_abuse_type = None  # abuse type picked by the reporter, used to prioritize review
+        self.classifier_verdict = None  # verdict of the automatic classifier, if it flagged the message
 
-        self.abuse_type = {
-                            '1': "Bullying",
-                            '2' : "Spam",
-                            '3': "Offensive Content",
-                            '4': "Immenent Danger"
-                    } # abuse type dictionary, used for report summary
-
-        self.bullying_type = {
-                            '1': "Threatening/abusive message(s)",
-                            '2': "Doxxing/exposing private information",
-                            '3': "Sharing nonconsensual image(s)"
-                    } # bullying type dictionary, used for report summary
-
-        self.blocking_type = {
-                            '1': "Block just this account",
-                            '2': "Block this and any future accounts they create using the same email/phone number",
-                            '3': "Do not block"
-                    } # blocking type dictionary, used for report summary
-
-        self.victim = {
-                            '1': "User",
-                            '2': "Someone the user knows",
-                            '3': "Other"
-                    } # who the victim is dictionary, used for report summary
+        # IDs behind report_message, msg_poster and msg_reporter; reports restored from storage only have these
+        self.message_link = None  # [guild id, channel id, message id] of the reported message
+        self.poster_id = None
+        self.reporter_id = None
 
         self.report_summary = []
-        self.policy_text = """
-                Cyberbullying Policy:
+        self.generation = None  # in-flight Gemini call, if any
+        self.busy = False  # a reporter's DM or a moderator's review message is being handled
+        self.generation_cancelled = False
 
-                Cyberbullying is strictly prohibited on this platform. This includes content that targets an individual (including by name, handle, or image, regardless of whether or not that individual is directly tagged in the post itself) with one or more threatening or abusive messages, doxxes or exposes private information about an individual, and/or shares one or more nonconsensual images of an individual with malicious intent.
-        """
-    
-    async def save_image(self, image_url, image_path):
+    def to_dict(self):
         '''
-        Download an image from a URL and save it locally.
+        Everything needed to rebuild this report after a restart, as plain JSON-serializable values.
         '''
-        response = requests.get(image_url)
-        image_data = response.content
-
-        # image_path = 'image.jpg'
-        with open(image_path, 'wb') as f:
-            f.write(image_data)
+        return {
+            'id': self.report_id,
+            'created': self.created_at,
+            'state': self.state.name,
+            'summary': self.report_summary,
+            'abuse': self.selected_abuse_type,
+            'verdict': self.classifier_verdict,
+            'bullying': self.bullying_type if isinstance(self.bullying_type, int) else None,
+            'victim': self.victim if isinstance(self.victim, int) else None,
+            'link': self.message_link,
+            'poster': self.poster_id,
+            'reporter': self.reporter_id,
+        }
+
+    @classmethod
+    def from_dict(cls, client, data):
+        '''
+        Rebuild a report from `to_dict` output without touching Discord; see `resolve`.
+        '''
+        report = cls(client, report_id=data['id'])
+        report.created_at = data['created']
+        report.state = State[data['state']]
+        report.report_summary = data['summary']
+        report.selected_abuse_type = data['abuse']
+        report.classifier_verdict = data['verdict']
+        if data['bullying'] is not None:
+            report.bullying_type = data['bullying']
+        if data['victim'] is not None:
+            report.victim = data['victim']
+        report.message_link = data['link']
+        report.poster_id = data['poster']
+        report.reporter_id = data['reporter']
+        return report
+
+    def set_reported_message(self, message, poster):
+        self.report_message = message
+        self.message_link = [message.guild.id, message.channel.id, message.id]
+        self.msg_poster = poster
+        self.poster_id = poster.id
+
+    async def resolve(self):
+        '''
+        Fetch the Discord objects of a report restored from storage, the first time they are needed. Returns
+        False if one of them was deleted or the bot can no longer see it.
+        '''
+        try:
+            if self.report_message is None and self.message_link:
+                channel = self.client.get_channel(self.message_link[1]) or await self.client.fetch_channel(self.message_link[1])
+                self.report_message = await self.client.message_cache.fetch(channel, self.message_link[2])
+            if self.msg_poster is None and self.poster_id:
+                self.msg_poster = self.client.get_user(self.poster_id) or await self.client.fetch_user(self.poster_id)
+            if self.msg_reporter is None and self.reporter_id:
+                self.msg_reporter = self.client.get_user(self.reporter_id) or await self.client.fetch_user(self.reporter_id)
+        except (discord.NotFound, discord.Forbidden):
+            return False
+        return True
+
+    def close_unavailable(self):
+        '''
+        Close a report whose message, channel or user is gone; ModBot then drops it from the store and the queue.
+        '''
+        self.state = State.REPORT_COMPLETE
+        metrics.inc('reports_closed_unavailable')
+        return ["The reported message, its channel or one of the users involved has been deleted or is no longer "
+                "visible to the bot, so this report has been closed."]
 
-        return image_path
+    async def generate(self, parts, safety_settings):
+        '''
+        Run a Gemini call that `cancel_generation` can interrupt. Returns None if it was cancelled or timed out.
+        '''
+        self.generation_cancelled = False
+        self.generation = asyncio.ensure_future(
+            self.client.models.generate(GEMINI_MODEL, parts, safety_settings=safety_settings))
+        try:
+            return await self.generation
+        except asyncio.TimeoutError:
+            return None
+        except asyncio.CancelledError:
+            if not self.generation_cancelled:
+                raise  # we are being cancelled ourselves, not just the generation
+            return None
+        finally:
+            self.generation = None
+
+    def cancel_generation(self):
+        if self.generation is not None:
+            self.generation_cancelled = True
+            self.generation.cancel()
 
     async def handle_message(self, message):
+        '''
+        Handle one DM of the reporting flow. A message that arrives while an earlier one is still being answered
+        (e.g. waiting on Gemini) is turned away rather than moving the form on underneath it; `cancel` always works.
+        '''
+        if message.content == self.CANCEL_KEYWORD:
+            return await self._handle_message(message)
+        if self.busy:
+            return ["Still working on your last answer, one moment."]
+        self.busy = True
+        try:
+            return await self._handle_message(message)
+        finally:
+            self.busy = False
+
+    async def _handle_message(self, message):
         '''
         This function makes up the meat of the user-side reporting flow. It defines how we transition between states and what 
         prompts to offer at each of those states. You're welcome to change anything you want; this skeleton is just here to
@@ -142,26 +235,28 @@ class Report:
         '''
         
         # Handle image attachments in the original message
-        image_urls = [attachment.url for attachment in message.attachments if attachment.content_type.startswith('image')]
-        referenced_image_urls = []
-
-        vertexai.init(project='cs152team5', location="us-central1")
-        self.model = GenerativeModel(model_name="gemini-1.0-pro-vision-001")
+        attachments = message.attachments
+        referenced_attachments = []
 
         # print('image_urls', image_urls)
 
         # self.image_urls = referenced_image_urls
         # # Handle image attachments in the referenced message (if any)
         if message.reference:
-            referenced_message = await message.channel.fetch_message(message.reference.message_id)
-            referenced_image_urls = [attachment.url for attachment in referenced_message.attachments if attachment.content_type.startswith('image')]
+            referenced_message = await self.client.message_cache.fetch(message.channel, message.reference.message_id)
+            referenced_attachments = referenced_message.attachments
 
         if message.content == self.CANCEL_KEYWORD:
             self.state = State.REPORT_COMPLETE
+            self.cancel_generation()
             return ["Report cancelled."]
 
+        if not await self.resolve():
+            return self.close_unavailable()
+
         if self.state == State.REPORT_START:
             self.msg_reporter = message.author
+            self.reporter_id = message.author.id
             reply =  "Thank you for starting the reporting process. "
             reply += "Say `help` at any time for more information.\n\n"
             reply += "Please copy paste the link to the message you want to report.\n"
@@ -181,14 +276,15 @@ class Report:
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                self.report_message = await channel.fetch_message(int(m.group(3)))
+                self.report_message = await self.client.message_cache.fetch(channel, int(m.group(3)))
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
             self.report_summary.append('Reported author:' + self.report_message.author.name)
             self.report_summary.append('Reported message:' + self.report_message.content)
-            self.msg_poster = message.author
+            # The poster is the reported message's author, whose prior violations rank the report for review
+            self.set_reported_message(self.report_message, self.report_message.author)
 
-            referenced_image_urls = [attachment.url for attachment in self.report_message.attachments if attachment.content_type.startswith('image')]
+            referenced_image_urls = [attachment.url for attachment in image_attachments(self.report_message.attachments)]
 
             # Here we've found the message - it's up to you to decide what to do next!
             self.state = State.AWAITING_ABUSE_TYPE
@@ -208,6 +304,7 @@ class Report:
 
         if self.state == State.AWAITING_ABUSE_TYPE:
             self.report_summary.append('Abuse type:' + self.abuse_type[message.content])
+            self.selected_abuse_type = self.abuse_type[message.content]
             if message.content == '1':
                 self.state = State.AWAITING_BULLYING_TYPE
                 return ["Please specify the type of bullying: ", \
@@ -265,20 +362,19 @@ class Report:
 
         if self.state == State.AWAITING_RESOURCES:
             reply = []
-            self.state = State.AWAITING_REVIEW
             if message.content == "Y":
+                generative_models = await self.client.models.sdk()
+                Part, Image = generative_models.Part, generative_models.Image
+
                 parts = []
 
                 # print('referenced_image_urls', referenced_image_urls)
                 # print('image_urls', image_urls)
                 
-                for image_url in referenced_image_urls:
-                    image_path = await self.save_image(image_url, image_path='reference_image.jpg')
-                    parts.append(Part.from_image(Image.load_from_file(image_path)))
-                
-                for image_url in image_urls:
-                    image_path = await self.save_image(image_url, image_path='image.jpg')
-                    parts.append(Part.from_image(Image.load_from_file(image_path)))
+                referenced_images, images = await asyncio.gather(self.client.attachments.fetch_all(referenced_attachments),
+                                                                 self.client.attachments.fetch_all(attachments))
+                for image in referenced_images + images:
+                    parts.append(Part.from_image(Image.from_bytes(image.data)))
 
                 # # Download images and add them to the parts list
                 # for image_url in referenced_image_urls:
@@ -433,10 +529,17 @@ class Report:
                     ),
                 ]
 
-                response = self.model.generate_content(parts, safety_settings=safety_config)
+                response = await self.generate(parts, safety_config)
+                if self.state == State.REPORT_COMPLETE:
+                    return []  # the reporter cancelled while we were waiting
 
                 # reply += [' ', ]
-                reply += ["Mental health resources", response.text]
+                if response is not None:
+                    reply += ["Mental health resources", response.text]
+                else:
+                    reply += ["Sorry, we couldn't put together mental health resources right now."]
+            # Only now, so a message sent while Gemini was answering can't also finish the form
+            self.state = State.AWAITING_REVIEW
             reply += ["Thank you for keeping our community safe from bullying! Your report will be reviewed and appropriate action will be taken.", \
             "Would you like to block this user to prevent seeing their content in the future?", \
             "1. Yes, just this account", \
@@ -463,6 +566,21 @@ class Report:
         return []
 
     async def handle_review(self, message):
+        '''
+        Handle one message of the review flow, turning away messages that arrive while an earlier one is still
+        being answered, the same way `handle_message` does for the reporter.
+        '''
+        if message.content == self.CANCEL_KEYWORD:
+            return await self._handle_review(message)
+        if self.busy:
+            return ["Still working on your last answer, one moment."]
+        self.busy = True
+        try:
+            return await self._handle_review(message)
+        finally:
+            self.busy = False
+
+    async def _handle_review(self, message):
         '''
         This function makes up the meat of the moderator-side manual review flow.
         '''
@@ -470,6 +588,9 @@ class Report:
             self.state = State.REVIEW_COMPLETE
             return ["Review cancelled."]
 
+        if not await self.resolve():
+            return self.close_unavailable()
+
         if self.state == State.AWAITING_REVIEW:
             reply = ["Thank you for starting the reviewing process. "]
             reply += ["Say `help` at any time for more information.\n\n"]
@@ -486,30 +607,27 @@ class Report:
 
         if self.state == State.VIOLATION_TYPE:
             if message.content == '1':
-                num_violations = read_violation_reports(self.msg_poster.id)
+                num_violations = read_violation_reports(self.client.offender_store, self.msg_poster.id)
                 reply = "This reported user has " + str(num_violations) + " previous violations. \n"
-                update_violation_reports(self.msg_poster.id, 1)
 
                 if num_violations == 0:
-                    self.state = State.REPORT_COMPLETE
+                    generative_models = await self.client.models.sdk()
+                    Part, Image = generative_models.Part, generative_models.Image
 
                     parts = [self.policy_text]
                     parts.append('Reported message:' + self.report_message.content)
 
-                    image_urls = [attachment.url for attachment in message.attachments if attachment.content_type.startswith('image')]
-                    referenced_image_urls = [attachment.url for attachment in self.report_message.attachments if attachment.content_type.startswith('image')]
+                    images, referenced_images = await asyncio.gather(
+                        self.client.attachments.fetch_all(message.attachments),
+                        self.client.attachments.fetch_all(self.report_message.attachments))
 
-                    if image_urls:
-                        for image_url in image_urls:
-                            image_path = await self.save_image(image_url, image_path='image.jpg')
-                            parts.append('Reported image:')
-                            parts.append(Part.from_image(Image.load_from_file(image_path)))
+                    for image in images:
+                        parts.append('Reported image:')
+                        parts.append(Part.from_image(Image.from_bytes(image.data)))
 
-                    if referenced_image_urls:
-                        for image_url in referenced_image_urls:
-                            image_path = await self.save_image(image_url, image_path='reference_image.jpg')
-                            parts.append('Post image:')
-                            parts.append(Part.from_image(Image.load_from_file(image_path)))
+                    for image in referenced_images:
+                        parts.append('Post image:')
+                        parts.append(Part.from_image(Image.from_bytes(image.data)))
 
                     parts.append('Explain why the text or image is a violation of a social media platform?')
 
@@ -533,11 +651,16 @@ class Report:
                         ),
                     ]
 
-                    response = self.model.generate_content(parts, safety_settings=safety_config)
+                    response = await self.generate(parts, safety_config)
+                    if self.generation_cancelled:
+                        return []  # the moderator cancelled the review while we were waiting
+                    # Completed only now, so a message sent during generation can't close the report early
+                    self.state = State.REPORT_COMPLETE
                     # print(['response.text', response.text])
-                    await self.msg_poster.send('Reported message:' + self.report_message.content)
-                    await self.msg_poster.send(response.text)
-                    await self.msg_poster.send("Please don't bully people, that's bad :(")
+                    await self.client.outbox.send(self.msg_poster,
+                                                  'Reported message:' + self.report_message.content,
+                                                  response.text if response is not None else None,
+                                                  "Please don't bully people, that's bad :(")
                     reply += "Warning sent!"
                 elif num_violations < 3:
                     self.state = State.REPORT_COMPLETE
@@ -546,6 +669,10 @@ class Report:
                     self.state = State.AWAITING_BAN_POSTER
                     reply += "Do you want to ban the user?\n 1. Yes\n 2. No"
 
+                # Recorded only now: a review cancelled while the warning was being written goes back in the queue
+                update_violation_reports(self.client.offender_store, self.msg_poster.id, 1)
+                # A confirmed violation: reposts of its images will be flagged without asking the classifier
+                await self.client.remember_violating_images(self.report_message, self.report_id)
                 return [reply]
 
             elif message.content == '2':
@@ -562,14 +689,16 @@ class Report:
                 "2. No"]
         
         if self.state == State.AWAITING_OTHER_VIOLATION_TYPE:
+            # Only now is the violation confirmed; a review cancelled at this prompt goes back in the queue
+            await self.client.remember_violating_images(self.report_message, self.report_id)
             self.state = State.REPORT_COMPLETE
             return ["The report has been sent to another moderation team"]
 
         if self.state == State.AWAITING_ADVERSARIAL_DECISION:
             if message.content == '1':
-                num_violations = read_adversarial_reports(self.msg_reporter.id)
+                num_violations = read_adversarial_reports(self.client.offender_store, self.msg_reporter.id)
                 reply = "This reporting user has " + str(num_violations) + " previous adversarial reports. \n"
-                update_adversarial_reports(self.msg_reporter.id, 1)
+                update_adversarial_reports(self.client.offender_store, self.msg_reporter.id, 1)
 
                 if num_violations <= 1:
                     self.state = State.REPORT_COMPLETE
@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+from evaluation import percentile
+from storage import connect
+
+
+# Lower rank is reviewed first; reports without an abuse type (e.g. auto-flagged ones) sit after Bullying
+ABUSE_TYPE_RANK = {
+    "Immenent Danger": 0,
+    "Bullying": 1,
+    "Offensive Content": 3,
+    "Spam": 4,
+}
+UNKNOWN_ABUSE_TYPE_RANK = 2
+
+
+class ReviewQueue:
+    '''
+    Priority queue of reports awaiting moderator review.
+
+    Reports are ordered by abuse type, then by whether the classifier flagged them, then by the offender's
+    number of prior violations, with the oldest report first among equals. Each moderator claims at most one
+    report at a time and claimed reports leave the heap, so concurrent moderators always work distinct
+    reports. Enqueue and claim are O(log n); removal is lazy.
+    '''
+
+    def __init__(self, history=1000):
+        self.heap = []
+        self.entries = {}  # report key -> heap entry, for queued reports only
+        self.claims = {}  # moderator id -> (report key, entry)
+        self.counter = itertools.count()
+        self.waits = deque(maxlen=history)  # seconds each recently claimed report spent queued
+
+    def push(self, key, abuse_type=None, flagged=False, prior_violations=0, enqueued_at=None):
+        if key in self.entries or self.claimed_by(key) is not None:
+            return
+        rank = ABUSE_TYPE_RANK.get(abuse_type, UNKNOWN_ABUSE_TYPE_RANK)
+        enqueued_at = enqueued_at or time.time()
+        entry = [rank, not flagged, -prior_violations, enqueued_at, next(self.counter), key]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def claim(self, moderator_id):
+        '''
+        Hand the most urgent unclaimed report to `moderator_id` and return its key, or None if the queue is
+        empty. A moderator who already holds a claim gets that report back.
+        '''
+        if moderator_id in self.claims:
+            return self.claims[moderator_id][0]
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            key = entry[-1]
+            if self.entries.get(key) is not entry:
+                continue  # removed while queued
+            del self.entries[key]
+            self.claims[moderator_id] = (key, entry)
+            self.waits.append(time.time() - entry[3])
+            return key
+        return None
+
+    def claimed(self, moderator_id):
+        claim = self.claims.get(moderator_id)
+        return claim[0] if claim else None
+
+    def claimed_by(self, key):
+        for moderator_id, (claimed_key, _) in self.claims.items():
+            if claimed_key == key:
+                return moderator_id
+        return None
+
+    def release(self, moderator_id):
+        '''
+        Give up a claim without finishing it; the report goes back in the queue with its original age.
+        '''
+        key, entry = self.claims.pop(moderator_id)
+        entry = entry[:4] + [next(self.counter), key]
+        self.entries[key] = entry
+        heapq.heappush(self.heap, entry)
+
+    def complete(self, moderator_id):
+        self.claims.pop(moderator_id, None)
+
+    def remove(self, key):
+        '''
+        Drop a report from the queue (e.g. the reporter cancelled it) and from any claim on it.
+        '''
+        self.entries.pop(key, None)
+        moderator_id = self.claimed_by(key)
+        if moderator_id is not None:
+            del self.claims[moderator_id]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        now = time.time()
+        oldest = max((now - entry[3] for entry in self.entries.values()), default=0.0)
+        return (f"Review queue: {len(self)} waiting, {len(self.claims)} claimed, oldest waiting {oldest:.0f} s\n"
+                f"Time in queue: p50 {percentile(list(self.waits), 50):.0f} s, "
+                f"p95 {percentile(list(self.waits), 95):.0f} s")
+
+
+class SharedReviewQueue:
+    '''
+    ReviewQueue kept in SQLite instead of memory, for a bot sharded across processes.
+
+    Every shard opens the same database, so they all see one queue. A claim is a single UPDATE, which means
+    two shards can never hand out the same report. Ordering and interface match ReviewQueue. Claims are
+    stored with the queue, so they outlive the shard that made them until the report is completed or released.
+    '''
+
+    ORDER = 'rank, unflagged, prior, enqueued_at, rowid'
+
+    def __init__(self, path='moderation.db', history=1000):
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS review_queue (
+                key TEXT PRIMARY KEY,
+                rank INTEGER NOT NULL,
+                unflagged INTEGER NOT NULL,
+                prior INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed_by INTEGER
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS review_queue_order '
+                        'ON review_queue (rank, unflagged, prior, enqueued_at) WHERE claimed_by IS NULL')
+        self.db.execute('CREATE INDEX IF NOT EXISTS review_queue_claims ON review_queue (claimed_by)')
+        self.waits = deque(maxlen=history)  # seconds each report recently claimed by this shard spent queued
+
+    def _one(self, query, params=()):
+        with self.lock:
+            row = self.db.execute(query, params).fetchone()
+        return row[0] if row else None
+
+    def push(self, key, abuse_type=None, flagged=False, prior_violations=0, enqueued_at=None):
+        rank = ABUSE_TYPE_RANK.get(abuse_type, UNKNOWN_ABUSE_TYPE_RANK)
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO review_queue VALUES (?, ?, ?, ?, ?, NULL)',
+                            (key, rank, not flagged, -prior_violations, enqueued_at or time.time()))
+
+    def claim(self, moderator_id):
+        '''
+        Hand the most urgent unclaimed report to `moderator_id` and return its key, or None if the queue is
+        empty. A moderator who already holds a claim gets that report back.
+        '''
+        key = self.claimed(moderator_id)
+        if key is not None:
+            return key
+        with self.lock:
+            row = self.db.execute(f'''
+                UPDATE review_queue SET claimed_by = ?
+                WHERE key = (SELECT key FROM review_queue WHERE claimed_by IS NULL ORDER BY {self.ORDER} LIMIT 1)
+                RETURNING key, enqueued_at
+            ''', (moderator_id,)).fetchone()
+        if row is None:
+            return None
+        self.waits.append(time.time() - row[1])
+        return row[0]
+
+    def claimed(self, moderator_id):
+        return self._one('SELECT key FROM review_queue WHERE claimed_by = ?', (moderator_id,))
+
+    def claimed_by(self, key):
+        return self._one('SELECT claimed_by FROM review_queue WHERE key = ?', (key,))
+
+    def release(self, moderator_id):
+        with self.lock:
+            self.db.execute('UPDATE review_queue SET claimed_by = NULL WHERE claimed_by = ?', (moderator_id,))
+
+    def complete(self, moderator_id):
+        with self.lock:
+            self.db.execute('DELETE FROM review_queue WHERE claimed_by = ?', (moderator_id,))
+
+    def remove(self, key):
+        with self.lock:
+            self.db.execute('DELETE FROM review_queue WHERE key = ?', (key,))
+
+    def __len__(self):
+        return self._one('SELECT COUNT(*) FROM review_queue WHERE claimed_by IS NULL')
+
+    def stats(self):
+        with self.lock:
+            waiting, claimed, oldest = self.db.execute(
+                'SELECT COUNT(*) - COUNT(claimed_by), COUNT(claimed_by), '
+                'MIN(CASE WHEN claimed_by IS NULL THEN enqueued_at END) FROM review_queue').fetchone()
+        oldest = time.time() - oldest if oldest is not None else 0.0
+        return (f"Review queue: {waiting} waiting, {claimed} claimed, oldest waiting {oldest:.0f} s\n"
+                f"Time in queue: p50 {percentile(list(self.waits), 50):.0f} s, "
+                f"p95 {percentile(list(self.waits), 95):.0f} s")
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,54 @@
+class ModChannelIndex(dict):
+    '''
+    Map from guild ID to that guild's mod channel.
+
+    Built once when the bot connects and then kept current from guild and channel events, so nothing ever
+    rescans every channel of every guild. Reports are routed to the mod channel of the guild that owns the
+    reported message.
+    '''
+
+    def __init__(self, name=None):
+        super().__init__()
+        self.name = name  # e.g. 'group-5-mod'; known once the bot has parsed its group number
+
+    def build(self, guilds):
+        self.clear()
+        for guild in guilds:
+            self.add_guild(guild)
+
+    def add_guild(self, guild):
+        for channel in guild.text_channels:
+            if channel.name == self.name:
+                self[guild.id] = channel
+                return
+
+    def remove_guild(self, guild_id):
+        self.pop(guild_id, None)
+
+    def channel_created(self, channel):
+        if channel.name == self.name and channel.guild.id not in self:
+            self[channel.guild.id] = channel
+
+    def channel_deleted(self, channel):
+        current = self.get(channel.guild.id)
+        if current is not None and current.id == channel.id:
+            del self[channel.guild.id]
+            self.add_guild(channel.guild)  # another channel with the same name may take over
+
+    def channel_updated(self, before, after):
+        current = self.get(after.guild.id)
+        if current is not None and current.id == after.id:
+            if after.name == self.name:
+                self[after.guild.id] = after
+            else:
+                self.channel_deleted(after)  # renamed away
+        else:
+            self.channel_created(after)
+
+    def for_report(self, report):
+        '''
+        The mod channel of the guild the reported message was posted in, or None if it is unknown.
+        '''
+        if not report.message_link:
+            return None
+        return self.get(report.message_link[0])
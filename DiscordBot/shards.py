@@ -0,0 +1,70 @@
+'''
+Run ModBot sharded across processes.
+
+    python shards.py --processes 2 --shards 4 --workers 4
+
+This starts `processes` bot processes. Each is an AutoShardedClient that runs its slice of the bot's `shards`
+gateway shards. They share one pool of `workers` classification processes (see workers.py). Open reports,
+the review queue and the offender counters live in the SQLite database at `database_path`. Every process opens
+that database in WAL mode, so a report filed through one shard can be reviewed from a mod channel on another.
+Set `verdict_cache_path` in tokens.json to share the verdict cache as well. Each process logs to its own file.
+'''
+import argparse
+import multiprocessing
+
+import discord
+
+from bot import ModBot, classifier_options, load_tokens
+from metrics import setup_logging
+from workers import PoolClassifier, WorkerPool
+
+
+class ShardedModBot(ModBot, discord.AutoShardedClient):
+    pass
+
+
+def run_shards(tokens, index, shard_ids, shard_count, jobs, results):
+    '''
+    Entry point of one bot process: run `shard_ids` out of `shard_count` shards, classifying through the pool.
+    '''
+    tokens = dict(tokens, shard_ids=shard_ids, shard_count=shard_count, shared_state=True)
+    setup_logging(path=f"{tokens.get('log_path', 'discord.log')}.{index}", level=tokens.get('log_level', 'INFO'),
+                  sample_rate=tokens.get('log_sample_rate', 0.01))
+    classifier = PoolClassifier(jobs, results, index, classifier_options(tokens)['model'])
+    client = ShardedModBot(tokens, classifier=classifier)
+    client.run(tokens['discord'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=2, help='bot processes')
+    parser.add_argument('--shards', type=int, help='gateway shards in total, default one per process')
+    parser.add_argument('--workers', type=int, default=4, help='classification worker processes')
+    parser.add_argument('--tokens', default='tokens.json')
+    args = parser.parse_args()
+
+    tokens = load_tokens(args.tokens)
+    shard_count = args.shards or args.processes
+    pool = WorkerPool(args.workers, clients=args.processes, **classifier_options(tokens))
+    pool.start()
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(args.processes):
+        shard_ids = list(range(index, shard_count, args.processes))
+        processes.append(context.Process(target=run_shards, name=f'shards-{index}',
+                                         args=(tokens, index, shard_ids, shard_count, pool.jobs, pool.results[index])))
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+UPSERT = '''
+    INSERT INTO offenders (kind, user_id, count) VALUES (?, ?, ?)
+    ON CONFLICT (kind, user_id) DO UPDATE SET count = count + excluded.count
+'''
+
+
+def connect(path):
+    db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+
+class OffenderStore:
+    '''
+    Per-user violation and adversarial-report counters backed by SQLite in WAL mode.
+
+    Lookups and increments go through the (kind, user_id) primary key, so they cost O(log n) page reads no
+    matter how many users are tracked, and each increment is a single atomic upsert. WAL mode plus a busy
+    timeout lets several bot processes share the same file.
+    '''
+
+    def __init__(self, path='moderation.db'):
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS offenders (
+                kind TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (kind, user_id)
+            ) WITHOUT ROWID
+        ''')
+        self.db.execute('CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY)')
+
+    def read(self, kind, user_id):
+        with self.lock:
+            row = self.db.execute('SELECT count FROM offenders WHERE kind = ? AND user_id = ?',
+                                  (kind, str(user_id))).fetchone()
+        return row[0] if row else 0
+
+    def increment(self, kind, user_id, count=1):
+        '''
+        Add `count` to the user's counter and return the new total.
+        '''
+        with self.lock:
+            row = self.db.execute(UPSERT + ' RETURNING count', (kind, str(user_id), count)).fetchone()
+        return row[0]
+
+    def bulk_increment(self, kind, counts):
+        '''
+        Apply many (user_id, count) increments in one transaction.
+        '''
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany(UPSERT, ((kind, str(user_id), count) for user_id, count in counts))
+            self.db.execute('COMMIT')
+
+    def import_json(self, kind, path):
+        '''
+        One-time import of a legacy `{user_id: {"count": n}}` JSON file. Returns the number of users imported,
+        or 0 if the file is missing or was already imported.
+        '''
+        source = f'{kind}:{os.path.abspath(path)}'
+        if not os.path.exists(path):
+            return 0
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            if self.db.execute('SELECT 1 FROM imports WHERE source = ?', (source,)).fetchone():
+                self.db.execute('ROLLBACK')
+                return 0
+            self.db.executemany(UPSERT, ((kind, str(user_id), entry['count']) for user_id, entry in data.items()))
+            self.db.execute('INSERT INTO imports VALUES (?)', (source,))
+            self.db.execute('COMMIT')
+        return len(data)
+
+    def close(self):
+        self.db.close()
+
+
+class ReportStore:
+    '''
+    Durable copy of in-flight reports, one compact JSON row per report ID.
+
+    ModBot saves a report after every state transition and deletes it once complete, so after a restart
+    `load_all` returns exactly the reports that were still open.
+    '''
+
+    def __init__(self, path='moderation.db'):
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS reports (report_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+
+    def save(self, report_id, data):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO reports VALUES (?, ?)',
+                            (report_id, json.dumps(data, separators=(',', ':'))))
+
+    def delete(self, report_id):
+        with self.lock:
+            self.db.execute('DELETE FROM reports WHERE report_id = ?', (report_id,))
+
+    def load(self, report_id):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM reports WHERE report_id = ?', (report_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_all(self):
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM reports').fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def close(self):
+        self.db.close()
+
+
+class ImageHashStore:
+    '''
+    Perceptual hashes of images moderators confirmed as violations, with the report that confirmed each one.
+    Hashes are unsigned 64-bit values, stored shifted into SQLite's signed integer range.
+    '''
+
+    def __init__(self, path='moderation.db'):
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS image_hashes (hash INTEGER PRIMARY KEY, report_id TEXT, '
+                        'added_at REAL)')
+
+    def add(self, value, report_id, added_at):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO image_hashes VALUES (?, ?, ?)',
+                            (value - 2 ** 63, report_id, added_at))
+
+    def load_all(self):
+        with self.lock:
+            rows = self.db.execute('SELECT hash FROM image_hashes').fetchall()
+        return [value + 2 ** 63 for value, in rows]
+
+    def close(self):
+        self.db.close()
+
+
+class EvalRunStore:
+    '''
+    Finished evaluation runs, so runs against different policy versions or models can be compared later.
+    '''
+
+    COLUMNS = ('dataset', 'policy', 'model', 'finished_at', 'tn', 'fp', 'fn', 'tp', 'errors', 'elapsed', 'p50', 'p95',
+               'resumed')
+
+    def __init__(self, path='moderation.db'):
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS eval_runs (run_id INTEGER PRIMARY KEY, dataset TEXT, '
+                        'policy TEXT, model TEXT, finished_at REAL, tn INTEGER, fp INTEGER, fn INTEGER, '
+                        'tp INTEGER, errors INTEGER, elapsed REAL, p50 REAL, p95 REAL, resumed INTEGER DEFAULT 0)')
+        if 'resumed' not in [row[1] for row in self.db.execute('PRAGMA table_info(eval_runs)')]:
+            self.db.execute('ALTER TABLE eval_runs ADD COLUMN resumed INTEGER DEFAULT 0')  # tables from before
+
+    def save(self, **run):
+        with self.lock:
+            cursor = self.db.execute(f'INSERT INTO eval_runs ({", ".join(self.COLUMNS)}) '
+                                     f'VALUES ({", ".join("?" * len(self.COLUMNS))})',
+                                     [run[column] for column in self.COLUMNS])
+        return cursor.lastrowid
+
+    def latest(self, dataset=None, limit=10):
+        '''
+        The most recent runs, newest first, optionally only those on `dataset`; each as a dict.
+        '''
+        query = f'SELECT run_id, {", ".join(self.COLUMNS)} FROM eval_runs'
+        params = []
+        if dataset:
+            query += ' WHERE dataset = ?'
+            params.append(dataset)
+        query += ' ORDER BY run_id DESC LIMIT ?'
+        params.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, params).fetchall()
+        return [dict(zip(('run_id',) + self.COLUMNS, row)) for row in rows]
+
+    def close(self):
+        self.db.close()
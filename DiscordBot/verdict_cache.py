@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from storage import connect
+
+
+def normalize_text(text):
+    '''
+    Fold case, unicode forms and whitespace so trivially different copies of a message hash the same.
+    '''
+    text = unicodedata.normalize('NFKC', text or '')
+    return ' '.join(text.lower().split())
+
+
+class VerdictCache:
+    '''
+    Content-addressed cache of classifier verdicts.
+
+    Entries live in an in-memory LRU of at most `max_entries` items and expire `ttl` seconds after they were
+    stored. If `path` is given, entries are also written to a SQLite file so they survive a restart; on an
+    in-memory miss the file is consulted before reporting a miss. The file is opened in WAL mode so shard
+    processes can share it, and new entries are written in batches every `flush_interval` seconds from a
+    worker thread rather than committed one by one on the event loop.
+    '''
+
+    def __init__(self, max_entries=10000, ttl=24 * 60 * 60, path=None, flush_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.entries = OrderedDict()  # key -> (stored_at, verdict)
+        self.hits = 0
+        self.misses = 0
+        self.unwritten = []  # (key, verdict json, stored_at) rows waiting for the next flush
+        self.flush_scheduled = False
+
+        self.db = None
+        self.lock = threading.Lock()
+        if path:
+            self.db = connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, verdict TEXT, stored_at REAL)')
+            self.db.execute('DELETE FROM verdicts WHERE stored_at < ?', (time.time() - ttl,))
+
+    @staticmethod
+    def key(text, attachments=(), version=''):
+        '''
+        Hash the normalized text, the attachment identifiers (or bytes) and the policy version into one key.
+        '''
+        digest = hashlib.sha256()
+        digest.update(version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(normalize_text(text).encode('utf-8'))
+        for attachment in attachments:
+            digest.update(b'\0')
+            digest.update(attachment if isinstance(attachment, bytes) else str(attachment).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None and self.db is not None:
+            with self.lock:
+                row = self.db.execute('SELECT stored_at, verdict FROM verdicts WHERE key = ?', (key,)).fetchone()
+            if row:
+                entry = (row[0], json.loads(row[1]))
+                self._remember(key, entry)
+
+        if entry is None or now - entry[0] > self.ttl:
+            if entry is not None:
+                self.entries.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, verdict):
+        entry = (time.time(), verdict)
+        self._remember(key, entry)
+        if self.db is None:
+            return
+        self.unwritten.append((key, json.dumps(verdict), entry[0]))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()  # no event loop to block
+            return
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            loop.call_later(self.flush_interval, self._flush_in_background, loop)
+
+    def _flush_in_background(self, loop):
+        self.flush_scheduled = False
+        loop.run_in_executor(None, self.flush)
+
+    def flush(self):
+        '''
+        Write the entries stored since the last flush in one transaction.
+        '''
+        rows, self.unwritten = self.unwritten, []
+        with self.lock:
+            if not rows or self.db is None:
+                return
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)', rows)
+            self.db.execute('COMMIT')
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return (f"Verdict cache: {len(self.entries)}/{self.max_entries} entries, "
+                f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)")
@@ -0,0 +1,158 @@
+'''
+Classification in worker processes.
+
+A `WorkerPool` starts worker processes that each own a `Classifier`, so each has its own event loop and HTTP
+connection pool. They all take jobs from one shared queue. A bot process talks to the pool through a
+`PoolClassifier`. That class has the same `create` / `stream_verdict` / `close` interface as `Classifier`,
+so ModBot can use either one. Request building, the HTTP exchange and response parsing then run off the
+bot's event loop. Several bot processes (see shards.py) can share one pool, and each gets its results back
+on its own queue.
+'''
+import asyncio
+import itertools
+import multiprocessing
+import os
+import pickle
+import threading
+
+from classifier import Classifier
+
+
+def _worker(options, jobs, results, ready):
+    asyncio.run(_serve(options, jobs, results, ready))
+
+
+async def _serve(options, jobs, results, ready):
+    loop = asyncio.get_running_loop()
+    classifier = Classifier(**options)
+    classifier.client  # import openai before reporting ready
+    # Only take a job when there is room to run it, so an idle worker never waits behind a busy one's backlog
+    capacity = asyncio.Semaphore(options.get('max_concurrency', 8))
+    tasks = set()
+
+    async def run(client, job_id, method, args, kwargs):
+        try:
+            outcome = (True, await getattr(classifier, method)(*args, **kwargs))
+        except Exception as e:
+            outcome = (False, e)
+        finally:
+            capacity.release()
+        try:
+            payload = pickle.dumps((job_id,) + outcome)
+        except Exception:  # e.g. an API error holding its HTTP response
+            error = RuntimeError(f'{type(outcome[1]).__name__}: {outcome[1]}')
+            payload = pickle.dumps((job_id, False, error))
+        results[client].put(payload)
+
+    ready.put(os.getpid())
+    while True:
+        await capacity.acquire()
+        job = await loop.run_in_executor(None, jobs.get)
+        if job is None:
+            break
+        task = asyncio.ensure_future(run(*job))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+    await classifier.close()
+
+
+class PoolClassifier:
+    '''
+    A bot process's handle on a WorkerPool. A reader thread waits on this client's results queue and hands
+    each result back to the event loop that is waiting for it.
+    '''
+
+    def __init__(self, jobs, results, client=0, model='gpt-4o'):
+        self.jobs = jobs
+        self.results = results
+        self.client = client  # index of `results` in the pool's list of result queues
+        self.model = model  # the workers' model, recorded with evaluation runs
+        self.ids = itertools.count()
+        self.futures = {}
+        self.loop = None
+        self.reader = None
+
+    def _read(self):
+        while True:
+            payload = self.results.get()
+            if payload is None:
+                return
+            job_id, ok, value = pickle.loads(payload)
+            self.loop.call_soon_threadsafe(self._resolve, job_id, ok, value)
+
+    def _resolve(self, job_id, ok, value):
+        future = self.futures.pop(job_id, None)
+        if future is None or future.done():
+            return  # the caller gave up on it
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    async def _call(self, method, *args, **kwargs):
+        if self.reader is None:
+            self.loop = asyncio.get_running_loop()
+            self.reader = threading.Thread(target=self._read, daemon=True)
+            self.reader.start()
+        job_id = next(self.ids)
+        future = self.loop.create_future()
+        self.futures[job_id] = future
+        self.jobs.put((self.client, job_id, method, args, kwargs))
+        try:
+            return await future
+        finally:
+            self.futures.pop(job_id, None)
+
+    async def create(self, messages, max_tokens=300, **kwargs):
+        return await self._call('create', messages, max_tokens=max_tokens, **kwargs)
+
+    async def complete(self, messages, max_tokens=300, **kwargs):
+        return await self._call('complete', messages, max_tokens=max_tokens, **kwargs)
+
+    async def stream_verdict(self, messages, **kwargs):
+        return await self._call('stream_verdict', messages, **kwargs)
+
+    async def prewarm(self):
+        pass  # the workers loaded everything before the pool started
+
+    async def close(self):
+        if self.reader is not None:
+            self.results.put(None)  # stops the reader thread
+
+
+class WorkerPool:
+    '''
+    `processes` classification workers shared by `clients` bot processes. `options` are passed to each
+    worker's Classifier, and `max_concurrency` in them applies per worker.
+    '''
+
+    def __init__(self, processes=4, clients=1, **options):
+        context = multiprocessing.get_context('spawn')  # workers must not inherit the bot's event loop
+        self.jobs = context.Queue()
+        self.results = [context.Queue() for _ in range(clients)]
+        self.ready = context.Queue()
+        self.model = options.get('model', 'gpt-4o')
+        self.processes = [context.Process(target=_worker, args=(options, self.jobs, self.results, self.ready),
+                                          daemon=True, name=f'classifier-{i}')
+                          for i in range(processes)]
+
+    def start(self, timeout=60.0):
+        '''
+        Start the workers and wait until each has built its Classifier.
+        '''
+        for process in self.processes:
+            process.start()
+        for _ in self.processes:
+            self.ready.get(timeout=timeout)
+
+    def client(self, index=0):
+        return PoolClassifier(self.jobs, self.results[index], index, self.model)
+
+    def close(self, timeout=10.0):
+        for _ in self.processes:
+            self.jobs.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()